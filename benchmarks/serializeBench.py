@@ -0,0 +1,83 @@
+# -*- mode: python;-*-
+
+# Parse and emit throughput of Messages with each available JSON codec, for
+# a typical message and for one with a 10 MB body. Parsing leaves the body
+# undecoded until it is used; "+ body" includes decoding it.
+#
+#     make bench
+
+import random
+import string
+import time
+
+from npipes.message.header import *
+from npipes import serialize
+from npipes.serialize import CODECS, useCodec
+
+
+def typicalMessage() -> Message:
+    steps = [Step("resize", command=Command(["convert", "${bodyfile}", "out.png"]),
+                  assets=[S3Asset(S3Path("s3://bucket/images/input.png"), AssetSettings("img"))]),
+             Step("notify", trigger=TriggerSqs("results", "s3://bucket/overflow"))]
+    return Message(Header(steps=steps), BodyInString(randomText(2000)))
+
+
+def bigMessage() -> Message:
+    return Message(Header(steps=[Step("next")]), BodyInString(randomText(10 * 1024 * 1024)))
+
+
+def randomText(size:int) -> str:
+    rng = random.Random(0)
+    alphabet = string.ascii_letters + string.digits + ' "\\\n\té'
+    return "".join(rng.choices(alphabet, k=size))
+
+
+def timePerCall(f, minSeconds:float=1.0) -> float:
+    """Seconds per call of *f*, averaged over at least *minSeconds*
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        f()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= minSeconds:
+            return elapsed / calls
+
+
+def report(label:str, seconds:float, size:int) -> None:
+    throughput = f" {size / seconds / 1e6:10.1f} MB/s" if size else ""
+    print(f"  {label:<8} {seconds * 1e6:12.1f} us/msg{throughput}")
+
+
+def uncachedMinDict(header:Header) -> None:
+    """_toMinDict as it costs without the cache of default dicts
+    """
+    serialize._defaults.clear()
+    header._toMinDict()
+
+
+def main() -> None:
+    header = typicalMessage().header
+    print("typical header to dict:")
+    report("_toDict", timePerCall(header._toDict), 0)
+    report("min", timePerCall(header._toMinDict), 0)
+    report("uncached", timePerCall(lambda: uncachedMinDict(header)), 0)
+    big = bigMessage()
+    print("10 MB body message, replace the steps:")
+    report("_with", timePerCall(lambda: big._with([(".header.steps", [])])), 0)
+    report("by dict", timePerCall(lambda: big._withDict([(".header.steps", [])])), 0)
+    for name, message in [("typical", typicalMessage()), ("10 MB body", big)]:
+        for codec in sorted(CODECS):
+            useCodec(codec)
+            text = message.toMinJsonLines()
+            size = len(text.encode())
+            print(f"{name} message ({size} bytes), {codec}:")
+            report("emit", timePerCall(message.toMinJsonLines), size)
+            report("parse", timePerCall(lambda: Message.fromJsonLines(text)), size)
+            report("+ body", timePerCall(lambda: Message.fromJsonLines(text).body), size)
+    useCodec("")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+# -*- mode: python;-*-
+
+# A per-node cache of localized assets, so that an asset used by many messages
+# is downloaded once rather than once per message.
+#
+# Layout under the cache root:
+#   objects/<sha256>   localized assets (a file, or a directory if the asset was
+#                      an archive that got decompressed), named by the hash of
+#                      their content and made read-only
+#   index/<sha256>     one small file per asset version, holding the name of the
+#                      object it resolved to; keyed by a hash of the asset's
+#                      location, remote version (eg. S3 ETag) and settings
+#   locks/<sha256>     per-version lock files, so only one process fetches a
+#                      given version at a time
+#   tmp/               fetches in progress
+#
+# Objects are hardlinked (or reflinked, or as a last resort copied) into each
+# message's working location, so removing a message's files never touches the
+# cache, and evicting an object never disturbs a message that is using it.
+# Least recently used objects are evicted once the cache exceeds its size cap;
+# use is recorded by touching the object's mtime. All index and eviction
+# changes are made under flock, so several npipes processes on a host can share
+# one cache.
+
+import errno
+import hashlib
+import os
+import shutil
+import stat
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from ..outcome import Outcome, Success, Failure
+from ..utils.track import track
+from ..utils.typeshed import pathlike
+
+try:
+    import fcntl
+except ImportError: # Windows; the cache is then only safe within one process
+    fcntl = None # type: ignore
+
+# Linux ioctl to make a copy-on-write clone of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def randomTmpName() -> str:
+    return hashlib.sha256(os.urandom(16)).hexdigest()[:16]
+
+
+@contextmanager
+def flocked(path:Path) -> Iterator[None]:
+    """Holds an exclusive flock on *path* for the duration of the context
+    """
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def hashContent(path:Path) -> str:
+    """sha256 of a file, or of the relative paths and contents of all the
+       files in a directory
+    """
+    hsh = hashlib.sha256()
+    files = [path] if path.is_file() else sorted(p for p in path.rglob("*") if p.is_file())
+    for f in files:
+        if f != path:
+            hsh.update(str(f.relative_to(path)).encode() + b"\0")
+        with open(f, "rb") as src:
+            for b in iter(lambda: src.read(1 << 20), b""):
+                hsh.update(b)
+    return hsh.hexdigest()
+
+
+def treeSize(path:Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def makeReadOnly(path:Path) -> None:
+    """Removes write permission from the files of a cached object, so that a
+       Command can't modify the cache through its hardlink
+    """
+    files = [path] if path.is_file() else [p for p in path.rglob("*") if p.is_file()]
+    for f in files:
+        f.chmod(f.stat().st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def linkFile(src:Path, dst:Path) -> None:
+    """Makes *dst* a hardlink of *src*; falls back to a reflink, then a copy,
+       when *src* and *dst* are on different filesystems
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as s, open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def linkTree(src:Path, dst:Path) -> None:
+    """Places *src* (a file or a directory) at *dst* by linking its files,
+       replacing anything already there
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if src.is_file():
+        tmp = dst.with_name(f".{dst.name}.{randomTmpName()}")
+        linkFile(src, tmp)
+        os.replace(tmp, dst)
+    else:
+        for s in src.rglob("*"):
+            d = dst.joinpath(s.relative_to(src))
+            if s.is_dir():
+                d.mkdir(parents=True, exist_ok=True)
+            else:
+                d.parent.mkdir(parents=True, exist_ok=True)
+                if d.exists():
+                    d.unlink()
+                linkFile(s, d)
+
+
+def removeTree(path:Path) -> None:
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+
+
+class AssetCache:
+    """Content-addressed cache of localized assets in directory *root*, holding
+       at most *maxBytes* bytes (0 means no limit) after each insertion
+    """
+    def __init__(self, root:pathlike, maxBytes:int=0) -> None:
+        self.root = Path(root)
+        self.maxBytes = maxBytes
+        for sub in ["objects", "index", "locks", "tmp"]:
+            self.root.joinpath(sub).mkdir(parents=True, exist_ok=True)
+
+    def _keyName(self, key:str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _lookup(self, keyName:str) -> Optional[Path]:
+        try:
+            objName = self.root.joinpath("index", keyName).read_text().strip()
+        except OSError:
+            return None
+        obj = self.root.joinpath("objects", objName)
+        return obj if obj.exists() else None
+
+    def localize(self,
+                 key:str,
+                 target:pathlike,
+                 fetch:Callable[[str], Outcome[str, pathlike]]) -> Outcome[str, pathlike]:
+        """Places the asset version identified by *key* at *target*, calling
+           *fetch* to produce it if it isn't cached yet. *fetch* is given a
+           fresh directory to work in and returns the path of the localized
+           asset (a file or a directory) within it.
+        """
+        keyName = self._keyName(key)
+        try:
+            return self._obtain(keyName, fetch) >> (lambda obj: self._place(obj, key, target, fetch))
+        except OSError as err:
+            return Failure(track(f"Asset cache error for {target}: {err}"))
+
+    def _obtain(self, keyName:str, fetch:Callable[[str], Outcome[str, pathlike]]) -> Outcome[str, Path]:
+        """The cached object for *keyName*, calling *fetch* to produce it first
+           if need be
+        """
+        obj = self._lookup(keyName)
+        if obj is not None:
+            return Success(obj)
+        with flocked(self.root.joinpath("locks", keyName)):
+            # Someone else may have fetched it while we waited
+            obj = self._lookup(keyName)
+            return Success(obj) if obj is not None else self._insert(keyName, fetch)
+
+    def _place(self,
+               obj:Path,
+               key:str,
+               target:pathlike,
+               fetch:Callable[[str], Outcome[str, pathlike]]) -> Outcome[str, pathlike]:
+        """Links *obj* into *target* before evicting whatever no longer fits, so
+           that the object being served is never evicted from under us. Starts
+           over if another process evicted *obj* after it was looked up.
+        """
+        if not self._use(obj, Path(target)):
+            return self.localize(key, target, fetch)
+        self.evict(keep=obj)
+        return Success(target)
+
+    def _use(self, obj:Path, target:Path) -> bool:
+        """Links *obj* into *target* and marks it as recently used, unless it has
+           been evicted; returns whether it was still there. The links keep the
+           object's files alive for *target* even if it is evicted afterwards.
+        """
+        with flocked(self.root.joinpath("lock")):
+            if not obj.exists():
+                return False
+            os.utime(obj)
+            linkTree(obj, target)
+            return True
+
+    def _insert(self, keyName:str, fetch:Callable[[str], Outcome[str, pathlike]]) -> Outcome[str, Path]:
+        workDir = self.root.joinpath("tmp", randomTmpName())
+        workDir.mkdir()
+        try:
+            return fetch(str(workDir)) >> (lambda product: Success(self._store(keyName, Path(product))))
+        finally:
+            removeTree(workDir)
+
+    def _store(self, keyName:str, product:Path) -> Path:
+        """Moves a freshly fetched *product* into the cache as the object for
+           *keyName*, and returns the object's path
+        """
+        obj = self.root.joinpath("objects", hashContent(product))
+        makeReadOnly(product)
+        with flocked(self.root.joinpath("lock")):
+            if not obj.exists():
+                os.rename(product, obj)
+            indexTmp = self.root.joinpath("index", f".{keyName}.{randomTmpName()}")
+            indexTmp.write_text(obj.name)
+            os.replace(indexTmp, self.root.joinpath("index", keyName))
+        return obj
+
+    def size(self) -> int:
+        return sum(treeSize(obj) for obj in self.root.joinpath("objects").iterdir())
+
+    def evict(self, keep:Optional[Path]=None) -> None:
+        """Removes least recently used objects until the cache fits in
+           *maxBytes*, but never *keep*, even if it alone is larger than that.
+           Index entries pointing at evicted objects are ignored by lookups, and
+           are removed here as well.
+        """
+        if not self.maxBytes:
+            return
+        with flocked(self.root.joinpath("lock")):
+            entries:List[Tuple[float, int, Path]] = sorted(
+                (obj.stat().st_mtime, treeSize(obj), obj)
+                for obj in self.root.joinpath("objects").iterdir())
+            total = sum(size for _, size, _ in entries)
+            evicted = set()
+            for _, size, obj in entries:
+                if total <= self.maxBytes:
+                    break
+                if obj == keep:
+                    continue
+                removeTree(obj)
+                evicted.add(obj.name)
+                total -= size
+            if evicted:
+                for index in self.root.joinpath("index").iterdir():
+                    try:
+                        if index.read_text().strip() in evicted:
+                            index.unlink()
+                    except OSError:
+                        pass
@@ -1,43 +1,57 @@
 # -*- mode: python;-*-
 
-from typing import Tuple, NamedTuple, List, Dict, Union, Type, Any, Optional, Sequence
+from typing import (Tuple, NamedTuple, List, Dict, Union, Type, Any, Optional, Sequence, Callable,
+                    IO)
 import secrets
 import zipfile
 import gzip
 import shutil
 import string
 import logging
+import os
 from pathlib import Path
-import distutils.dir_util
 
 
 from ..message.header import (
     Uri, Topic, QueueName, FilePath,
     Asset, S3Asset, UriAsset, AssetSettings, Decompression)
 
-from ..outcome import Outcome, Success, Failure, onFailure, filterMapSucceeded
-from ..utils.fp import concurrentMap
+from ..outcome import Outcome, Success, Failure, onFailure, onSuccess, filterMapSucceeded
+from ..iopool import ioPool, checkCancelled
 from ..utils.iteratorextras import consume
 from .s3path import S3Path
+from .assetcache import AssetCache
 from ..utils.track import track
 from ..utils.typeshed import pathlike
 
 
-def localizeAssets(assets:Sequence[Asset]) -> Outcome[str, Sequence[pathlike]]:
+def localizeAssets(assets:Sequence[Asset],
+                   scratchDir:str="",
+                   cache:Optional[AssetCache]=None) -> Outcome[str, Sequence[pathlike]]:
     """Localize (ie., download to local node and write to disk) a List of
        Asset's according to the rules for each Asset type.
        Cleans up and returns Failure if localization fails for *any* Asset.
        Returns a list of local targets inside a Success if everything succeeded.
+       Relative local targets are placed under *scratchDir*. Assets are
+       taken from *cache* when one is given.
+       Assets are localized concurrently on the shared I/O pool, and the rest
+       are cancelled as soon as one fails or the pool's timeout passes.
     """
-    # concurrentMap could easily support a timeout if we want to add a blanket T.O.
-    outcomes = concurrentMap(localizeAsset, assets)
+    outcomes = ioPool.mapOutcomes(lambda asset: localizeAsset(asset, scratchDir, cache), assets)
     if any(map(lambda oc: isinstance(oc, Failure), outcomes)):
         logFailures(outcomes, assets)
         # Clean up the successful downloads
-        consume(filterMapSucceeded(lambda p: Path(p).unlink(), outcomes))
+        consume(filterMapSucceeded(removeLocalized, outcomes))
         return Failure(track("Unable to localize one or more assets"))
     else:
-        return Success(list(map(lambda oc: oc.value, outcomes)))
+        return Success(list(filterMapSucceeded(lambda path: path, outcomes)))
+
+
+def removeLocalized(path:pathlike) -> None:
+    if Path(path).is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif Path(path).exists():
+        Path(path).unlink()
 
 
 def logFailures(outcomes:Sequence[Outcome[str, pathlike]], assets:Sequence[Asset]) -> None:
@@ -46,14 +60,57 @@ def logFailures(outcomes:Sequence[Outcome[str, pathlike]], assets:Sequence[Asset
             logging.fatal("Fatal error localizing {}: {}".format(nm, reason))
 
 
-def localizeAsset(asset:Asset) -> Outcome[str, pathlike]:
-    """Localize a single Asset
+def localizeAsset(asset:Asset,
+                  scratchDir:str="",
+                  cache:Optional[AssetCache]=None) -> Outcome[str, pathlike]:
+    """Localize a single Asset, going through *cache* if there is one and the
+       Asset's current version can be identified
     """
-    tempname = genUniqueAssetName(asset)
-
+    target = decideLocalPath(asset, scratchDir)
+    key = None if cache is None else assetCacheKey(asset)
+    if cache is not None and key is not None:
+        return cache.localize(key, target,
+                              lambda workDir: fetchAsset(asset, workDir,
+                                                         os.path.join(workDir, "asset")))
+    return fetchAsset(asset, scratchDir, target)
+
+
+def fetchAsset(asset:Asset, workDir:str, target:str) -> Outcome[str, pathlike]:
+    """Localizes an Asset at *target*, decompressing it if required. Where the
+       compression format and Asset type allow, the Asset is decompressed as it
+       downloads; otherwise it is downloaded to a uniquely named file in
+       *workDir* first.
+    """
+    reader = streamDecompressor(asset)
+    if reader is not None:
+        return ( openAssetStream(asset)
+                 >> (lambda stream: decompressStream(stream, reader, target)) )
+    tempname = os.path.join(workDir, genUniqueAssetName(asset))
     return ( localizeAssetTyped(asset, tempname) >>
-             (lambda name: decompressIfRequired(name, asset)) >>
-             (lambda name: renameToLocalTarget(name, asset)) )
+             (lambda name: decompressIfRequired(name, asset, target)) )
+
+
+def assetCacheKey(asset:Asset) -> Optional[str]:
+    """Identifies the current version of an Asset, as localized according to
+       its settings, for use as an AssetCache key. None if the version can't be
+       determined, in which case the Asset isn't cached.
+    """
+    decompress = asset.settings.decompression.decompress
+    for version in onSuccess(assetVersion(asset)):
+        return f"{version}?decompress={decompress}"
+    return None
+
+
+def assetVersion(asset:Asset) -> Outcome[str, str]:
+    """Identifies an Asset's location and its current version there
+    """
+    if isinstance(asset, S3Asset):
+        return s3AssetVersion(asset)
+    elif isinstance(asset, UriAsset):
+        return uriAssetVersion(asset)
+    else:
+        return Failure(track(f"Versions of {type(asset)} are not known"))
+
 
 # These localizeAssetTyped patterns *must* return Success(target) if all
 # went well. (That allows easier composition and chaining.) We start with
@@ -67,27 +124,53 @@ def localizeAssetTyped(asset:Asset, target:str) -> Outcome[str, pathlike]:
     else:
         return Failure(track(f"Unknown Asset type {type(asset)}"))
 
+
+def openAssetStream(asset:Asset) -> Outcome[str, IO[bytes]]:
+    """Opens the raw content of an Asset for reading as it downloads
+    """
+    if isinstance(asset, S3Asset):
+        return s3utils.openStream(asset.path)
+    elif isinstance(asset, UriAsset):
+        return httputils.openStream(asset.uri)
+    else:
+        return Failure(track(f"Unable to stream Asset type {type(asset)}"))
+
+
+def canStream(asset:Asset) -> bool:
+    return ( (isinstance(asset, S3Asset) and haveS3)
+             or (isinstance(asset, UriAsset) and haveHttp) )
+
+
 # Boto is large, so don't assume s3 utils are available:
 try:
     from . import s3utils
+    haveS3 = True
     def localizeS3Asset(asset:S3Asset, target:str) -> Outcome[str, pathlike]:
         """Localize an Asset stored in S3; assumes AWS credentials exist in the
         environment
         """
         return s3utils.downloadFile(asset.path, target)
+
+    def s3AssetVersion(asset:S3Asset) -> Outcome[str, str]:
+        return ( s3utils.remoteVersion(asset.path)
+                 >> (lambda version: Success(f"{asset.path}@{version}")) )
 except ImportError:
-    pass # Won't be able to handle S3Assets
+    haveS3 = False # Won't be able to handle S3Assets
 
 
 try:
-    import requests
+    from . import httputils
+    haveHttp = True
     def localizeUriAsset(asset:UriAsset, target:str) -> Outcome[str, pathlike]:
         """Localize a standard URI Asset
         """
-        # TODO: do some stuff with requests.py
-        return Success(target)
+        return httputils.downloadFile(asset.uri, target)
+
+    def uriAssetVersion(asset:UriAsset) -> Outcome[str, str]:
+        return ( httputils.remoteVersion(asset.uri)
+                 >> (lambda version: Success(f"{asset.uri}@{version}")) )
 except ModuleNotFoundError:
-    pass
+    haveHttp = False # Won't be able to handle UriAssets
 
 
 def genUniqueAssetName(asset:Asset) -> str:
@@ -102,85 +185,143 @@ def randomName() -> str:
     return secrets.token_hex(8)
 
 
-def decompressIfRequired(fname:pathlike, asset:Asset) -> Outcome[str, pathlike]:
-    """Invokes decompression if asset has been marked for decompression;
-       successful Outcome will contain the filename that should be used
-       for processing beyond this point
+def decompressIfRequired(fname:pathlike, asset:Asset, target:str) -> Outcome[str, pathlike]:
+    """Invokes decompression into *target* if asset has been marked for
+       decompression, and otherwise moves *fname* to *target*
     """
     if asset.settings.decompression.decompress:
-        return decompress(fname)
+        return decompress(fname, target)
     else:
-        return Success(fname)
+        return renameToLocalTarget(fname, target)
+
+
+def gzipReader(stream:IO[bytes]) -> IO[bytes]:
+    return gzip.GzipFile(fileobj=stream, mode="rb") # type: ignore
 
 
-def decompress(path:pathlike) -> Outcome[str, pathlike]:
+# Readers that decompress a stream as it is read, by file extension. gzip is
+# always available; zstd and lz4 only if their packages are installed.
+STREAM_DECOMPRESSORS:Dict[str, Callable[[IO[bytes]], IO[bytes]]] = {
+    ".gz": gzipReader,
+    ".tgz": gzipReader }
+
+try:
+    import zstandard
+    STREAM_DECOMPRESSORS[".zst"] = \
+        lambda stream: zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    STREAM_DECOMPRESSORS[".lz4"] = lambda stream: lz4.frame.LZ4FrameFile(stream, mode="rb")
+except ImportError:
+    pass
+
+
+def streamDecompressor(asset:Asset) -> Optional[Callable[[IO[bytes]], IO[bytes]]]:
+    """The reader with which to decompress an Asset as it downloads, or None if
+       it isn't to be decompressed that way
+    """
+    if not (asset.settings.decompression.decompress and canStream(asset)):
+        return None
+    return STREAM_DECOMPRESSORS.get("." + getAssetRawExt(asset).split(".")[-1])
+
+
+def decompressStream(stream:IO[bytes],
+                     reader:Callable[[IO[bytes]], IO[bytes]],
+                     target:pathlike) -> Outcome[str, pathlike]:
+    """Decompresses *stream* with *reader* into the file *target*. The file is
+       written under a temporary name and renamed once complete.
+    """
+    tmp = Path(target).with_name(f".{Path(target).name}.{randomName()}")
+    try:
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        with stream, reader(stream) as src, open(tmp, "wb") as dst:
+            for chunk in iter(lambda: src.read(1 << 20), b""):
+                checkCancelled()
+                dst.write(chunk)
+        os.replace(tmp, target)
+        return Success(target)
+    except Exception as err:
+        if tmp.exists():
+            tmp.unlink()
+        return Failure(track(f"Decompression error for {target}: {err}"))
+
+
+def decompress(path:pathlike, target:str) -> Outcome[str, pathlike]:
     """Chooses and invokes a decompressor based on file extension of path
     """
-    pth = Path(path)
-    suff = pth.suffix
+    suff = Path(path).suffix
     if suff == ".zip":
-        return decompressZip(path)
-    elif suff == ".gz":
-        return decompressGzip(path)
+        return decompressZip(path, target)
+    elif suff in STREAM_DECOMPRESSORS:
+        return decompressFile(path, STREAM_DECOMPRESSORS[suff], target)
     else:
         return Failure(track(f"Unable to determine decompressor from file extension {suff}"))
 
 
-def decompressZip(file:pathlike) -> Outcome[str, pathlike]:
-    """Decompress ZipFile `file` into a unique dir
+def decompressZip(file:pathlike, target:str) -> Outcome[str, pathlike]:
+    """Decompress ZipFile `file` straight into the directory `target`
     """
-    tmpdir = randomName()
+    created = not Path(target).exists()
     try:
         with zipfile.ZipFile(file) as z:
-            z.extractall(path=tmpdir)
-        Path(file).unlink() # Don't leave the uncompressed archive sitting around
-        return Success(tmpdir)
+            z.extractall(path=target)
+        return Success(target)
     except Exception as err:
-        if Path(tmpdir).exists(): # Clean up if things go wrong
-            distutils.dir_util.remove_tree(tmpdir)
-            Path(file).unlink()
+        if created and Path(target).exists(): # Clean up if things go wrong
+            shutil.rmtree(target, ignore_errors=True)
         return Failure(track(f"Decompression error: {err}"))
+    finally:
+        Path(file).unlink() # Don't leave the compressed archive sitting around
 
 
-def decompressGzip(file:pathlike) -> Outcome[str, pathlike]:
-    """Decompress a .gz or .tgz file.
+def decompressFile(file:pathlike,
+                   reader:Callable[[IO[bytes]], IO[bytes]],
+                   target:str) -> Outcome[str, pathlike]:
+    """Decompress a .gz, .tgz, (or .zst or .lz4) file into the file `target`.
        ONLY decompresses; does NOT explode .tar.gz or .tgz!
     """
     try:
-        target = Path(file).stem
-        if Path(file).suffix == ".tgz":
-            target += ".tar"
-        with gzip.open(file, "rb") as src:
-            with open(target, "wb+") as dst:
-                shutil.copyfileobj(src, dst)
-        return Success(target)
-    except Exception as err:
-        return Failure(track(f"decompressGzip failed with {err}"))
+        result = decompressStream(open(file, "rb"), reader, target)
+    except OSError as err:
+        result = Failure(track(f"Unable to read {file}: {err}"))
+    Path(file).unlink()
+    return result
 
 
-def renameToLocalTarget(fname:pathlike, asset:Asset) -> Outcome[str, pathlike]:
-    """Rename an Asset to the requested localTarget
+def renameToLocalTarget(fname:pathlike, target:str) -> Outcome[str, pathlike]:
+    """Rename an Asset to the requested localTarget. A directory renamed onto
+       an existing directory is merged into it.
     """
-    target = decideLocalTarget(asset)
     targetPath = Path(target)
     try:
         targetPath.parent.mkdir(parents=True, exist_ok=True)
-        if targetPath.name is not ".":
-            Path(fname).rename(targetPath)
+        if Path(fname).is_dir() and targetPath.is_dir():
+            moveTree(Path(fname), targetPath)
+        elif targetPath.is_dir():
+            return Failure(track(f"Unable to rename a file to {targetPath}"))
         else:
-            # FIXME: I don't like this. Python does not have a good library function
-            # to recursively move files. Should write my own to avoid unnecessary disk
-            # use in this copy all then delete all process.
-            if Path(fname).is_dir():
-                distutils.dir_util.copy_tree(str(fname), target)
-                distutils.dir_util.remove_tree(str(fname))
-            else:
-                return Failure(track(f"Unable to rename a file to {targetPath}"))
+            os.replace(fname, targetPath)
         return Success(target)
     except Exception as err:
         return Failure(track(f"Error renaming to local target {target}: {err}"))
 
 
+def moveTree(src:Path, dst:Path) -> None:
+    """Moves the contents of directory *src* into directory *dst* by renaming,
+       merging subdirectories that exist in both
+    """
+    for entry in src.iterdir():
+        into = dst.joinpath(entry.name)
+        if entry.is_dir() and into.is_dir():
+            moveTree(entry, into)
+        else:
+            os.replace(entry, into)
+    src.rmdir()
+
+
 def getAssetRawExt(asset:Asset) -> str:
     """Returns complete file extension on the *raw* identifier contained in
        Asset; eg., https://my.domain.com/a_file.json.gz  ->  json.gz
@@ -190,6 +331,12 @@ def getAssetRawExt(asset:Asset) -> str:
     return ext
 
 
+def decideLocalPath(asset:Asset, scratchDir:str="") -> str:
+    """Path at which the asset is localized when working in *scratchDir*
+    """
+    return os.path.join(scratchDir, decideLocalTarget(asset))
+
+
 def decideLocalTarget(asset:Asset) -> str:
     if asset.settings.localTarget:
         return asset.settings.localTarget
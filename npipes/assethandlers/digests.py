@@ -0,0 +1,105 @@
+# -*- mode: python;-*-
+
+# Digests of local files, as used to tell whether a local file matches an S3
+# object. Hashing a large file means reading all of it, so digests are kept in
+# an index keyed by the file's path, size, mtime and inode: as long as none of
+# those change, the file is taken to be unchanged and isn't hashed again.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from ..utils.typeshed import pathlike
+
+# Identifies a particular state of a file: (path, size, mtime_ns, inode)
+FileState = Tuple[str, int, int, int]
+
+
+def fileState(pth:pathlike) -> FileState:
+    st = os.stat(pth)
+    return (os.path.abspath(pth), st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def fileMd5(file:pathlike) -> str:
+    hsh = hashlib.md5()
+    with open(file, "rb") as f:
+        for b in iter(lambda: f.read(1 << 20), b""):
+            hsh.update(b)
+    return hsh.hexdigest()
+
+
+def multipartEtag(file:pathlike, partSize:int) -> str:
+    """The ETag S3 gives an object uploaded in parts of *partSize* bytes: the
+       MD5 of the concatenated MD5s of the parts, followed by the part count
+    """
+    partDigests = []
+    with open(file, "rb") as f:
+        for part in iter(lambda: f.read(partSize), b""):
+            partDigests.append(hashlib.md5(part).digest())
+    return "{}-{}".format(hashlib.md5(b"".join(partDigests)).hexdigest(), len(partDigests))
+
+
+def isMultipartEtag(etag:str) -> bool:
+    return "-" in etag
+
+
+def etagParts(etag:str) -> int:
+    return int(etag.split("-")[1])
+
+
+class DigestIndex:
+    """Thread-safe, size-bounded map from FileStates to digests of the file in
+       that state. Each file may have several kinds of digest (eg. its MD5, or
+       its multipart ETag for a given part size).
+    """
+    def __init__(self, maxFiles:int=4096) -> None:
+        self.maxFiles = maxFiles
+        self._lock = threading.Lock()
+        self._digests:"OrderedDict[FileState, Dict[str, str]]" = OrderedDict()
+
+    def lookup(self, pth:pathlike, kind:str) -> Optional[str]:
+        state = fileState(pth)
+        with self._lock:
+            digests = self._digests.get(state)
+            if digests is None:
+                return None
+            self._digests.move_to_end(state)
+            return digests.get(kind)
+
+    def remember(self, pth:pathlike, kind:str, digest:str) -> None:
+        state = fileState(pth)
+        with self._lock:
+            self._digests.setdefault(state, {})[kind] = digest
+            self._digests.move_to_end(state)
+            while len(self._digests) > self.maxFiles:
+                self._digests.popitem(last=False)
+
+    def digest(self, pth:pathlike, kind:str, compute:Callable[[pathlike], str]) -> str:
+        """The *kind* digest of the file at *pth*, computed with *compute* only
+           if the file has changed since it was last computed
+        """
+        known = self.lookup(pth, kind)
+        if known is not None:
+            return known
+        state = fileState(pth)
+        value = compute(pth)
+        # Only keep the digest if the file didn't change while we read it
+        if fileState(pth) == state:
+            self.remember(pth, kind, value)
+        return value
+
+    def md5(self, pth:pathlike) -> str:
+        return self.digest(pth, "md5", fileMd5)
+
+    def etag(self, pth:pathlike, partSize:int=0) -> str:
+        """The ETag S3 would give the file if uploaded whole (*partSize* 0) or
+           in parts of *partSize* bytes
+        """
+        if not partSize:
+            return self.md5(pth)
+        return self.digest(pth, f"etag:{partSize}", lambda p: multipartEtag(p, partSize))
+
+
+digests = DigestIndex()
@@ -0,0 +1,292 @@
+# -*- mode: python;-*-
+
+# HTTP(S) downloads for UriAssets, over one shared keep-alive connection pool.
+# Requests to each host are limited to a few at a time, so that many messages
+# (or many ranges of one large file) don't overwhelm a single server.
+#
+# Files are requested with Accept-Encoding: identity, so what is saved is
+# exactly the file the server holds, and byte ranges refer to that file.
+
+import pathlib
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, IO, Iterator, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+from ..outcome import Outcome, Success, Failure
+from ..utils.track import track
+from ..utils.typeshed import pathlike
+from ..iopool import checkCancelled
+from .digests import digests
+from .ranges import MiB, ByteRange, downloadInRanges, writeRange
+
+
+@dataclass(frozen=True)
+class HttpSettings:
+    """Files larger than twice *chunkSize* bytes are fetched in *chunkSize*
+       ranges, up to *concurrency* at a time, when the server supports ranges.
+       No more than *perHost* requests are made to any one host at once. An
+       interrupted download is resumed up to *retries* times.
+    """
+    chunkSize:int   = 8 * MiB
+    concurrency:int = 4
+    perHost:int     = 8
+    timeout:int     = 60
+    retries:int     = 3
+
+
+httpSettings = HttpSettings()
+_session:Optional[requests.Session] = None
+_hostSlots:Dict[str, threading.BoundedSemaphore] = {}
+_lock = threading.Lock()
+
+IDENTITY = {"Accept-Encoding": "identity"}
+STREAM_CHUNK = 64 * 1024
+RETRYABLE = (requests.ConnectionError, requests.Timeout,
+             requests.exceptions.ChunkedEncodingError)
+
+
+def configureHttp(concurrency:int, perHost:int) -> None:
+    """Sets the HttpSettings used from now on by all HTTP downloads
+    """
+    global httpSettings, _session, _hostSlots
+    with _lock:
+        httpSettings = HttpSettings(concurrency=concurrency, perHost=perHost)
+        _session = None
+        _hostSlots = {}
+
+
+def session() -> requests.Session:
+    """The Session shared by all downloads, so that connections to a host are
+       kept alive and reused
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16,
+                                                    pool_maxsize=httpSettings.perHost)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def hostSlot(uri:str) -> threading.BoundedSemaphore:
+    host = urlsplit(uri).netloc
+    with _lock:
+        if host not in _hostSlots:
+            _hostSlots[host] = threading.BoundedSemaphore(httpSettings.perHost)
+        return _hostSlots[host]
+
+
+@contextmanager
+def request(uri:str, method:str="GET", headers:Dict[str, str]={}) -> Iterator[requests.Response]:
+    """Makes a streamed request while holding one of the host's slots
+    """
+    with hostSlot(uri):
+        with session().request(method, uri, headers={**IDENTITY, **headers}, stream=True,
+                               allow_redirects=True, timeout=httpSettings.timeout) as response:
+            yield response
+
+
+class RemoteResource(NamedTuple):
+    """What a HEAD request tells us about a resource; *size* is -1 if unknown
+    """
+    uri:str
+    size:int = -1
+    etag:str = ""
+    lastModified:str = ""
+    acceptsRanges:bool = False
+
+    def validator(self) -> str:
+        """Strong ETag if there is one, or else the Last-Modified date; used
+           in If-Range to make sure every part comes from the same version
+        """
+        return self.etag if self.etag and not self.etag.startswith("W/") else self.lastModified
+
+
+def headResource(uri:str) -> RemoteResource:
+    with request(uri, "HEAD") as response:
+        if response.status_code >= 400:
+            # Some servers don't do HEAD; a GET will find out what's there
+            return RemoteResource(uri)
+        return describe(uri, response)
+
+
+def remoteVersion(uri:str) -> Outcome[str, str]:
+    """Identifies the current version of a resource by its ETag or
+       Last-Modified date
+    """
+    try:
+        remote = headResource(uri)
+        version = remote.etag or remote.lastModified
+        if version:
+            return Success(version)
+        return Failure(track(f"{uri} has neither an ETag nor a Last-Modified date"))
+    except Exception as err:
+        return Failure(track(f"Unable to get version of {uri}. Reason: {err}"))
+
+
+def conditionalHeaders(pth:pathlib.Path) -> Dict[str, str]:
+    """Headers that ask the server to send the resource only if it differs
+       from the copy in *pth*, as of when that was downloaded
+    """
+    if not pth.exists():
+        return {}
+    etag = digests.lookup(pth, "httpEtag")
+    lastModified = digests.lookup(pth, "httpLastModified")
+    if etag:
+        return {"If-None-Match": etag}
+    elif lastModified:
+        return {"If-Modified-Since": lastModified}
+    return {}
+
+
+def downloadFile(uri:str, localPath:pathlike) -> Outcome[str, pathlike]:
+    """Downloads *uri* to *localPath*. Large files are fetched in concurrent
+       ranges when the server allows it; otherwise the file is streamed,
+       resuming where it left off if the connection drops.
+
+       If a copy was downloaded to the same *localPath* before, a single
+       conditional GET either confirms it is still current or streams the new
+       version in its place. That only helps callers that reuse *localPath*;
+       the processor and the AssetCache fetch into fresh paths, which always
+       cost a HEAD and a download.
+    """
+    pth = pathlib.Path(localPath)
+    try:
+        pth.parent.mkdir(parents=True, exist_ok=True)
+        conditional = conditionalHeaders(pth)
+        if conditional:
+            changed = downloadStream(RemoteResource(uri), pth, conditional)
+            if changed is None:
+                return Success(localPath) # Still current
+            remote = changed
+        else:
+            remote = headResource(uri)
+            if ( remote.acceptsRanges and remote.validator()
+                 and remote.size >= 2 * httpSettings.chunkSize ):
+                downloadInRanges(pth, remote.size, httpSettings.chunkSize,
+                                 httpSettings.concurrency,
+                                 lambda fd, rng: downloadRange(remote, fd, rng))
+            else:
+                remote = downloadStream(remote, pth) or remote
+        # Remember validators so a later download can be made conditional
+        if remote.etag:
+            digests.remember(pth, "httpEtag", remote.etag)
+        if remote.lastModified:
+            digests.remember(pth, "httpLastModified", remote.lastModified)
+        return Success(localPath)
+    except Exception as err:
+        return Failure(track(f"Unable to download {uri}. Reason: {err}"))
+
+
+def downloadRange(remote:RemoteResource, fd:int, rng:ByteRange) -> None:
+    first, last = rng
+    headers = {"Range": f"bytes={first}-{last}", "If-Range": remote.validator()}
+    with request(remote.uri, headers=headers) as response:
+        if response.status_code != 206:
+            raise IOError(f"Expected part of {remote.uri}, but got status {response.status_code}"
+                          " (has it changed?)")
+        writeRange(fd, rng, response.iter_content(MiB))
+
+
+def downloadStream(remote:RemoteResource,
+                   pth:pathlib.Path,
+                   conditional:Dict[str, str]={}) -> Optional[RemoteResource]:
+    """Streams *remote* to *pth* with a single GET. If the connection fails,
+       the download resumes from where it stopped with a Range request, as long
+       as the server supports that and the resource hasn't changed. Returns
+       the RemoteResource as described by the GET, or None if the GET was
+       made with *conditional* headers and the server answered that the copy
+       already in *pth* is current.
+    """
+    tmp = pth.with_name(f".{pth.name}.download")
+    try:
+        with open(tmp, "wb") as f:
+            for attempt in range(httpSettings.retries + 1):
+                headers = conditional
+                if f.tell() and remote.validator():
+                    headers = {"Range": f"bytes={f.tell()}-", "If-Range": remote.validator()}
+                try:
+                    with request(remote.uri, headers=headers) as response:
+                        if response.status_code == 304:
+                            return None
+                        response.raise_for_status()
+                        if response.status_code != 206: # A complete response
+                            f.seek(0)
+                            f.truncate()
+                            remote = describe(remote.uri, response)
+                        # Small reads, since a read cut short by a dropped
+                        # connection is lost and has to be fetched again
+                        for chunk in response.iter_content(STREAM_CHUNK):
+                            checkCancelled()
+                            f.write(chunk)
+                    break
+                except RETRYABLE:
+                    if attempt == httpSettings.retries:
+                        raise
+        if remote.size >= 0 and tmp.stat().st_size != remote.size:
+            raise IOError(f"Expected {remote.size} bytes, but got {tmp.stat().st_size}")
+        tmp.replace(pth)
+        return remote
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def describe(uri:str, response:requests.Response) -> RemoteResource:
+    """The RemoteResource described by the headers of a complete response
+    """
+    headers = response.headers
+    return RemoteResource(uri,
+                          int(headers.get("Content-Length", -1)),
+                          headers.get("ETag", ""),
+                          headers.get("Last-Modified", ""),
+                          headers.get("Accept-Ranges", "") == "bytes")
+
+
+class SlotStream:
+    """The body of a streamed response, holding a slot for its host until it
+       is closed
+    """
+    def __init__(self, response:requests.Response, slot:threading.BoundedSemaphore) -> None:
+        self._response = response
+        self._slot:Optional[threading.BoundedSemaphore] = slot
+
+    def read(self, size:int=-1) -> bytes:
+        return self._response.raw.read(None if size < 0 else size)
+
+    def close(self) -> None:
+        self._response.close()
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
+    def __enter__(self) -> "SlotStream":
+        return self
+
+    def __exit__(self, *exc:Any) -> None:
+        self.close()
+
+
+def openStream(uri:str) -> Outcome[str, IO[bytes]]:
+    """Opens *uri* for reading as it downloads
+    """
+    slot = hostSlot(uri)
+    slot.acquire()
+    try:
+        response = session().get(uri, headers=IDENTITY, stream=True, allow_redirects=True,
+                                 timeout=httpSettings.timeout)
+    except Exception as err:
+        slot.release()
+        return Failure(track(f"Unable to download {uri}. Reason: {err}"))
+    stream = SlotStream(response, slot)
+    if not response.ok:
+        stream.close()
+        return Failure(track(f"Unable to download {uri}. Reason: status {response.status_code}"))
+    return Success(stream) # type: ignore
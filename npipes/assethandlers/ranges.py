@@ -0,0 +1,78 @@
+# -*- mode: python;-*-
+
+# Downloads split into byte ranges that are fetched concurrently and written
+# straight into their place in a preallocated file. Shared by the S3 and HTTP
+# asset handlers, which supply the function that fetches one range.
+
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Tuple
+
+from ..iopool import checkCancelled, currentToken, runWithToken
+
+MiB = 1024 * 1024
+
+# An inclusive (first, last) byte range
+ByteRange = Tuple[int, int]
+
+
+def byteRanges(size:int, chunkSize:int) -> List[ByteRange]:
+    """Inclusive (first, last) byte ranges covering *size* bytes in chunks
+    """
+    return [(first, min(first + chunkSize, size) - 1) for first in range(0, size, chunkSize)]
+
+
+def preallocate(fd:int, size:int) -> None:
+    """Reserves *size* bytes for the file open at *fd*, so that concurrent
+       writes into it don't fragment it (or fail partway for lack of space)
+    """
+    if size == 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError): # Not available on every platform or filesystem
+        os.ftruncate(fd, size)
+
+
+def writeRange(fd:int, rng:ByteRange, chunks:Iterable[bytes]) -> None:
+    """Writes *chunks*, the content of byte range *rng*, into place in the file
+       open at *fd*
+    """
+    first, last = rng
+    offset = first
+    for chunk in chunks:
+        checkCancelled()
+        os.pwrite(fd, chunk, offset)
+        offset += len(chunk)
+    if offset != last + 1:
+        raise IOError(f"Short read of bytes {first}-{last}: got {offset - first} bytes")
+
+
+def downloadInRanges(pth:pathlib.Path,
+                     size:int,
+                     chunkSize:int,
+                     concurrency:int,
+                     fetchRange:Callable[[int, ByteRange], None]) -> None:
+    """Downloads *size* bytes to *pth* by calling *fetchRange(fd, rng)* for
+       each *chunkSize* range, up to *concurrency* at once. The file is written
+       under a temporary name and renamed into place once complete. Ranges run
+       under the CancelToken of the calling operation.
+    """
+    token = currentToken()
+    tmp = pth.with_name(f".{pth.name}.download")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        preallocate(fd, size)
+        ranges = byteRanges(size, chunkSize)
+        if len(ranges) > 1:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(ranges))) as pool:
+                list(pool.map(lambda rng: runWithToken(token, fetchRange, fd, rng), ranges))
+        elif ranges:
+            fetchRange(fd, ranges[0])
+    except BaseException:
+        os.close(fd)
+        tmp.unlink()
+        raise
+    os.close(fd)
+    os.replace(tmp, pth)
@@ -1,15 +1,82 @@
 # -*- mode: python;-*-
-from typing import Union, AnyStr, Any
+from typing import Union, AnyStr, Any, IO, NamedTuple, Optional
+import io
 import pathlib
 import hashlib
+from base64 import b64encode
+from dataclasses import dataclass
 import boto3
+import boto3.s3.transfer
+import botocore.exceptions
 
+from .. import awsclients
 from ..outcome import Outcome, Success, Failure
 from ..utils.typeshed import pathlike
 from .s3path import S3Path
+from .digests import digests, fileMd5, isMultipartEtag, etagParts
+from .ranges import MiB, ByteRange, byteRanges, downloadInRanges, writeRange
 from ..utils.track import track
 
 
+@dataclass(frozen=True)
+class TransferSettings:
+    """How S3 transfers are split up: objects larger than *chunkSize* bytes
+       are moved in *chunkSize* parts, up to *concurrency* at a time
+    """
+    chunkSize:int   = 8 * MiB
+    concurrency:int = 10
+
+    def transferConfig(self) -> boto3.s3.transfer.TransferConfig:
+        return boto3.s3.transfer.TransferConfig(multipart_threshold=self.chunkSize,
+                                                multipart_chunksize=self.chunkSize,
+                                                max_concurrency=self.concurrency,
+                                                use_threads=True)
+
+
+transferSettings = TransferSettings()
+
+
+def configureTransfers(chunkSize:int, concurrency:int) -> None:
+    """Sets the TransferSettings used from now on by all S3 transfers
+    """
+    global transferSettings
+    transferSettings = TransferSettings(chunkSize, concurrency)
+    awsclients.forget("s3") # Size a new connection pool for the new concurrency
+
+
+def s3Client() -> Any:
+    """The S3 client shared by all transfers. Its connection pool is sized so
+       that several transfers can each run at full concurrency.
+    """
+    return awsclients.client("s3", maxPoolConnections=max(10, 4 * transferSettings.concurrency))
+
+
+class RemoteObject(NamedTuple):
+    """What a HEAD request tells us about an S3 object
+    """
+    bucket:str
+    key:str
+    etag:str
+    size:int
+    md5:str = ""
+    versionId:str = ""
+
+
+def headObject(s3path:S3Path) -> Optional[RemoteObject]:
+    """Looks up an S3 object; None if it doesn't exist
+    """
+    try:
+        head = s3Client().head_object(Bucket=s3path.bucket, Key=s3path.key)
+    except botocore.exceptions.ClientError as err:
+        if err.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return RemoteObject(s3path.bucket, s3path.key,
+                        head["ETag"].replace("\"", ""),
+                        head["ContentLength"],
+                        head.get("Metadata", {}).get("md5", "").replace("\"", ""),
+                        head.get("VersionId") or "")
+
 
 # -> Outcome[str, pathlike]
 def downloadFile(remotePath:Union[str, S3Path], localPath:pathlike) -> Outcome[str, pathlike]:
@@ -21,38 +88,101 @@ def downloadFile(remotePath:Union[str, S3Path], localPath:pathlike) -> Outcome[s
     s3path = S3Path(remotePath)
 
     try:
-        obj = boto3.resource("s3").Object(s3path.bucket, s3path.key)
+        remote = headObject(s3path)
+        if remote is None:
+            return Failure(track(f"Unable to download {remotePath}. Reason: no such object"))
         pth = pathlib.Path(localPath)
         # If we already have the current version, don't download it again
-        if isCurrent(obj, pth):
+        if isCurrent(remote, pth):
             return Success(localPath)
         else:
             preparePath(pth)
-            obj.download_file(str(pth))
+            downloadRanges(remote, pth)
+            # Remember the file's ETag so it won't need hashing to check later
+            digests.remember(pth, "remoteEtag", remote.etag)
             return checkLocal(localPath) # use localPath rather than pth so contained returned
                                          # type is same as input type
     except Exception as err:
-        return Failure(track("Unable to download {remotePath}. Reason: {err}"))
+        return Failure(track(f"Unable to download {remotePath}. Reason: {err}"))
 
 
-def isCurrent(obj:Any, pth:pathlib.Path) -> bool:
-    # obj really should be a boto S3 resource object, but there are currently no
-    # type annotations for that.
-    if not pth.exists():
+def openStream(remotePath:Union[str, S3Path]) -> Outcome[str, IO[bytes]]:
+    """Opens an S3 object for reading as it downloads
+    """
+    s3path = S3Path(remotePath)
+    try:
+        return Success(s3Client().get_object(Bucket=s3path.bucket, Key=s3path.key)["Body"])
+    except Exception as err:
+        return Failure(track(f"Unable to download {remotePath}. Reason: {err}"))
+
+
+def downloadRanges(remote:RemoteObject, pth:pathlib.Path) -> None:
+    """Downloads *remote* to *pth* with concurrent ranged GETs, each writing
+       its part straight into its place in a preallocated file. Every GET is
+       pinned to the version that was HEADed, so a concurrent overwrite of the
+       object fails the download rather than mixing two versions.
+    """
+    settings = transferSettings
+    downloadInRanges(pth, remote.size, settings.chunkSize, settings.concurrency,
+                     lambda fd, rng: downloadRange(remote, fd, rng))
+
+
+def downloadRange(remote:RemoteObject, fd:int, rng:ByteRange) -> None:
+    first, last = rng
+    pinned = {"VersionId": remote.versionId} if remote.versionId else {"IfMatch": f"\"{remote.etag}\""}
+    response = s3Client().get_object(Bucket=remote.bucket, Key=remote.key,
+                                     Range=f"bytes={first}-{last}", **pinned)
+    body = response["Body"]
+    writeRange(fd, rng, iter(lambda: body.read(MiB), b""))
+
+
+def remoteVersion(remotePath:Union[str, S3Path]) -> Outcome[str, str]:
+    """Identifies the current version of an S3 object with a HEAD request:
+       its VersionId in a versioned bucket, otherwise its ETag
+    """
+    try:
+        remote = headObject(S3Path(remotePath))
+        if remote is None:
+            return Failure(track(f"Unable to get version of {remotePath}. Reason: no such object"))
+        return Success(remote.versionId or remote.etag)
+    except Exception as err:
+        return Failure(track(f"Unable to get version of {remotePath}. Reason: {err}"))
+
+
+def isCurrent(remote:Optional[RemoteObject], pth:pathlib.Path) -> bool:
+    """True if the local file *pth* has the same content as S3 object *remote*.
+       Digests of local files are kept in an index (see digests.py), so an
+       unchanged file is only hashed once.
+    """
+    if remote is None or not pth.exists():
         return False
-    md5 = fileMd5(str(pth))
-    if md5 == obj.e_tag.replace("\"", "") or md5 == obj.metadata.get("md5","").replace("\"", ""):
+    if pth.stat().st_size != remote.size:
+        return False
+    if digests.lookup(pth, "remoteEtag") == remote.etag:
         return True
+    if isMultipartEtag(remote.etag):
+        current = digests.etag(pth, remotePartSize(remote)) == remote.etag
     else:
-        return False
+        current = digests.md5(pth) == remote.etag
+    if not current and remote.md5:
+        current = digests.md5(pth) == remote.md5
+    return current
 
 
-def fileMd5(file:str) -> str:
-    hsh = hashlib.md5()
-    with open(file, "rb") as f:
-        for b in iter(lambda: f.read(65536), b""):
-            hsh.update(b)
-    return hsh.hexdigest()
+def remotePartSize(remote:RemoteObject) -> int:
+    """Part size of an S3 object that was uploaded in parts. S3 reports the
+       size of the first part when asked for it; failing that, assume boto3's
+       default of 8 MiB parts if that gives the right number of parts, or else
+       the smallest whole number of MiB that does.
+    """
+    try:
+        head = s3Client().head_object(Bucket=remote.bucket, Key=remote.key, PartNumber=1)
+        return head["ContentLength"]
+    except Exception:
+        parts = etagParts(remote.etag)
+        if -(-remote.size // (8 * MiB)) == parts:
+            return 8 * MiB
+        return -(-remote.size // (parts * MiB)) * MiB
 
 
 def preparePath(pth:pathlib.Path) -> None:
@@ -64,7 +194,7 @@ def checkLocal(pth:pathlike) -> Outcome[str, pathlike]:
     if p.exists() and p.stat().st_size > 0:
         return Success(pth)
     else:
-        return Failure(track("Error downloading {str(pth)}; local file does not exist or is empty"))
+        return Failure(track(f"Error downloading {str(pth)}; local file does not exist or is empty"))
 
 
 # TODO: For both of these upload functions, should probably be doing something sane
@@ -75,37 +205,40 @@ def uploadFile(localPath:pathlike, remotePath:Union[str, S3Path]) -> Outcome[str
        Though the types involved are different, the signature for
        downloadFile, uploadFile, and uploadData follows the same pattern:
        source -> destination -> destination
+       Files larger than the chunk size are uploaded in concurrent parts.
     """
     s3path = S3Path(remotePath)
     try:
-        obj = boto3.resource("s3").Object(s3path.bucket, s3path.key)
-        if isCurrent(obj, pathlib.Path(localPath)):
+        if isCurrent(headObject(s3path), pathlib.Path(localPath)):
             return Success(remotePath)
         else:
-            obj.upload_file(str(localPath))
+            s3Client().upload_file(str(localPath), s3path.bucket, s3path.key,
+                                   Config=transferSettings.transferConfig())
             return Success(remotePath)
     except Exception as err:
-        return Failure(track("Unable to upload {localPath} to {remotePath}. Reason: {err}"))
+        return Failure(track(f"Unable to upload {localPath} to {remotePath}. Reason: {err}"))
 
 
 # -> Outcome[str, Union[str, S3Path]]
-def uploadData(data:AnyStr, remotePath:Union[str, S3Path]) -> Outcome[str, Union[str, S3Path]]:
+def uploadData(data:Union[AnyStr, IO[bytes]],
+               remotePath:Union[str, S3Path]) -> Outcome[str, Union[str, S3Path]]:
     """Assumes AWS credentials exist in the environment
        Though the types involved are different, the signature for
        downloadFile, uploadFile, and uploadData follows the same pattern:
        source -> destination -> destination
+       *data* may also be a binary file object, which is streamed up in
+       concurrent parts a chunk at a time rather than read into memory.
     """
     s3path = S3Path(remotePath)
     try:
-        obj = boto3.resource("s3").Object(s3path.bucket, s3path.key)
-        if isinstance(data, str):
-            bData = data.encode()
+        payload = data.encode() if isinstance(data, str) else data
+        if isinstance(payload, bytes) and len(payload) <= transferSettings.chunkSize:
+            md5 = b64encode(hashlib.md5(payload).digest()).decode()
+            s3Client().put_object(Bucket=s3path.bucket, Key=s3path.key, Body=payload, ContentMD5=md5)
         else:
-            bData = data
-        hsh = hashlib.md5()
-        hsh.update(bData)
-        md5 = hsh.hexdigest()
-        obj.put(Body=bData, ContentMD5=md5)
+            fileobj = io.BytesIO(payload) if isinstance(payload, bytes) else payload
+            s3Client().upload_fileobj(fileobj, s3path.bucket, s3path.key,
+                                      Config=transferSettings.transferConfig())
         return Success(remotePath)
     except Exception as err:
-        return Failure(track("Unable to upload data to {s3path}. Reason: {err}"))
+        return Failure(track(f"Unable to upload data to {s3path}. Reason: {err}"))
@@ -0,0 +1,374 @@
+# -*- mode: python;-*-
+
+# An asyncio-based alternative to processor.runMessageProducer. Commands run
+# as asyncio subprocesses, so a single event loop can keep many of them going
+# while it waits on the network for receives, sends, and asset fetches. Those
+# network operations go through blocking libraries (boto3, requests), so they
+# are dispatched to the event loop's executor.
+#
+# Everything that doesn't block is shared with processor.py; only the control
+# flow lives here.
+
+import asyncio
+import inspect
+import logging
+import subprocess
+import threading
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+from .assethandlers.assetcache import AssetCache
+from .configuration import Configuration
+from .message.header import Command
+from .metrics import metrics
+from .outcome import Outcome, Success, Failure, onFailure, onSuccess, failed
+from .processor import (WorkItem, prepareBatch, runBatch, stageWorkItem, runExpandedCommand,
+                        scrapeOutput, makeMessage, triggerNextStep, batchKey,
+                        newScratchDirectory, removeScratchDirectory, newOutputSpool,
+                        asBytes, triggerBefore, assetCacheFor, STOP_POLL_SECONDS)
+from .outputspool import OutputSpool, TailBuffer, CommandOutput, BodyData, outputSize
+from .producers.producer import Producer, Delivery
+from .supervision import runningProcesses, killProcessGroup, stopOnSignals
+from .utils.autodeleter import AutoDeleter
+from .utils.track import track
+
+
+async def drainStreamAsync(stream:asyncio.StreamReader,
+                           sink:Union[OutputSpool, TailBuffer]) -> None:
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            return
+        sink.write(chunk)
+
+
+async def feedStreamAsync(stream:asyncio.StreamWriter, data:bytes) -> None:
+    try:
+        stream.write(data)
+        await stream.drain()
+        stream.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+
+
+async def runProcessAsync(command:Command,
+                          input:Optional[bytes],
+                          timeout:Optional[int],
+                          spool:Optional[OutputSpool]=None) -> Outcome[str, CommandOutput]:
+    """Async version of *processor.runProcess*
+    """
+    spool = OutputSpool() if spool is None else spool
+    stderr = TailBuffer()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+                   *command.arglist,
+                   stdin=(subprocess.PIPE if input is not None else None),
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                   start_new_session=True)
+    except Exception as err:
+        return Failure(track(f"Unknown error running command: {err}"))
+
+    assert proc.stdout is not None and proc.stderr is not None
+    pumps = [drainStreamAsync(proc.stdout, spool), drainStreamAsync(proc.stderr, stderr)]
+    if input is not None:
+        assert proc.stdin is not None
+        pumps.append(feedStreamAsync(proc.stdin, input))
+    with runningProcesses.running(proc.pid):
+        try:
+            await asyncio.wait_for(asyncio.gather(*pumps, proc.wait()), timeout)
+        except asyncio.TimeoutError:
+            killProcessGroup(proc.pid)
+            await proc.wait()
+            spool.close()
+            return Failure(track("Command timed out"))
+
+    if proc.returncode != 0:
+        return Failure(track(f"Exit code: {proc.returncode}\n"
+                             f"stdout: {spool.preview()}\n"
+                             f"stderr: {stderr.text()}"))
+    else:
+        return Success(spool.result(command.binaryOutput))
+
+
+async def runCommandAsync(command:Command,
+                          body:BodyData,
+                          spool:Optional[OutputSpool]=None) -> Outcome[str, CommandOutput]:
+    """Async version of *processor.runCommand*
+    """
+    timeout = None if command.timeout == 0 else command.timeout
+    input = asBytes(body) if command.inputChannelStdin else None
+    threshold = 0 if spool is None else spool.threshold
+    with metrics.timed("command") as sample:
+        output = await runProcessAsync(command, input, timeout, spool)
+        sample.bytes = sum(map(outputSize, onSuccess(output)))
+    return output >> (lambda out: metrics.call("scrape", scrapeOutput, command, out, threshold))
+
+
+async def runWorkItemAsync(config:Configuration, work:WorkItem) -> Outcome[str, None]:
+    """Async version of *processor.runWorkItem*
+    """
+    loop = asyncio.get_event_loop()
+    with AutoDeleter() as deleter:
+        cmd, expcmd, header, body = stageWorkItem(config, work, deleter)
+        if work.deadline.expired():
+            return work.deadline.check()
+        elif cmd.persistence.persist:
+            # Persistent workers are driven with blocking pipe I/O
+            output = await loop.run_in_executor(None, runExpandedCommand,
+                                                cmd, expcmd, header, body)
+        else:
+            output = await runCommandAsync(expcmd, body, newOutputSpool(config, work, deleter))
+
+        if isinstance(output, Failure):
+            return output
+        else:
+            # Still inside the deleter's context, since the output may be
+            # spooled to a file that has to outlive makeMessage
+            return await loop.run_in_executor(
+                       None, lambda: ( output
+                                       >> (lambda out: makeMessage(out, work.newHeader,
+                                                                   config.overflowPath))
+                                       >> partial(triggerBefore, work.deadline) ))
+
+
+async def runWorkItemsAsync(config:Configuration,
+                            works:List[WorkItem],
+                            running:asyncio.Semaphore,
+                            stop:threading.Event,
+                            received:float) -> List[Outcome[str, None]]:
+    """Async version of *processor.runWorkItems*. Batches are handed to the
+       executor as a whole. Once *stop* is set, *WorkItem*s still waiting to
+       run are failed instead, and so released.
+    """
+    async with running:
+        metrics.record("queueWait", time.perf_counter() - received)
+        if stop.is_set():
+            return [Failure(track("Shutting down"))] * len(works)
+        elif batchKey(config, works[0].message)[0].batching.maxMessages > 1:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, runBatch, config, works)
+        else:
+            return [await runWorkItemAsync(config, works[0])]
+
+
+async def settleDeliveryAsync(delivery:Delivery, result:Outcome[str, None]) -> None:
+    with metrics.timed("settle"):
+        settled = delivery.settle(result)
+        if inspect.isawaitable(settled):
+            await settled
+    metrics.countMessage(not failed(result))
+    for reason in onFailure(result):
+        logging.fatal(reason)
+
+
+async def releaseDeliveryAsync(delivery:Delivery) -> None:
+    """Async version of *processor.releaseDelivery*
+    """
+    with metrics.timed("settle"):
+        settled = delivery.settle(None)
+        if inspect.isawaitable(settled):
+            await settled
+
+
+async def settleUnlessStoppingAsync(stop:threading.Event,
+                                    delivery:Delivery,
+                                    result:Outcome[str, None]) -> None:
+    """Async version of *processor.settleUnlessStopping*
+    """
+    if stop.is_set() and failed(result):
+        await releaseDeliveryAsync(delivery)
+    else:
+        await settleDeliveryAsync(delivery, result)
+
+
+async def handleDeliveriesAsync(config:Configuration,
+                                deliveries:List[Delivery],
+                                running:asyncio.Semaphore,
+                                stop:threading.Event,
+                                received:float,
+                                cache:Optional[AssetCache]=None) -> None:
+    """Async version of *processor.handleDeliveries*. Assets are localized as
+       soon as the messages arrive (through *cache* if given), while *running*
+       limits how many Commands run at once.
+    """
+    loop = asyncio.get_event_loop()
+    scratchDir = newScratchDirectory(config)
+    try:
+        prepared = await loop.run_in_executor(None, prepareBatch,
+                                              [d.message for d in deliveries], scratchDir,
+                                              cache)
+        if isinstance(prepared, Failure):
+            results:List[Outcome[str, None]] = [prepared] * len(deliveries)
+        elif isinstance(prepared, Success):
+            results = await runWorkItemsAsync(config, prepared.value, running, stop, received)
+    except Exception as err:
+        results = [Failure(track(f"Unhandled exception while handling message: {err}"))] * len(deliveries)
+    finally:
+        removeScratchDirectory(scratchDir)
+
+    await asyncio.gather(*map(partial(settleUnlessStoppingAsync, stop), deliveries, results))
+
+
+class AsyncDeliveryStream:
+    """Async version of *processor.DeliveryStream*
+    """
+    def __init__(self, producer:Producer) -> None:
+        self._producer = producer
+        self._deliveries = producer.asyncDeliveries()
+        self._pending:Optional[asyncio.Future] = None
+
+    async def next(self, timeout:Optional[float]=None) -> Optional[Delivery]:
+        """Returns the next *Delivery*, or None once the Producer is exhausted.
+           Raises asyncio.TimeoutError if nothing arrives within *timeout*
+           seconds; the pending receive is kept for the next call.
+        """
+        if self._pending is None:
+            self._pending = asyncio.ensure_future(self._nextOrNone())
+        done, _ = await asyncio.wait({self._pending}, timeout=timeout)
+        if not done:
+            raise asyncio.TimeoutError()
+        delivery = self._pending.result()
+        self._pending = None
+        return delivery
+
+    async def nextUnless(self, stop:threading.Event) -> Optional[Delivery]:
+        """Like *next*, but gives up and returns None once *stop* is set
+        """
+        while not stop.is_set():
+            try:
+                return await self.next(timeout=STOP_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        return None
+
+    async def close(self, timeout:float) -> None:
+        """Stops pulling, after releasing any *Delivery* that is on its way,
+           and closes the Producer so that it can flush or release whatever it
+           still holds. Gives up on a Producer that doesn't stop within
+           *timeout* seconds.
+        """
+        self._producer.close()
+        try:
+            await asyncio.wait_for(self._close(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Producer did not stop within the {timeout}s "
+                            f"shutdown grace period; abandoning it")
+            if self._pending is not None:
+                self._pending.cancel()
+
+    async def _close(self) -> None:
+        if self._pending is not None:
+            delivery = await asyncio.shield(self._pending)
+            self._pending = None
+            if delivery is not None:
+                await releaseDeliveryAsync(delivery)
+        aclose = getattr(self._deliveries, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    async def _nextOrNone(self) -> Optional[Delivery]:
+        try:
+            return await self._deliveries.__anext__()
+        except StopAsyncIteration:
+            return None
+
+
+async def collectBatchAsync(config:Configuration,
+                            stream:AsyncDeliveryStream,
+                            first:Delivery) -> Tuple[List[Delivery], Optional[Delivery]]:
+    """Async version of *processor.collectBatch*
+    """
+    key = batchKey(config, first.message)
+    batching = key[0].batching
+    deadline = time.monotonic() + batching.maxWaitMs / 1000
+    batch = [first]
+    while len(batch) < batching.maxMessages:
+        try:
+            delivery = await stream.next(timeout=max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            break
+        if delivery is None:
+            break
+        elif batchKey(config, delivery.message) != key:
+            return (batch, delivery)
+        batch.append(delivery)
+    return (batch, None)
+
+
+async def acquireUnlessAsync(semaphore:asyncio.Semaphore, stop:threading.Event) -> bool:
+    """Async version of *processor.acquireUnless*
+    """
+    acquiring = asyncio.ensure_future(semaphore.acquire())
+    while not stop.is_set():
+        done, _ = await asyncio.wait({acquiring}, timeout=STOP_POLL_SECONDS)
+        if done:
+            return True
+    acquiring.cancel()
+    return False
+
+
+async def drainInFlightAsync(config:Configuration, tasks:List[asyncio.Future]) -> None:
+    """Async version of *processor.drainInFlight*
+    """
+    if not tasks:
+        return
+    _, notDone = await asyncio.wait(tasks, timeout=config.shutdownGrace)
+    if notDone:
+        logging.warning(f"{len(notDone)} still in flight after the {config.shutdownGrace}s "
+                        f"shutdown grace period; killing their commands")
+        runningProcesses.killAll()
+
+
+async def runDeliveriesAsync(config:Configuration,
+                             producer:Producer,
+                             stop:threading.Event) -> None:
+    """Async version of *processor.runMessageProducer*; see that function for
+       how *config.concurrency*, *config.prefetch* and *stop* apply
+    """
+    inFlight = asyncio.Semaphore(config.concurrency + config.prefetch)
+    running = asyncio.Semaphore(config.concurrency)
+    stream = AsyncDeliveryStream(producer)
+    cache = assetCacheFor(config)
+    tasks:List[asyncio.Future] = []
+    heldOver:Optional[Delivery] = None
+    while await acquireUnlessAsync(inFlight, stop):
+        delivery = heldOver or await stream.nextUnless(stop)
+        if delivery is None:
+            break
+        received = time.perf_counter()
+        batch, heldOver = await collectBatchAsync(config, stream, delivery)
+        task = asyncio.ensure_future(handleDeliveriesAsync(config, batch, running, stop, received,
+                                                           cache))
+        task.add_done_callback(lambda _: inFlight.release())
+        tasks = [t for t in tasks if not t.done()] + [task]
+    if stop.is_set():
+        if heldOver is not None:
+            await releaseDeliveryAsync(heldOver)
+        closing = asyncio.ensure_future(stream.close(config.shutdownGrace))
+        await drainInFlightAsync(config, tasks)
+        await closing
+    await asyncio.gather(*tasks)
+
+
+def runMessageProducerAsync(config:Configuration,
+                            producer:Producer,
+                            stop:Optional[threading.Event]=None) -> None:
+    """Runs a message Producer on an asyncio event loop, until it is exhausted
+       or *stop* is set
+    """
+    stop = threading.Event() if stop is None else stop
+    loop = asyncio.new_event_loop()
+    # Localization, triggers, and adapted producers all block in the default
+    # executor, so size it to the number of messages that can be in flight
+    executor = ThreadPoolExecutor(max_workers=2 * (config.concurrency + config.prefetch))
+    loop.set_default_executor(executor)
+    try:
+        with stopOnSignals(stop):
+            loop.run_until_complete(runDeliveriesAsync(config, producer, stop))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+        executor.shutdown()
+    return None
@@ -0,0 +1,73 @@
+# -*- mode: python;-*-
+
+# One boto3 client per AWS service for the whole process, shared by the
+# producers, triggers and asset handlers. Making a client costs tens of
+# milliseconds of credential and endpoint resolution plus a new connection
+# pool, so sharing one keeps connections alive from one message to the next.
+#
+# Clients (unlike resources) are thread-safe, so one client serves every
+# worker thread. They are not safe across fork(), so a forked child makes its
+# own.
+
+import os
+import threading
+from typing import Any, Dict, Optional
+
+import boto3
+import botocore.config
+
+_lock = threading.Lock()
+_pid = os.getpid()
+_session:Optional[boto3.session.Session] = None
+_clients:Dict[str, Any] = {}
+_queueUrls:Dict[str, str] = {}
+
+
+def _resetIfForked() -> None:
+    global _pid, _session, _clients, _queueUrls
+    if os.getpid() != _pid:
+        _pid = os.getpid()
+        _session = None
+        _clients = {}
+        _queueUrls = {}
+
+
+def client(service:str, maxPoolConnections:int=10) -> Any:
+    """The client for *service* shared by the whole process. The client is
+       made with a pool of *maxPoolConnections* keep-alive connections the
+       first time it is asked for.
+    """
+    global _session
+    with _lock:
+        _resetIfForked()
+        if service not in _clients:
+            # Sessions aren't thread-safe, so clients are only made under the lock
+            if _session is None:
+                _session = boto3.session.Session()
+            config = botocore.config.Config(max_pool_connections=maxPoolConnections,
+                                            tcp_keepalive=True,
+                                            retries={"mode": "standard"})
+            _clients[service] = _session.client(service, config=config)
+        return _clients[service]
+
+
+def forget(service:str) -> None:
+    """Drops the shared client for *service*, so that the next call to
+       client() makes a new one (eg. with a bigger connection pool)
+    """
+    with _lock:
+        _clients.pop(service, None)
+        if service == "sqs":
+            _queueUrls.clear()
+
+
+def queueUrl(queueName:str) -> str:
+    """The URL of SQS queue *queueName*, looked up once per process
+    """
+    with _lock:
+        url = _queueUrls.get(queueName)
+    if url is None:
+        url = client("sqs").get_queue_url(QueueName=queueName)["QueueUrl"]
+        with _lock:
+            _queueUrls[queueName] = url
+    return url
@@ -48,6 +48,67 @@ class Configuration(Serializable):
             instance
         producerArgs (Dict[str, Any]): Dictionary of arguments for creating
             the producer
+        concurrency (int): Maximum number of messages to process at once. When
+            greater than 1, each message gets a private scratch directory for
+            its assets and temp files, so messages sharing asset targets
+            don't trample each other. Commands still run in the CWD of the
+            processor and share its `pid`.
+        prefetch (int): Number of messages to read ahead of those currently
+            running. Assets for read-ahead messages are localized in the
+            background so download time overlaps with command run time. Like
+            concurrency, a non-zero value gives each message a private
+            scratch directory.
+        spoolThreshold (int): Size in bytes beyond which a Command's output
+            is no longer held in memory, but spooled to a file in the
+            message's scratch directory. 0 (the default) keeps all output in
+            memory.
+        overflowPath (str): S3 prefix of the form "s3://bucket/my/prefix".
+            When set, output spooled to disk is uploaded below it and handed
+            to the next Step as an asset, rather than read back into memory.
+        tempFiles (str): How the files behind ${bodyfile}, ${bodyfiles} and
+            ${headerfile} are created. They are only written when a Command
+            refers to them. "disk" (the default) writes ordinary files;
+            "memfd" backs them with anonymous in-memory files on Linux, where
+            the Command sees a /proc/<pid>/fd/<n> path. A memfd is not used
+            if the path is extended in the Command (eg. ${bodyfile}.out).
+        tempDir (str): Directory for temp files written to disk, such as a
+            tmpfs mount; by default they go in the message's scratch
+            directory.
+        assetCacheDir (str): Directory holding a cache of localized assets
+            shared by the npipes processes on this node. Cached assets are
+            hardlinked into each message's scratch directory and are
+            read-only there. Empty (the default) disables the cache.
+        assetCacheMb (int): Size cap of the asset cache in megabytes; least
+            recently used assets are evicted beyond it. 0 means no cap.
+        s3ChunkMb (int): S3 objects larger than this many megabytes are
+            downloaded and uploaded in parts of this size
+        s3Concurrency (int): Number of parts of one S3 object transferred at
+            once
+        httpConcurrency (int): Number of ranges of one large file fetched at
+            once from HTTP(S) servers that support ranges
+        httpPerHost (int): Most requests made to any one HTTP(S) host at once
+        ioThreads (int): Size of the thread pool shared by asset downloads,
+            output uploads and trigger sends
+        ioTimeout (int): Seconds allowed for localizing a message's assets, an
+            upload or a trigger send before it is abandoned. 0 means no limit.
+        sqsLingerMs (int): Milliseconds a message sent to an SQS queue waits for
+            others to be sent with it in one batch. Each send is delayed by up
+            to this long, so 0 (the default) does not wait.
+        jsonCodec (str): JSON library used for messages: "orjson", "ujson" or
+            "json" (the standard library). Empty (the default) picks the
+            fastest one installed.
+        shutdownGrace (int): Seconds that running Commands are given to finish
+            once the processor is asked to stop (eg. by SIGTERM) before they
+            are killed and their messages released
+        metricsFile (str): If set, per-stage timings and byte counts (see
+            npipes.metrics) are written to this file as JSON every
+            metricsInterval seconds
+        metricsPort (int): If non-zero, the same metrics are served as JSON at
+            http://127.0.0.1:<metricsPort>/metrics
+        metricsInterval (int): Seconds between writes of metricsFile
+        runtime (str): "threads" (the default) runs messages on a pool of
+            threads; "asyncio" runs them on an asyncio event loop (see
+            npipes.asyncprocessor)
         pid (int): PID of the current process
     """
     command:Command       = field(default_factory=Command)
@@ -55,6 +116,27 @@ class Configuration(Serializable):
     commandValidator:str  = ""
     producer:str          = ""
     producerArgs:Dict     = field(default_factory=dict)
+    concurrency:int       = 1
+    prefetch:int          = 0
+    spoolThreshold:int    = 0
+    overflowPath:str      = ""
+    tempFiles:str         = "disk"
+    tempDir:str           = ""
+    assetCacheDir:str     = ""
+    assetCacheMb:int      = 10240
+    s3ChunkMb:int         = 8
+    s3Concurrency:int     = 10
+    httpConcurrency:int   = 4
+    httpPerHost:int       = 8
+    ioThreads:int         = 16
+    ioTimeout:int         = 0
+    sqsLingerMs:int       = 0
+    jsonCodec:str         = ""
+    shutdownGrace:int     = 30
+    metricsFile:str       = ""
+    metricsPort:int       = 0
+    metricsInterval:int   = 60
+    runtime:str           = "threads"
     pid:int               = field(default_factory=os.getpid)
 
     # def _toDict(self):
@@ -69,7 +151,28 @@ class Configuration(Serializable):
                 "NPIPES_lockCommand"     : str(self.lockCommand),
                 "NPIPES_commandValidator": self.commandValidator,
                 "NPIPES_producer"        : self.producer,
-                "NPIPES_producerArgs"    : strToB64Str(json.dumps(self.producerArgs)) }
+                "NPIPES_producerArgs"    : strToB64Str(json.dumps(self.producerArgs)),
+                "NPIPES_concurrency"     : str(self.concurrency),
+                "NPIPES_prefetch"        : str(self.prefetch),
+                "NPIPES_spoolThreshold"  : str(self.spoolThreshold),
+                "NPIPES_overflowPath"    : self.overflowPath,
+                "NPIPES_tempFiles"       : self.tempFiles,
+                "NPIPES_tempDir"         : self.tempDir,
+                "NPIPES_assetCacheDir"   : self.assetCacheDir,
+                "NPIPES_assetCacheMb"    : str(self.assetCacheMb),
+                "NPIPES_s3ChunkMb"       : str(self.s3ChunkMb),
+                "NPIPES_s3Concurrency"   : str(self.s3Concurrency),
+                "NPIPES_httpConcurrency" : str(self.httpConcurrency),
+                "NPIPES_httpPerHost"     : str(self.httpPerHost),
+                "NPIPES_ioThreads"       : str(self.ioThreads),
+                "NPIPES_ioTimeout"       : str(self.ioTimeout),
+                "NPIPES_sqsLingerMs"     : str(self.sqsLingerMs),
+                "NPIPES_jsonCodec"       : self.jsonCodec,
+                "NPIPES_shutdownGrace"   : str(self.shutdownGrace),
+                "NPIPES_metricsFile"     : self.metricsFile,
+                "NPIPES_metricsPort"     : str(self.metricsPort),
+                "NPIPES_metricsInterval" : str(self.metricsInterval),
+                "NPIPES_runtime"         : self.runtime }
                 # b64encode(json.dumps(self.producerArgs).encode()).decode()}
 
     def _fromDict(d):
@@ -86,4 +189,25 @@ class Configuration(Serializable):
                  commandValidator = d.get("NPIPES_commandValidator", ""),
                  producer         = d.get("NPIPES_producer", ""),
                  producerArgs     = (json.loads(b64StrToStr(d.get("NPIPES_producerArgs",
-                                                                  strToB64Str("{}"))))) )
+                                                                  strToB64Str("{}"))))),
+                 concurrency      = int(d.get("NPIPES_concurrency", "1")),
+                 prefetch         = int(d.get("NPIPES_prefetch", "0")),
+                 spoolThreshold   = int(d.get("NPIPES_spoolThreshold", "0")),
+                 overflowPath     = d.get("NPIPES_overflowPath", ""),
+                 tempFiles        = d.get("NPIPES_tempFiles", "disk"),
+                 tempDir          = d.get("NPIPES_tempDir", ""),
+                 assetCacheDir    = d.get("NPIPES_assetCacheDir", ""),
+                 assetCacheMb     = int(d.get("NPIPES_assetCacheMb", "10240")),
+                 s3ChunkMb        = int(d.get("NPIPES_s3ChunkMb", "8")),
+                 s3Concurrency    = int(d.get("NPIPES_s3Concurrency", "10")),
+                 httpConcurrency  = int(d.get("NPIPES_httpConcurrency", "4")),
+                 httpPerHost      = int(d.get("NPIPES_httpPerHost", "8")),
+                 ioThreads        = int(d.get("NPIPES_ioThreads", "16")),
+                 ioTimeout        = int(d.get("NPIPES_ioTimeout", "0")),
+                 sqsLingerMs      = int(d.get("NPIPES_sqsLingerMs", "0")),
+                 jsonCodec        = d.get("NPIPES_jsonCodec", ""),
+                 shutdownGrace    = int(d.get("NPIPES_shutdownGrace", "30")),
+                 metricsFile      = d.get("NPIPES_metricsFile", ""),
+                 metricsPort      = int(d.get("NPIPES_metricsPort", "0")),
+                 metricsInterval  = int(d.get("NPIPES_metricsInterval", "60")),
+                 runtime          = d.get("NPIPES_runtime", "threads") )
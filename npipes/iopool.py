@@ -0,0 +1,147 @@
+# -*- mode: python;-*-
+
+# A long-lived thread pool for blocking I/O (asset downloads, uploads and
+# trigger sends), shared by every message instead of being created per
+# message. Operations are given a timeout, and a group of operations (such as
+# the assets of one message) is abandoned as soon as any one of them fails.
+#
+# Threads can't be killed, so abandoning an operation is cooperative: each
+# operation runs with a CancelToken, and long-running loops (eg. writing a
+# download to disk) call checkCancelled() to stop early once it is cancelled.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from typing import Any, Callable, List, Optional, Sequence, TypeVar
+
+from .outcome import Outcome, Success, Failure
+from .utils.track import track
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self) -> None:
+        self._event = threading.Event()
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self) -> None:
+        if self._event.is_set():
+            raise Cancelled("Operation cancelled")
+
+
+_local = threading.local()
+
+
+def currentToken() -> Optional[CancelToken]:
+    """The CancelToken of the operation running on this thread, if any
+    """
+    return getattr(_local, "token", None)
+
+
+def checkCancelled() -> None:
+    """Raises Cancelled if the operation running on this thread was cancelled
+    """
+    token = currentToken()
+    if token is not None:
+        token.check()
+
+
+def runWithToken(token:Optional[CancelToken], fn:Callable[..., T], *args:Any) -> T:
+    """Calls *fn* with *args* as an operation cancelled by *token*. Use this to
+       carry the current token over to threads an operation starts itself.
+    """
+    previous = currentToken()
+    _local.token = token
+    try:
+        return fn(*args)
+    finally:
+        _local.token = previous
+
+
+def guarded(fn:Callable[..., Outcome[str, R]], *args:Any) -> Outcome[str, R]:
+    try:
+        return fn(*args)
+    except Cancelled:
+        return Failure(track("Cancelled"))
+    except Exception as err:
+        return Failure(track(f"Unhandled exception: {err}"))
+
+
+class IOPool:
+    """Runs Outcome-returning I/O operations on up to *maxWorkers* threads,
+       failing any that take longer than *timeout* seconds (0 for no limit)
+    """
+    def __init__(self, maxWorkers:int=16, timeout:float=0) -> None:
+        self.maxWorkers = maxWorkers
+        self.timeout = timeout
+        self._executor:Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def configure(self, maxWorkers:int, timeout:float) -> None:
+        with self._lock:
+            if self._executor is not None and maxWorkers != self.maxWorkers:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.maxWorkers = maxWorkers
+            self.timeout = timeout
+
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.maxWorkers,
+                                                    thread_name_prefix="npipes-io")
+            return self._executor
+
+    def submit(self, token:CancelToken, fn:Callable[..., Outcome[str, R]], *args:Any) -> Future:
+        return self.executor().submit(runWithToken, token, guarded, fn, *args)
+
+    def call(self, fn:Callable[..., Outcome[str, R]], *args:Any) -> Outcome[str, R]:
+        """Runs *fn(\\*args)* on the pool and waits for its Outcome
+        """
+        return self.mapOutcomes(lambda _: fn(*args), [None])[0]
+
+    def mapOutcomes(self,
+                    f:Callable[[T], Outcome[str, R]],
+                    xs:Sequence[T],
+                    failFast:bool=True) -> List[Outcome[str, R]]:
+        """Runs *f* on each of *xs* concurrently and returns their Outcomes in
+           order. Once any of them fails (unless *failFast* is False) or the
+           timeout passes, the rest are cancelled and fail too.
+        """
+        token = CancelToken()
+        futures = [self.submit(token, f, x) for x in xs]
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        pending = set(futures)
+        reason = ""
+        while pending and not reason:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                reason = f"Timed out after {self.timeout} seconds"
+            elif failFast and any(isinstance(fut.result(), Failure) for fut in done):
+                reason = "Cancelled after another operation failed"
+        abandoned = pending
+        if abandoned:
+            token.cancel()
+            for fut in abandoned:
+                fut.cancel()
+            # Cancelled operations stop at their next checkCancelled(), so wait
+            # for them (within the timeout) rather than leave them writing files
+            wait(abandoned, timeout=None if deadline is None
+                                    else max(0, deadline - time.monotonic()))
+        return [Failure(track(reason)) if fut in abandoned else fut.result()
+                for fut in futures]
+
+
+ioPool = IOPool()
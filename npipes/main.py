@@ -11,6 +11,10 @@ from pathlib   import Path
 
 from .configuration      import Configuration
 from .processor          import runMessageProducer
+from .asyncprocessor     import runMessageProducerAsync
+from .iopool             import ioPool
+from .metrics            import startExporting
+from .serialize          import useCodec
 from .producers.producer import Producer
 
 
@@ -31,7 +35,15 @@ def getFileConfig(fname):
 def getEnv():
     keys = ["NPIPES_command", "NPIPES_lockCommand",
             "NPIPES_commandValidator", "NPIPES_producer",
-            "NPIPES_producerArgs"]
+            "NPIPES_producerArgs", "NPIPES_concurrency",
+            "NPIPES_prefetch", "NPIPES_spoolThreshold", "NPIPES_overflowPath",
+            "NPIPES_tempFiles", "NPIPES_tempDir", "NPIPES_assetCacheDir",
+            "NPIPES_assetCacheMb", "NPIPES_s3ChunkMb", "NPIPES_s3Concurrency",
+            "NPIPES_httpConcurrency", "NPIPES_httpPerHost", "NPIPES_ioThreads",
+            "NPIPES_ioTimeout", "NPIPES_sqsLingerMs", "NPIPES_jsonCodec",
+            "NPIPES_shutdownGrace",
+            "NPIPES_metricsFile", "NPIPES_metricsPort", "NPIPES_metricsInterval",
+            "NPIPES_runtime"]
     return {k:os.environ[k] for k in keys if k in os.environ}
     # typecast the special ones
     # if "NPIPES_lockCommand" in env:
@@ -70,10 +82,34 @@ def main():
 
     liftConfig(config, configHash)
 
+    startExporting(config.metricsFile, config.metricsPort, config.metricsInterval)
+    ioPool.configure(config.ioThreads, config.ioTimeout)
+    useCodec(config.jsonCodec)
+
+    # Boto is large, so don't assume s3 utils are available:
+    try:
+        from .assethandlers import s3utils
+        s3utils.configureTransfers(config.s3ChunkMb * 1024 * 1024, config.s3Concurrency)
+    except ImportError:
+        pass
+    try:
+        from .assethandlers import httputils
+        httputils.configureHttp(config.httpConcurrency, config.httpPerHost)
+    except ImportError:
+        pass
+    try:
+        from .triggers import sqs
+        sqs.configureBatching(config.sqsLingerMs / 1000)
+    except ImportError:
+        pass
+
     producerModule = import_module(config.producer)
     producer = producerModule.createProducer(extraArgs, config.producerArgs)
 
-    runMessageProducer(config, producer)
+    if config.runtime == "asyncio":
+        runMessageProducerAsync(config, producer)
+    else:
+        runMessageProducer(config, producer)
 
 
 if __name__ == "__main__":
@@ -7,10 +7,11 @@ import secrets
 import platform
 import os
 from contextlib import contextmanager
+from base64 import b64encode, b64decode
 
 from .header import (Header, Step, Trigger, TriggerGet, Uri, QueueName, TriggerSqs,
                      ProtocolEZQ, Command, FilePath, OutputChannelFile, Asset,
-                     S3Asset, Decompression, AssetSettings, Body, BodyInString, BodyInAsset,
+                     S3Asset, Decompression, AssetSettings, Body, BodyInString, BodyInBytes, BodyInAsset,
                      Message)
 
 from ..assethandlers.s3path import S3Path
@@ -122,6 +123,9 @@ def makeBody(bodyStr:str,
         bodyAssetIndex = len(assets)
         bodyAsset:List[Asset] = [s3DictToAsset(ezqHeader["get_s3_file_as_body"], bodyAssetIndex)]
         body = BodyInAsset(assetId=str(bodyAssetIndex))
+    elif ezqHeader.get("body_encoding") == "base64":
+        body = BodyInBytes(data=b64decode(bodyStr))
+        bodyAsset = []
     else:
         body = BodyInString(string=bodyStr)
         bodyAsset = []
@@ -175,6 +179,14 @@ def convertToEZQ(message:Message) -> str:
         assert(isinstance(bodyAsset, S3Asset)) # EZQ doesn't support anything else for this case
         bodyString = "Message body was diverted to S3 as {}".format(bodyAsset.path)
         directives["get_s3_file_as_body"] = assetToBkDict(bodyAsset)
+    elif isinstance(body, BodyInBytes):
+        # EZQ bodies are text, so a binary body that isn't UTF-8 is sent as
+        # base64; *makeBody* undoes that on the way back in
+        try:
+            bodyString = body.data.decode("utf-8")
+        except UnicodeDecodeError:
+            bodyString = b64encode(body.data).decode()
+            directives["body_encoding"] = "base64"
     else:
         assert(isinstance(body, BodyInString))
         bodyString = body.string
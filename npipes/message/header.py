@@ -10,15 +10,15 @@ from ..assethandlers.s3path import S3Path
 from ..outcome import Outcome, Success, Failure
 # import npipes.message.message
 from typing import Tuple, Type, NewType, Union
-import json
 import yaml
+from base64 import b64encode, b64decode
 import pathlib
 import secrets
 from dataclasses import dataclass
 from operator import methodcaller
 from contextlib import contextmanager
 
-from ..serialize import Serializable, toJson, toMinJson
+from ..serialize import Serializable, toJson, toMinJson, loadJson
 # This one vvv is at the end of the file to avoid import cycle
 # from .ezqconverter import convertFromEZQ
 
@@ -355,6 +355,105 @@ class OutputChannelFile(OutputChannel):
 
 
 
+########################
+# Persistence
+########################
+@dataclass(frozen=True)
+class Persistence(Serializable):
+    persist:bool=False
+    maxMessages:int=0
+    maxMemoryMb:int=0
+    """Describes whether a Command is run once per message (the default), or is
+       started once and kept alive to serve many messages.
+
+       **persist**:     If True, the Command is run as a persistent worker.
+       **maxMessages**: Restart the worker after it has served this many
+                        messages; 0 means no limit
+       **maxMemoryMb**: Restart the worker once its resident memory exceeds
+                        this many MiB; 0 means no limit. Only enforced on
+                        platforms that provide /proc.
+
+       A persistent worker talks to nPipes over its stdin and stdout using
+       length-prefixed frames: a 4-byte, big-endian, unsigned length followed
+       by that many bytes. For each message, nPipes writes two frames:
+
+       1. the message Header as JSON (same contents as ${headerfile})
+       2. the message body
+
+       and the worker answers with two frames:
+
+       1. a status: "0" for success; anything else indicates failure
+       2. the output (the new message body), or an error description
+
+       The worker is restarted automatically if it exits or misbehaves. The
+       Command's arglist is expanded with the values of the message that
+       started the worker, so per-message information should be taken from
+       the frames rather than from the arglist. inputChannelStdin and
+       outputChannel are ignored for persistent workers, and the Command's
+       timeout applies to each message rather than to the life of the worker.
+    """
+    def _toDict(self, meth=methodcaller("_toDict")):
+        return {"persist": self.persist,
+                "maxMessages": self.maxMessages,
+                "maxMemoryMb": self.maxMemoryMb}
+    def _fromDict(d):
+        return Persistence( persist=d.get("persist", False),
+                            maxMessages=d.get("maxMessages", 0),
+                            maxMemoryMb=d.get("maxMemoryMb", 0))
+
+
+########################
+# Batching
+########################
+@dataclass(frozen=True)
+class Batching(Serializable):
+    maxMessages:int=1
+    maxWaitMs:int=0
+    delimiter:str="\n"
+    """Describes whether a Command may be run once over the bodies of several
+       messages rather than once per message.
+
+       **maxMessages**: Largest number of messages to put in one invocation;
+                        1 (the default) turns batching off
+       **maxWaitMs**:   Longest time to wait for further messages to fill a
+                        batch, counted from receipt of the first one
+       **delimiter**:   Separates the individual bodies on stdin, and the
+                        individual results in the output
+
+       Only messages that would run the same Command with the same assets are
+       put in a batch together. The bodies are made available to the Command
+       as follows:
+
+       **${bodyfiles}** -- an arglist entry consisting of exactly this variable
+                       is replaced with one entry per message, each the path of
+                       a file holding that message's body. (For a Command run
+                       on a single message, this is the same as ${bodyfile}.)
+
+       If inputChannelStdin is True, the bodies are written to stdin, separated
+       by *delimiter*. Variables that refer to a single message, such as
+       ${bodyfile} and ${headerfile}, refer to the first message of the batch.
+
+       The output must contain exactly one result per message, in the same
+       order as the bodies and separated by *delimiter*; a trailing delimiter
+       is ignored. Each result becomes the body of a separate message which is
+       triggered and acknowledged on its own. If the Command fails, or its
+       output doesn't split into the right number of results, every message in
+       the batch fails.
+
+       Only producers that can hand out several messages at once (eg. SQS,
+       filesystem) can fill a batch; for SQS, set maxNumberOfMessages to
+       receive several messages per request.
+    """
+    def _toDict(self, meth=methodcaller("_toDict")):
+        return {"maxMessages": self.maxMessages,
+                "maxWaitMs": self.maxWaitMs,
+                "delimiter": self.delimiter}
+    def _fromDict(d):
+        return Batching( maxMessages=d.get("maxMessages", 1),
+                         maxWaitMs=d.get("maxWaitMs", 0),
+                         delimiter=d.get("delimiter", "\n"))
+
+
 ########################
 # Command
 ########################
@@ -364,6 +463,10 @@ class Command(Serializable):
     timeout:int=0
     inputChannelStdin:bool=False
     outputChannel:OutputChannel=OutputChannelStdout()
+    persistence:Persistence=Persistence()
+    batching:Batching=Batching()
+    binaryInput:bool=False
+    binaryOutput:bool=False
     """Command name and all arguments should appear as separate string entries
        in arglist. If you need your command to run inside a shell, do something
        like this: arglist=["bash", "-c", "ls -Fal *.txt | grep foo | wc"]
@@ -407,6 +510,9 @@ class Command(Serializable):
                         mentioned in the very first paragraph of this docstring, you
                         probably don't need this variable.
 
+       **${bodyfiles}** -- paths of the files holding the bodies of a batch of
+                       messages. See Batching.
+
        **${headerfile}** -- absolute path of a file containing the Header of
                         the current message. This is provided in case your
                         transform logic needs to mutate the details of
@@ -421,17 +527,38 @@ class Command(Serializable):
                      designed to be run in a multi-process architecture. This is
                      important when multiple nPipes processes are being run on a single
                      machine in the same userspace.
+
+       persistence allows the command to be kept running across messages
+       rather than being started anew for each one. See Persistence.
+
+       batching allows the command to be run once over the bodies of several
+       messages. See Batching.
+
+       If binaryInput is True, the message body is handed to the command as raw
+       bytes, both on stdin and in $bodyfile, with no text decoding. If
+       binaryOutput is True, the command's output is taken as raw bytes and
+       becomes a BodyInBytes. Otherwise bodies and output are treated as UTF-8
+       text. (Any body type may be sent to either kind of command; it is
+       converted once on its way in.)
     """
     def _toDict(self, meth=methodcaller("_toDict")):
         return { "arglist": self.arglist,
                  "timeout": self.timeout,
                  "inputChannelStdin": self.inputChannelStdin,
-                 "outputChannel": meth(self.outputChannel) }
+                 "outputChannel": meth(self.outputChannel),
+                 "persistence": meth(self.persistence),
+                 "batching": meth(self.batching),
+                 "binaryInput": self.binaryInput,
+                 "binaryOutput": self.binaryOutput }
     def _fromDict(d):
         return Command(arglist=d.get("arglist",[]),
                        timeout=d.get("timeout", 0),
                        inputChannelStdin=d.get("inputChannelStdin", False),
-                       outputChannel=OutputChannel._fromDict(d.get("outputChannel", {})))
+                       outputChannel=OutputChannel._fromDict(d.get("outputChannel", {})),
+                       persistence=Persistence._fromDict(d.get("persistence", {})),
+                       batching=Batching._fromDict(d.get("batching", {})),
+                       binaryInput=d.get("binaryInput", False),
+                       binaryOutput=d.get("binaryOutput", False))
 
 
 ########################
@@ -556,6 +683,8 @@ class Body(Serializable):
             return BodyInString._fromDict(d)
         elif typ == "asset":
             return BodyInAsset._fromDict(d)
+        elif typ == "bytes":
+            return BodyInBytes._fromDict(d)
 
 @dataclass(frozen=True)
 class BodyInString(Body):
@@ -571,6 +700,19 @@ class BodyInString(Body):
                             encoding=Encoding._fromDict(d.get("encoding", {})))
 
 
+@dataclass(frozen=True)
+class BodyInBytes(Body):
+    data:bytes
+    """A binary body. It is kept as bytes while a message is processed, and
+       base64-encoded only when the message is serialized.
+    """
+    def _toDict(self, meth=methodcaller("_toDict")):
+        return { "type": "bytes",
+                 "data": b64encode(self.data).decode() }
+    def _fromDict(d):
+        return BodyInBytes(data=b64decode(d.get("data", "")))
+
+
 @dataclass(frozen=True)
 class BodyInAsset(Body):
     assetId:str
@@ -585,10 +727,41 @@ class BodyInAsset(Body):
 ########################
 # Message
 ########################
+class RawBody(NamedTuple):
+    """The undecoded JSON text of a Message's Body"""
+    text:str
+
+    def decode(self) -> Body:
+        blank = not self.text or self.text.isspace()
+        return Body._fromDict({} if blank else loadJson(self.text))
+
+
+class LazyBody:
+    """Descriptor for Message.body that lets a Message hold a *RawBody* in
+       place of its Body, decoding it the first time the body is used. Large
+       bodies are then only decoded by whichever step actually reads them.
+    """
+    def __get__(self, obj, typ=None) -> Body:
+        if obj is None:
+            return BodyInString("")
+        body = obj.__dict__["_body"]
+        if isinstance(body, RawBody):
+            body = body.decode()
+            obj.__dict__["_body"] = body
+        return body
+
+    def __set__(self, obj, value:Union[Body, RawBody]) -> None:
+        obj.__dict__["_body"] = value
+
+    def stored(self, obj) -> Union[Body, RawBody]:
+        """The body of *obj* as it is held, without decoding it"""
+        return obj.__dict__["_body"]
+
+
 @dataclass(frozen=True)
 class Message(Serializable):
     header:Header=Header()
-    body:Body=BodyInString("")
+    body:LazyBody=LazyBody()
 
     def _toDict(self, meth=methodcaller("_toDict")):
         return { "header": meth(self.header),
@@ -606,12 +779,15 @@ class Message(Serializable):
         return self.toJsonLines(f=toMinJson)
 
     def fromJsonLines(s):
-        # Header is a single JSON line; Body is remainder of string
-        h, *t = s.splitlines()
-        header = json.loads(h)
-        body = json.loads("\n".join(t))
-        return Message._fromDict({"header": header, "body": body})
-
+        # Header is a single JSON line; Body is remainder of string, and is
+        # only decoded when it is first used
+        i = s.find("\n")
+        if i < 0:
+            i = len(s)
+        return Message(header=Header._fromDict(loadJson(s[:i])),
+                       body=RawBody(s[i+1:]))
+
+    @staticmethod
     @contextmanager
     def fromStr(s):
         """Contextmanager that yields a single message. The message should only
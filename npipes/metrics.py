@@ -0,0 +1,182 @@
+# -*- mode: python;-*-
+
+# Per-stage timings and byte counts for message processing, aggregated into
+# percentiles and rates that can be written to a file or served over HTTP.
+# These show where time goes: in asset downloads (S3), in the Command itself
+# (CPU), or in receiving and triggering messages (SQS).
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Percentiles are computed over the most recent samples of each stage
+MAX_SAMPLES = 4096
+
+
+class Sample:
+    """Handed out by *Metrics.timed*, so the timed code can report how many
+       bytes it handled
+    """
+    __slots__ = ["bytes"]
+
+    def __init__(self) -> None:
+        self.bytes = 0
+
+
+class StageStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.recent:Deque[float] = deque(maxlen=MAX_SAMPLES)
+
+    def add(self, seconds:float, nbytes:int) -> None:
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+        self.recent.append(seconds)
+
+    def summary(self, uptime:float) -> Dict[str, Any]:
+        ordered = sorted(self.recent)
+        return { "count": self.count,
+                 "totalSeconds": self.seconds,
+                 "p50": percentile(ordered, 50),
+                 "p95": percentile(ordered, 95),
+                 "p99": percentile(ordered, 99),
+                 "bytes": self.bytes,
+                 "bytesPerSecond": self.bytes / uptime if uptime else 0.0 }
+
+
+def percentile(ordered:List[float], p:int) -> float:
+    """Nearest-rank percentile of the sorted list *ordered*
+    """
+    if not ordered:
+        return 0.0
+    rank = max(0, -(-p * len(ordered) // 100) - 1)
+    return ordered[rank]
+
+
+class Metrics:
+    """Thread-safe collection of per-stage durations and byte counts, plus
+       counts of messages that succeeded and failed
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._stages:Dict[str, StageStats] = {}
+        self._succeeded = 0
+        self._failed = 0
+
+    def record(self, stage:str, seconds:float, nbytes:int=0) -> None:
+        with self._lock:
+            self._stages.setdefault(stage, StageStats()).add(seconds, nbytes)
+
+    @contextmanager
+    def timed(self, stage:str) -> Iterator[Sample]:
+        """Records how long the body of the context takes as *stage*
+        """
+        sample = Sample()
+        start = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            self.record(stage, time.perf_counter() - start, sample.bytes)
+
+    def call(self, stage:str, fn:Callable[..., T], *args:Any) -> T:
+        """Calls *fn* with *args*, recording how long it takes as *stage*
+        """
+        with self.timed(stage):
+            return fn(*args)
+
+    def countMessage(self, succeeded:bool) -> None:
+        with self._lock:
+            if succeeded:
+                self._succeeded += 1
+            else:
+                self._failed += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            uptime = time.monotonic() - self._started
+            done = self._succeeded + self._failed
+            return { "uptimeSeconds": uptime,
+                     "messages": { "succeeded": self._succeeded,
+                                   "failed": self._failed,
+                                   "perSecond": done / uptime if uptime else 0.0 },
+                     "stages": { name: stats.summary(uptime)
+                                 for name, stats in self._stages.items() } }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._started = time.monotonic()
+            self._stages = {}
+            self._succeeded = 0
+            self._failed = 0
+
+
+metrics = Metrics()
+
+
+def writeMetricsFile(path:str, m:Metrics=metrics) -> None:
+    """Writes the current summary of *m* to *path* as JSON, replacing the file
+       atomically so readers never see a partial write
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(m.summary(), f, indent=2)
+    os.replace(tmp, path)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serveMetrics(port:int, m:Metrics=metrics, host:str="127.0.0.1") -> HTTPServer:
+    """Serves the summary of *m* as JSON at http://host:port/metrics on a
+       background thread; returns the server so it can be shut down
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = json.dumps(m.summary()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format:str, *args:Any) -> None:
+            pass
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def startExporting(metricsFile:str, metricsPort:int, interval:int) -> None:
+    """Starts whichever exports are configured: a file rewritten every
+       *interval* seconds, and/or an HTTP endpoint
+    """
+    if metricsPort:
+        serveMetrics(metricsPort)
+        logging.info(f"Serving metrics at http://127.0.0.1:{metricsPort}/metrics")
+    if metricsFile:
+        def loop() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    writeMetricsFile(metricsFile)
+                except OSError as err:
+                    logging.warning(f"Unable to write metrics to {metricsFile}: {err}")
+        threading.Thread(target=loop, daemon=True).start()
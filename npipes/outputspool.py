@@ -0,0 +1,105 @@
+# -*- mode: python;-*-
+
+# Collects the output of a Command without necessarily holding all of it in
+# memory. Output is buffered until it grows past a threshold, after which it
+# is spilled to a file on disk and streamed there instead.
+
+import os
+from dataclasses import dataclass
+from typing import Optional, Union, IO
+
+
+# Message bodies and Command output are text, or bytes for binary Commands
+BodyData = Union[str, bytes]
+
+
+@dataclass(frozen=True)
+class SpilledOutput:
+    """Command output that was too large to keep in memory, and instead sits
+       in the file at *path*
+    """
+    path:str
+    binary:bool=False
+
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def read(self) -> BodyData:
+        with open(self.path, "rb" if self.binary else "r") as f:
+            return f.read()
+
+
+CommandOutput = Union[BodyData, SpilledOutput]
+
+
+def readOutput(output:CommandOutput) -> BodyData:
+    """Returns *output* in memory, reading it back from disk if it was spilled
+    """
+    return output.read() if isinstance(output, SpilledOutput) else output
+
+
+def outputSize(output:CommandOutput) -> int:
+    return output.size() if isinstance(output, SpilledOutput) else len(output)
+
+
+class OutputSpool:
+    """Accumulates bytes in memory until more than *threshold* bytes have been
+       written, then moves them to the file *spillPath* and appends everything
+       after that to the file. A *threshold* of 0 keeps everything in memory.
+    """
+    def __init__(self, threshold:int=0, spillPath:str="") -> None:
+        self.threshold = threshold
+        self.spillPath = spillPath
+        self.spilled = False
+        self.buffer = bytearray()
+        self._file:Optional[IO[bytes]] = None
+
+    def write(self, data:bytes) -> None:
+        if self._file is not None:
+            self._file.write(data)
+            return
+        self.buffer += data
+        if self.threshold and len(self.buffer) > self.threshold:
+            self.spilled = True
+            self._file = open(self.spillPath, "wb")
+            self._file.write(self.buffer)
+            self.buffer = bytearray()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+    def preview(self, limit:int=65536) -> str:
+        """Up to *limit* bytes of what was written, for use in error messages
+        """
+        self.close()
+        if not self.spilled:
+            return self.buffer[:limit].decode(errors="replace")
+        with open(self.spillPath, "rb") as f:
+            return f.read(limit).decode(errors="replace") + "\n[output truncated]"
+
+    def result(self, binary:bool=False) -> CommandOutput:
+        """Closes the spool and returns what was written to it, as bytes if
+           *binary* or else as a string
+        """
+        self.close()
+        if self.spilled:
+            return SpilledOutput(self.spillPath, binary)
+        return bytes(self.buffer) if binary else self.buffer.decode()
+
+
+class TailBuffer:
+    """Keeps only the last *limit* bytes written to it; used for stderr, which
+       is only ever needed for error messages
+    """
+    def __init__(self, limit:int=65536) -> None:
+        self.limit = limit
+        self.buffer = bytearray()
+
+    def write(self, data:bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) > self.limit:
+            del self.buffer[:len(self.buffer) - self.limit]
+
+    def text(self) -> str:
+        return self.buffer.decode(errors="replace")
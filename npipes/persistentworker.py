@@ -0,0 +1,189 @@
+# -*- mode: python;-*-
+
+# Support for Commands declared with Persistence(persist=True): the command is
+# started once and then fed one message after another over its stdin/stdout
+# using the framing protocol described in the docstring of Persistence.
+
+import atexit
+import os
+import struct
+import subprocess
+import threading
+from typing import Dict, List, Optional, Union, IO
+
+from .outcome import Outcome, Success, Failure
+from .message.header import Command, Persistence
+from .supervision import runningProcesses, killProcessGroup
+from .utils.track import track
+
+# How long a worker gets to exit once its stdin or stdout has closed
+EXIT_SECONDS = 5
+
+
+def writeFrame(stream:IO[bytes], data:bytes) -> None:
+    """Writes *data* to *stream* as a single length-prefixed frame
+    """
+    stream.write(struct.pack(">I", len(data)))
+    stream.write(data)
+
+
+def readFrame(stream:IO[bytes]) -> Optional[bytes]:
+    """Reads a single length-prefixed frame from *stream*; returns None if the
+       stream ends before a complete frame has been read
+    """
+    head = stream.read(4)
+    if len(head) < 4:
+        return None
+    (size,) = struct.unpack(">I", head)
+    data = stream.read(size)
+    return data if len(data) == size else None
+
+
+class PersistentProcess:
+    """A child process that stays alive to serve one message after another
+    """
+    def __init__(self, arglist:List[str]) -> None:
+        # stderr is inherited so worker diagnostics end up in our log stream. In
+        # a session of its own, like the Commands run by runProcess, so that
+        # killing it kills anything it started too.
+        self.proc = subprocess.Popen(arglist, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     start_new_session=True)
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        self.stdin:IO[bytes] = self.proc.stdin
+        self.stdout:IO[bytes] = self.proc.stdout
+        runningProcesses.add(self.proc.pid)
+        self.served = 0
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def exchange(self, header:bytes, body:bytes, timeout:Optional[int]) -> Outcome[str, bytes]:
+        """Sends a single message to the process and waits for its reply
+        """
+        timedOut = threading.Event()
+        def kill():
+            timedOut.set()
+            killProcessGroup(self.proc.pid)
+        timer = threading.Timer(timeout, kill) if timeout else None
+        try:
+            if timer:
+                timer.start()
+            writeFrame(self.stdin, header)
+            writeFrame(self.stdin, body)
+            self.stdin.flush()
+            status = readFrame(self.stdout)
+            output = readFrame(self.stdout)
+        except OSError as err:
+            return Failure(track(f"Lost connection to persistent worker: {err}"))
+        finally:
+            if timer:
+                timer.cancel()
+
+        self.served += 1
+        if timedOut.is_set():
+            return Failure(track("Command timed out"))
+        elif status is None or output is None:
+            return Failure(track(f"Persistent worker exited with code {self.exitCode()}"))
+        elif status != b"0":
+            return Failure(track(f"Persistent worker status: {status.decode()}\n"
+                                 f"output: {output.decode(errors='replace')}"))
+        else:
+            return Success(output)
+
+    def exitCode(self) -> Optional[int]:
+        """Waits for the process to exit, killing it if it takes longer than
+           EXIT_SECONDS; returns its exit code
+        """
+        try:
+            return self.proc.wait(timeout=EXIT_SECONDS)
+        except subprocess.TimeoutExpired:
+            killProcessGroup(self.proc.pid)
+            return self.proc.wait()
+
+    def memoryMb(self) -> float:
+        """Resident memory of the process in MiB, or 0 if it can't be determined
+        """
+        try:
+            with open(f"/proc/{self.proc.pid}/statm") as f:
+                residentPages = int(f.read().split()[1])
+            return residentPages * os.sysconf("SC_PAGE_SIZE") / 2**20
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def withinBudget(self, persistence:Persistence) -> bool:
+        if persistence.maxMessages and self.served >= persistence.maxMessages:
+            return False
+        if persistence.maxMemoryMb and self.memoryMb() > persistence.maxMemoryMb:
+            return False
+        return True
+
+    def stop(self) -> None:
+        """Asks the process to exit by closing its stdin; kills it if it doesn't
+        """
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+        self.exitCode()
+        self.stdout.close()
+        runningProcesses.discard(self.proc.pid)
+
+
+class PersistentWorkerPool:
+    """Keeps idle persistent workers around, keyed by the Command they run.
+       A worker serves only one message at a time, so with concurrent message
+       processing there may be several workers for the same Command.
+    """
+    def __init__(self) -> None:
+        self._idle:Dict[str, List[PersistentProcess]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key:str, arglist:List[str]) -> PersistentProcess:
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                worker = idle.pop()
+                if worker.alive():
+                    return worker
+                worker.stop()
+        return PersistentProcess(arglist)
+
+    def release(self, key:str, worker:PersistentProcess, persistence:Persistence) -> None:
+        if worker.alive() and worker.withinBudget(persistence):
+            with self._lock:
+                self._idle.setdefault(key, []).append(worker)
+        else:
+            worker.stop()
+
+    def stopAll(self) -> None:
+        with self._lock:
+            workers = [w for ws in self._idle.values() for w in ws]
+            self._idle = {}
+        for worker in workers:
+            worker.stop()
+
+
+_pool = PersistentWorkerPool()
+atexit.register(_pool.stopAll)
+
+
+def runPersistentCommand(key:str,
+                         command:Command,
+                         header:str,
+                         body:Union[str, bytes]) -> Outcome[str, Union[str, bytes]]:
+    """Runs a message through a persistent worker for *command*, starting one if
+       none is idle. *key* identifies interchangeable workers, and should be
+       derived from the *Command* before its tokens were expanded.
+    """
+    try:
+        worker = _pool.acquire(key, command.arglist)
+    except Exception as err:
+        return Failure(track(f"Unable to start persistent worker: {err}"))
+    timeout = None if command.timeout == 0 else command.timeout
+    try:
+        output = worker.exchange(header.encode("utf-8"),
+                                 body if isinstance(body, bytes) else body.encode("utf-8"),
+                                 timeout)
+    finally:
+        _pool.release(key, worker, command.persistence)
+    return output >> (lambda out: Success(out if command.binaryOutput else out.decode()))
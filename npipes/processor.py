@@ -1,45 +1,73 @@
 # -*- mode: python;-*-
 
-from typing import Tuple, NamedTuple, List, Dict, Union, Type, Any, Optional, Sequence
+from typing import (Tuple, NamedTuple, List, Dict, Union, Type, Any, Optional, Sequence, Callable,
+                    Iterator, IO, Pattern, cast)
+import re
 import subprocess
 import string
 import logging
+import os
+import shutil
+import threading
+import time
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+from itertools import chain
 from pathlib import Path
 
-from .outcome import Success, Failure, onFailure, onSuccess, filterMapFailed
+from dataclasses import dataclass
+
+from .outcome import Success, Failure, onFailure, onSuccess, filterMapFailed, failed
 
 from .message.header import (
-    Asset,
+    Asset, S3Asset, AssetSettings,
     Trigger,
     OutputChannel, OutputChannelStdout, OutputChannelFile,
     Encoding, EncodingPlainText, EncodingGzB64,
     Command,
-    Step, Header, Body, BodyInString, BodyInAsset, Message,
+    Step, Header, Body, BodyInString, BodyInBytes, BodyInAsset, Message,
     peekStep, popStep, peekTrigger)
 
-from .assethandlers.assets import localizeAssets, decideLocalTarget, randomName
+from .assethandlers.assets import localizeAssets, decideLocalPath, randomName
+from .assethandlers.assetcache import AssetCache
+from .assethandlers.s3path import S3Path
 from .configuration import Configuration
+from .outputspool import (OutputSpool, TailBuffer, SpilledOutput, CommandOutput, BodyData,
+                          readOutput, outputSize)
+from .iopool import ioPool
+from .metrics import metrics
+from .persistentworker import runPersistentCommand
+from .supervision import Deadline, runningProcesses, killProcessGroup, stopOnSignals
 from .serialize import toJson
-from .producers.producer import Producer
+from .producers.producer import Producer, Delivery, Puller, closeIterator
 from .outcome import Outcome, Success, Failure
 from .utils.iteratorextras import consume
 from .utils.typeshed import pathlike
 from .utils.autodeleter import AutoDeleter
-from .utils.compressionutils import fromGzB64
+from .utils.compressionutils import fromGzB64, gunzipB64
 from .utils.track import track
 
 # This file is largely organized according to a "dependencies first" rule.
 # Control flow starts near the *bottom* of the file, and moves upward as needed.
 
 
-def scrapeOutput(command:Command, cmdstdout:str) -> Outcome[str, str]:
+def scrapeOutput(command:Command,
+                 cmdstdout:CommandOutput,
+                 threshold:int=0) -> Outcome[str, CommandOutput]:
+    """Picks up the output of *command* from its *OutputChannel*. An output file
+       larger than *threshold* bytes (when non-zero) is left on disk rather
+       than read into memory.
+    """
     oc = command.outputChannel
     if isinstance(oc, OutputChannelStdout):
         result:Outcome = Success(cmdstdout)
     elif isinstance(oc, OutputChannelFile):
         p = Path(oc.filepath)
-        if p.is_file():
-            result = Success(p.read_text())
+        if p.is_file() and threshold and p.stat().st_size > threshold:
+            result = Success(SpilledOutput(str(p), command.binaryOutput))
+        elif p.is_file():
+            result = Success(p.read_bytes() if command.binaryOutput else p.read_text())
         else:
             result = Failure(track(f"Output file {p} does not exist"))
     else:
@@ -47,58 +75,191 @@ def scrapeOutput(command:Command, cmdstdout:str) -> Outcome[str, str]:
     return result
 
 
-def runProcess(command:Command, input:Optional[bytes], timeout:Optional[int]) -> Outcome[str, str]:
-    """Runs command in a new process and returns Outcome containing stdout as
-       a stringin case of Succees, or stdout and stderr as a string in case of
-       Failure
+def drainStream(stream:IO[bytes], sink:Union[OutputSpool, TailBuffer]) -> None:
+    for chunk in iter(lambda: stream.read(65536), b""):
+        sink.write(chunk)
+
+
+def feedStream(stream:IO[bytes], data:bytes) -> None:
+    try:
+        stream.write(data)
+        stream.close()
+    except BrokenPipeError:
+        # The command exited without reading all of its input; its exit
+        # code tells us whether that was a problem
+        pass
+
+
+def runProcess(command:Command,
+               input:Optional[bytes],
+               timeout:Optional[int],
+               spool:Optional[OutputSpool]=None) -> Outcome[str, CommandOutput]:
+    """Runs command in a new process and returns Outcome containing stdout in
+       case of Succees, or stdout and stderr as a string in case of Failure.
+       stdout is streamed into *spool*, so a large output may come back as a
+       *SpilledOutput*; without a *spool* it is all kept in memory. Only the
+       tail of stderr is kept.
     """
+    spool = OutputSpool() if spool is None else spool
+    stderr = TailBuffer()
     try:
-        cp = subprocess.run(command.arglist, input=input, timeout=timeout,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except subprocess.TimeoutExpired as teerr:
-        return Failure(track("Command timed out"))
+        # In a session of its own, so that on timeout we can kill everything
+        # the command started and not just the command itself
+        proc = subprocess.Popen(command.arglist,
+                                stdin=(subprocess.PIPE if input is not None else None),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                start_new_session=True)
     except Exception as err:
         return Failure(track(f"Unknown error running command: {err}"))
 
-    if cp.returncode is not 0:
-        return Failure(track(f"Exit code: {cp.returncode}\n"
-                             f"stdout: {cp.stdout.decode()}\n"
-                             f"stderr: {cp.stderr.decode}"))
+    pumps = [threading.Thread(target=drainStream, args=(proc.stdout, spool), daemon=True),
+             threading.Thread(target=drainStream, args=(proc.stderr, stderr), daemon=True)]
+    if input is not None:
+        pumps.append(threading.Thread(target=feedStream, args=(proc.stdin, input), daemon=True))
+    # Leaving *proc* closes its pipes, once the pumps are done with them
+    with proc, runningProcesses.running(proc.pid):
+        consume( map(lambda t: t.start(), pumps) )
+        try:
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            killProcessGroup(proc.pid)
+            proc.wait()
+            consume( map(lambda t: t.join(), pumps) )
+            spool.close()
+            return Failure(track("Command timed out"))
+        consume( map(lambda t: t.join(), pumps) )
+
+    if returncode != 0:
+        return Failure(track(f"Exit code: {returncode}\n"
+                             f"stdout: {spool.preview()}\n"
+                             f"stderr: {stderr.text()}"))
     else:
-        return Success(cp.stdout.decode())
+        return Success(spool.result(command.binaryOutput))
 
 
-def runCommand(command:Command, body:str) -> Outcome[str, str]:
-    """Runs a command with pre-expanded tokens. Handles logic of monitoring for
-       early exit.
+def runCommand(command:Command,
+               body:BodyData,
+               spool:Optional[OutputSpool]=None) -> Outcome[str, CommandOutput]:
+    """Runs a command with pre-expanded tokens
     """
-    # TODO: Push this onto another thread and periodically examine state.run
-    # to handle early exit
-    timeout = None if command.timeout is 0 else command.timeout
+    timeout = None if command.timeout == 0 else command.timeout
 
-    input = body.encode("utf-8") if command.inputChannelStdin else None
+    input = asBytes(body) if command.inputChannelStdin else None
 
-    return ( runProcess(command, input, timeout) >>
-             (lambda output: scrapeOutput(command, output))
+    threshold = 0 if spool is None else spool.threshold
+    with metrics.timed("command") as sample:
+        output = runProcess(command, input, timeout, spool)
+        sample.bytes = sum(map(outputSize, onSuccess(output)))
+    return ( output >>
+             (lambda out: metrics.call("scrape", scrapeOutput, command, out, threshold))
            )
 
 
-def toUniqueFile(data:str) -> str:
-    filename = randomName()
-    Path(filename).write_text(data)
+def runExpandedCommand(command:Command,
+                       expanded:Command,
+                       header:str,
+                       body:BodyData,
+                       spool:Optional[OutputSpool]=None) -> Outcome[str, CommandOutput]:
+    """Runs *expanded*, which is *command* with its tokens expanded, either in a
+       new process or on a persistent worker. Persistent workers reply in a
+       single frame, so their output is always kept in memory.
+    """
+    if command.persistence.persist:
+        # A persistent worker's output is never spilled, but is a CommandOutput all the same
+        return cast(Outcome[str, CommandOutput],
+                    metrics.call("command", runPersistentCommand, toJson(command), expanded,
+                                 header, body))
+    else:
+        return runCommand(expanded, body, spool)
+
+
+def pathSize(path:pathlike) -> int:
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def toUniqueFile(data:BodyData, scratchDir:str="") -> str:
+    filename = os.path.join(scratchDir, randomName())
+    if isinstance(data, bytes):
+        Path(filename).write_bytes(data)
+    else:
+        Path(filename).write_text(data)
     return filename
 
+# Characters that can follow a reference to a temp file in an arg without
+# extending the path it expands into
+WORD_ENDS = " \t\n'\";|&)<>"
+
+
+def tokenPattern(token:str) -> Pattern:
+    """Matches both forms of a reference to the command variable *token*"""
+    return re.compile(r"\$(?:\{%s\}|%s(?![_a-zA-Z0-9]))" % (token, token))
+
+
+def refersTo(command:Command, tokens:Sequence[str]) -> bool:
+    """True if *command*'s arglist or output file path refers to any of the
+       command variables in *tokens*
+    """
+    texts = list(command.arglist)
+    if isinstance(command.outputChannel, OutputChannelFile):
+        texts.append(command.outputChannel.filepath)
+    return any(tokenPattern(token).search(text) for token in tokens for text in texts)
+
+
+def memfdSafe(command:Command, tokens:Sequence[str]) -> bool:
+    """A memfd's path can't be extended into another valid path, so one is only
+       safe to use if every reference to *tokens* in *command* ends a word
+    """
+    if isinstance(command.outputChannel, OutputChannelFile):
+        if any(tokenPattern(token).search(command.outputChannel.filepath) for token in tokens):
+            return False
+    for arg in command.arglist:
+        for token in tokens:
+            for m in tokenPattern(token).finditer(arg):
+                if m.end() < len(arg) and arg[m.end()] not in WORD_ENDS:
+                    return False
+    return True
+
+
+def writeTempFile(config:Configuration,
+                  command:Command,
+                  tokens:Sequence[str],
+                  data:BodyData,
+                  scratchDir:str,
+                  deleter:AutoDeleter) -> str:
+    """Writes *data* to a temp file for *command*, but only if *command* refers
+       to one of *tokens*; returns the file's path, or "" if it wasn't needed.
+       The file is placed according to *config.tempFiles* and *config.tempDir*,
+       and is removed when *deleter* exits.
+    """
+    if not refersTo(command, tokens):
+        return ""
+    if ( config.tempFiles == "memfd" and hasattr(os, "memfd_create")
+         and memfdSafe(command, tokens) ):
+        fd = os.memfd_create(tokens[0])
+        deleter.callback(os.close, fd)
+        with open(fd, "wb", closefd=False) as f:
+            f.write(asBytes(data))
+        # Opened by path, since children don't inherit our descriptors
+        return f"/proc/{os.getpid()}/fd/{fd}"
+    return deleter.add( toUniqueFile(data, config.tempDir or scratchDir) )
+
+
 # TODO: add to this: timeout
 # There is a lot of logic going on in here. Would be nice to break it up a bit more.
 def expandCommand(command:Command,
                   assets:Sequence[Asset],
-                  body:str,
+                  body:BodyData,
                   bodyfile,
                   headerfile,
                   outputfile,
-                  pid) -> Command:
+                  pid,
+                  scratchDir:str="",
+                  bodyfiles:Optional[Sequence[str]]=None) -> Command:
     """Expands token variables in a *Command*'s *arglist*
     """
+    # A binary body is decoded the same way the OS decodes argv, so that it
+    # is passed to the command byte for byte
+    body = os.fsdecode(body) if isinstance(body, bytes) else body
     targetsForIds = {"bodyfile"    : bodyfile,
                      "bodycontents": body,
                      "headerfile"  : headerfile,
@@ -106,11 +267,17 @@ def expandCommand(command:Command,
                      "pid"         : pid}
     # Add asset markers into the dict
     targetsForIds.update(dict(zip(map(lambda a: a.settings.id, assets),
-                                  map(decideLocalTarget, assets))))
+                                  map(lambda a: decideLocalPath(a, scratchDir), assets))))
 
     newargs = list(map(lambda s: string.Template(s).safe_substitute(targetsForIds),
                        command.arglist))
 
+    # ${bodyfiles} expands into one arg per body, so it has to be spliced in
+    # rather than substituted
+    bfs = [bodyfile] if bodyfiles is None else list(bodyfiles)
+    newargs = list(chain.from_iterable(map(lambda arg: bfs if arg == "${bodyfiles}" else [arg],
+                                           newargs)))
+
     # Special thing #1: we don't want to generate an escaped string unless requested
     # since bodycontents may be large and we don't want to duplicate it unnecessarily
     if any(map(lambda arg: "${escapedbodycontents}" in arg, newargs)):
@@ -132,34 +299,96 @@ def triggerNextStep(result:Message) -> Outcome[str, None]:
     return peekTrigger(result).sendMessage(result)
 
 
-def makeMessage(result: str, newHeader:Header) -> Outcome[str, Message]:
-    return Success(Message(header=newHeader, body=BodyInString(result)))
+def overflowOutput(result:SpilledOutput,
+                   newHeader:Header,
+                   overflowPath:str) -> Outcome[str, Message]:
+    """Uploads spilled output to *overflowPath* in S3 and makes a *Message*
+       whose body refers to it as an asset of the next *Step*
+    """
+    try:
+        from .assethandlers import s3utils
+    except ImportError:
+        return Failure(track("boto3 is required to overflow output to S3"))
+    s3Path = S3Path(overflowPath).add(randomName())
+    asset = S3Asset(s3Path, AssetSettings(id="AutoOverflow"))
+    step, *rest = newHeader.steps
+    newStep = step._with([(".assets", list(step.assets) + [asset])])
+    return ( metrics.call("overflowUpload", ioPool.call, s3utils.uploadFile, result.path, s3Path)
+             >> (lambda _: Success(Message(header=newHeader._with([(".steps", [newStep] + rest)]),
+                                           body=BodyInAsset(assetId="AutoOverflow")))) )
+
+
+def makeMessage(result:CommandOutput,
+                newHeader:Header,
+                overflowPath:str="") -> Outcome[str, Message]:
+    """Makes the *Message* for the next *Step* from a *Command*'s output. Output
+       that was spilled to disk is sent on via *overflowPath* when that is set
+       and there is a next *Step*; otherwise it is read back into memory.
+    """
+    if isinstance(result, SpilledOutput):
+        if overflowPath and newHeader.steps:
+            return overflowOutput(result, newHeader, overflowPath)
+        result = result.read()
+    if isinstance(result, bytes):
+        return Success(Message(header=newHeader, body=BodyInBytes(result)))
+    else:
+        return Success(Message(header=newHeader, body=BodyInString(result)))
 
 
-def extractBodyInString(body:BodyInString) -> str:
+def extractBodyInString(body:BodyInString, binary:bool=False) -> BodyData:
     if isinstance(body.encoding, EncodingPlainText):
         return body.string
+    elif binary: # EncodingGzB64, wanted as bytes: no need to decode the text
+        return gunzipB64(body.string)
     else: # must be EncodingGzB64
-       return fromGzB64(body.string.encode())
+       return fromGzB64(body.string)
 
 
-def extractBodyInAsset(body:BodyInAsset, assets:Sequence[Asset]) -> str:
+def extractBodyInAsset(body:BodyInAsset,
+                       assets:Sequence[Asset],
+                       scratchDir:str="",
+                       binary:bool=False) -> BodyData:
     for asset in assets:
         if body.assetId == asset.settings.id:
-            with open(decideLocalTarget(asset)) as f:
+            with open(decideLocalPath(asset, scratchDir), "rb" if binary else "r") as f:
                 return f.read()
     return ""
 
 
-def extractBody(body:Body, assets:Sequence[Asset]) -> str:
-    """Extract the contents of a *Body* as a string
+def asBytes(data:BodyData) -> bytes:
+    """Converts *data* to bytes, treating text as UTF-8
+    """
+    return data.encode("utf-8") if isinstance(data, str) else data
+
+
+def asText(data:BodyData) -> str:
+    """Converts *data* to a string, treating bytes as UTF-8
+    """
+    return data.decode("utf-8") if isinstance(data, bytes) else data
+
+
+def asBodyData(data:BodyData, binary:bool) -> BodyData:
+    """Converts *data* to bytes if *binary*, or else to a string, treating text
+       as UTF-8
+    """
+    return asBytes(data) if binary else asText(data)
+
+
+def extractBody(body:Body,
+                assets:Sequence[Asset],
+                scratchDir:str="",
+                binary:bool=False) -> BodyData:
+    """Extract the contents of a *Body* as bytes if *binary*, or else as a string
     """
     if isinstance(body, BodyInString):
-        return extractBodyInString(body)
+        data:BodyData = extractBodyInString(body, binary)
+    elif isinstance(body, BodyInBytes):
+        data = body.data
     elif isinstance(body, BodyInAsset):
-        return extractBodyInAsset(body, assets)
+        data = extractBodyInAsset(body, assets, scratchDir, binary)
     else:
-        return ""
+        data = ""
+    return asBodyData(data, binary)
 
 
 def chooseCommand(config:Configuration, command:Command) -> Command:
@@ -174,42 +403,453 @@ def chooseCommand(config:Configuration, command:Command) -> Command:
         return command
 
 
-def handleMessage(config, msg):
-    """Handles a single *Message*
+@dataclass(frozen=True)
+class WorkItem:
+    """A *Message* whose current *Step* has been popped and whose assets have
+       been localized into *scratchDir*; ie. ready to run.
     """
-    step, newHeader = popStep(msg.header)
-
-    lao = localizeAssets(step.assets)
-    if isinstance(lao, Failure):
-        result = lao
+    message:Message
+    step:Step
+    newHeader:Header
+    localized:Sequence[pathlike]
+    scratchDir:str=""
+    deadline:Deadline=Deadline()
+
+
+def prepareMessage(msg:Message,
+                   scratchDir:str="",
+                   cache:Optional[AssetCache]=None) -> Outcome[str, WorkItem]:
+    """Pops the current *Step* from *msg* and localizes its assets, through
+       *cache* if given. The *Step*'s stepTimeout starts counting from here.
+    """
+    step, newHeader = metrics.call("popStep", popStep, msg.header)
+    deadline = Deadline.after(step.stepTimeout)
+    with metrics.timed("localize") as sample:
+        localized = localizeAssets(step.assets, scratchDir, cache)
+        sample.bytes = sum(pathSize(path) for paths in onSuccess(localized) for path in paths)
+    return ( localized
+             >> (lambda localized: deadline.check()
+                                   >> (lambda _: Success(WorkItem(msg, step, newHeader, localized,
+                                                                  scratchDir, deadline)))) )
+
+
+def stageWorkItem(config:Configuration,
+                  work:WorkItem,
+                  deleter:AutoDeleter) -> Tuple[Command, Command, str, BodyData]:
+    """Writes the temp files needed to run a *WorkItem*, registering them (and
+       the localized assets) with *deleter*, and expands its *Command*.
+       Returns the chosen *Command*, its expansion, and the header and body to
+       hand to it.
+    """
+    msg, step, scratchDir = work.message, work.step, work.scratchDir
+    consume( map(deleter.add, work.localized) )
+    cmd = chooseCommand(config, step.command)
+    with metrics.timed("extract") as sample:
+        body = extractBody(msg.body, step.assets, scratchDir, cmd.binaryInput)
+        sample.bytes = len(body)
+    with metrics.timed("tempFiles"):
+        header = toJson(msg.header)
+        bodyfile = writeTempFile(config, cmd, ["bodyfile", "bodyfiles"], body, scratchDir, deleter)
+        headerfile = writeTempFile(config, cmd, ["headerfile"], header, scratchDir, deleter)
+        outputfile = deleter.add( os.path.join(scratchDir, randomName()) )
+    with metrics.timed("expand"):
+        expcmd = limitTimeout(expandCommand(cmd, step.assets, body, bodyfile,
+                                            headerfile, outputfile, config.pid, scratchDir),
+                              work.deadline)
+    return (cmd, expcmd, header, body)
+
+
+def limitTimeout(command:Command, deadline:Deadline) -> Command:
+    """Shortens the timeout of *command* to end by *deadline*
+    """
+    if deadline.at is None:
+        return command
     else:
-        with AutoDeleter() as deleter:
-            body = extractBody(msg.body, step.assets)
-            bodyfile = deleter.add( toUniqueFile(body) )
-            headerfile = deleter.add( toUniqueFile(toJson(msg.header)) )
-            outputfile = deleter.add( randomName() )
-            consume( map(deleter.add, lao.value) )
-
-            result = ( ( Success(chooseCommand(config, step.command))
-                         >> (lambda cmd: Success(expandCommand(cmd, step.assets, body, bodyfile,
-                                           headerfile, outputfile, config.pid)))
-                         >> (lambda expcmd: runCommand(expcmd, body)) )
-                       >> (lambda res: makeMessage(res, newHeader))
-                       >> (lambda message: triggerNextStep(message)) )
+        return command._with([(".timeout", deadline.limit(command.timeout))])
+
+
+def triggerBefore(deadline:Deadline, message:Message) -> Outcome[str, None]:
+    """Triggers the next *Step* unless the current one has run out of time, in
+       which case the message will be retried rather than passed on
+    """
+    return deadline.check() >> (lambda _: metrics.call("trigger", ioPool.call,
+                                                       triggerNextStep, message))
+
+
+def triggerAllBefore(deadline:Deadline,
+                     messages:Sequence[Outcome[str, Message]]) -> List[Outcome[str, None]]:
+    """Like *triggerBefore*, for each of the *messages* made from a batch. They
+       are all sent at once, so that sends to the same place can be coalesced
+       (eg. into SQS batches).
+    """
+    def trigger(made:Outcome[str, Message]) -> Outcome[str, None]:
+        return ( made
+                 >> (lambda message: deadline.check()
+                     >> (lambda _: metrics.call("trigger", triggerNextStep, message))) )
+    return ioPool.mapOutcomes(trigger, messages, failFast=False)
+
+
+def newOutputSpool(config:Configuration, work:WorkItem, deleter:AutoDeleter) -> OutputSpool:
+    """Makes an *OutputSpool* for a *WorkItem*'s stdout that spills into its
+       scratch directory once the output is larger than *config.spoolThreshold*
+    """
+    spillPath = deleter.add( os.path.join(work.scratchDir, randomName()) )
+    return OutputSpool(config.spoolThreshold, spillPath)
+
+
+def runWorkItem(config:Configuration, work:WorkItem) -> Outcome[str, None]:
+    """Runs the *Command* for a prepared *WorkItem* and triggers the next *Step*
+    """
+    with AutoDeleter() as deleter:
+        cmd, expcmd, header, body = stageWorkItem(config, work, deleter)
+        spool = newOutputSpool(config, work, deleter)
+        result = ( work.deadline.check()
+                   >> (lambda _: runExpandedCommand(cmd, expcmd, header, body, spool))
+                   >> (lambda res: makeMessage(res, work.newHeader, config.overflowPath))
+                   >> (lambda message: triggerBefore(work.deadline, message)) )
     return result
 
 
-def runMessageProducer(config:Configuration, producer:Producer) -> None:
-    """Runs a message Producer as a stream
+def prepareBatch(msgs:Sequence[Message],
+                 scratchDir:str="",
+                 cache:Optional[AssetCache]=None) -> Outcome[str, List[WorkItem]]:
+    """Like *prepareMessage*, but for a batch of messages whose current *Step*s
+       share the same assets; the assets are localized only once
+    """
+    def withRest(first:WorkItem) -> List[WorkItem]:
+        return [first] + [WorkItem(m, *metrics.call("popStep", popStep, m.header),
+                                   first.localized, scratchDir, first.deadline)
+                          for m in msgs[1:]]
+    return prepareMessage(msgs[0], scratchDir, cache) >> (lambda first: Success(withRest(first)))
+
+
+def splitOutput(output:BodyData, delimiter:str, count:int) -> Outcome[str, List[BodyData]]:
+    """Splits the output of a batched *Command* into one result per message
+    """
+    results:List[BodyData] = ( list(output.split(asBytes(delimiter))) if isinstance(output, bytes)
+                               else list(output.split(delimiter)) )
+    if len(results) == count + 1 and not results[-1]:
+        results = results[:-1]
+    if len(results) != count:
+        return Failure(track(f"Batched command produced {len(results)} results "
+                             f"for {count} messages"))
+    return Success(results)
+
+
+def joinBodies(bodies:Sequence[BodyData], delimiter:str, binary:bool) -> BodyData:
+    """Joins the bodies of a batch into the single input of a batched *Command*
     """
-    stream = producer.messages()
-    for msg in stream: # () -> Message
-        result = handleMessage(config, msg)
+    if binary:
+        return asBytes(delimiter).join(map(asBytes, bodies))
+    else:
+        return delimiter.join(map(asText, bodies))
+
+
+def runBatch(config:Configuration, works:Sequence[WorkItem]) -> List[Outcome[str, None]]:
+    """Runs the *Command* once over a batch of prepared *WorkItem*s, then
+       triggers the next *Step* for each of them separately
+    """
+    first = works[0]
+    step, scratchDir = first.step, first.scratchDir
+    cmd = chooseCommand(config, step.command)
+    delimiter = cmd.batching.delimiter
+
+    def extract(work:WorkItem) -> BodyData:
+        with metrics.timed("extract") as sample:
+            body = extractBody(work.message.body, step.assets, scratchDir, cmd.binaryInput)
+            sample.bytes = len(body)
+        return body
+
+    with AutoDeleter() as deleter:
+        consume( map(deleter.add, first.localized) )
+        bodies = [extract(w) for w in works]
+        with metrics.timed("tempFiles"):
+            header = toJson(first.message.header)
+            bodyfile = writeTempFile(config, cmd, ["bodyfile"], bodies[0], scratchDir, deleter)
+            bodyfiles = ( [bodyfile or writeTempFile(config, cmd, ["bodyfiles"], bodies[0],
+                                                     scratchDir, deleter)]
+                          + [writeTempFile(config, cmd, ["bodyfiles"], body, scratchDir, deleter)
+                             for body in bodies[1:]] )
+            headerfile = writeTempFile(config, cmd, ["headerfile"], header, scratchDir, deleter)
+            outputfile = deleter.add( os.path.join(scratchDir, randomName()) )
+
+        def expand(_:None) -> Outcome[str, Command]:
+            with metrics.timed("expand"):
+                return Success(limitTimeout(
+                           expandCommand(cmd, step.assets, bodies[0], bodyfile, headerfile,
+                                         outputfile, config.pid, scratchDir, bodyfiles),
+                           first.deadline))
+
+        outputs = ( first.deadline.check()
+                    >> expand
+                    >> (lambda expcmd: runExpandedCommand(
+                                           cmd, expcmd, header,
+                                           joinBodies(bodies, delimiter, cmd.binaryInput)))
+                    >> (lambda output: splitOutput(readOutput(output), delimiter, len(works))) )
+
+    if isinstance(outputs, Success):
+        return triggerAllBefore(first.deadline,
+                                [makeMessage(res, work.newHeader)
+                                 for res, work in zip(outputs.value, works)])
+    else:
+        return [outputs] * len(works)
 
-        stream.send(result)
 
-        for reason in onFailure(result):
-            logging.fatal(reason)
+def runWorkItems(config:Configuration, works:Sequence[WorkItem]) -> List[Outcome[str, None]]:
+    """Runs prepared *WorkItem*s, as a single batch if their *Command* is batched
+    """
+    if chooseCommand(config, works[0].step.command).batching.maxMessages > 1:
+        return runBatch(config, works)
+    else:
+        return list(map(lambda work: runWorkItem(config, work), works))
+
+
+def handleMessage(config, msg, scratchDir=""):
+    """Handles a single *Message*. Assets and temp files are placed in
+       *scratchDir*, which defaults to the CWD.
+    """
+    return ( prepareMessage(msg, scratchDir, assetCacheFor(config))
+             >> (lambda work: runWorkItem(config, work)) )
+
+
+def assetCacheFor(config:Configuration) -> Optional[AssetCache]:
+    """The node's asset cache, if *config* enables one
+    """
+    if not config.assetCacheDir:
+        return None
+    return AssetCache(config.assetCacheDir, config.assetCacheMb * 1024 * 1024)
+
+
+def newScratchDirectory(config:Configuration) -> str:
+    """Creates a private directory for the assets and temp files of a single
+       message (or batch) when several may be in flight at once, so they can't
+       collide; otherwise, returns "" (ie. the CWD)
+    """
+    if config.concurrency > 1 or config.prefetch > 0:
+        scratchDir = Path(".npipes_scratch").joinpath(randomName())
+        scratchDir.mkdir(parents=True)
+        return str(scratchDir)
+    else:
+        return ""
 
-        # TODO: check value of state.run and break out if False
+
+def removeScratchDirectory(scratchDir:str) -> None:
+    if scratchDir:
+        shutil.rmtree(scratchDir, ignore_errors=True)
+
+
+def settleDelivery(delivery:Delivery, result:Outcome[str, None]) -> None:
+    metrics.call("settle", delivery.settle, result)
+    metrics.countMessage(not failed(result))
+    for reason in onFailure(result):
+        logging.fatal(reason)
+
+
+def releaseDelivery(delivery:Delivery) -> None:
+    """Hands back a *Delivery* that won't be run because we're shutting down.
+       It is settled with None rather than an *Outcome*, so the Producer
+       leaves its message to be delivered again rather than failing it.
+    """
+    metrics.call("settle", delivery.settle, None)
+
+
+def settleUnlessStopping(stop:Optional[threading.Event],
+                         delivery:Delivery,
+                         result:Outcome[str, None]) -> None:
+    """Settles *delivery* with *result*, unless it failed once *stop* was set:
+       then the failure is most likely the shutdown itself (the Command was
+       killed, or never run), so the *Delivery* is released instead
+    """
+    if stop is not None and stop.is_set() and failed(result):
+        releaseDelivery(delivery)
+    else:
+        settleDelivery(delivery, result)
+
+
+# How often blocking waits check whether the processor has been asked to stop
+STOP_POLL_SECONDS = 0.5
+
+
+def handleDeliveries(config:Configuration,
+                     deliveries:Sequence[Delivery],
+                     prepare:Callable[[], Outcome[str, List[WorkItem]]],
+                     scratchDir:str,
+                     stop:Optional[threading.Event]=None,
+                     received:Optional[float]=None) -> None:
+    """Runs the *Message*s in *deliveries* (a single message, or a batch) once
+       *prepare* yields their *WorkItem*s, then settles each *Delivery* and
+       removes *scratchDir*. Intended to run on a worker thread, so exceptions
+       are converted to *Failure* to ensure every *Delivery* is settled. If
+       *stop* has been set by the time the messages would run, or they fail
+       after it has been, they are released instead. *received* is the time.perf_counter() at which the
+       messages arrived, used to measure how long they waited for a worker.
+    """
+    if received is not None:
+        metrics.record("queueWait", time.perf_counter() - received)
+    try:
+        prepared = prepare()
+        if stop is not None and stop.is_set():
+            results:List[Outcome[str, None]] = [Failure(track("Shutting down"))] * len(deliveries)
+        elif isinstance(prepared, Failure):
+            results = [prepared] * len(deliveries)
+        elif isinstance(prepared, Success):
+            results = runWorkItems(config, prepared.value)
+    except Exception as err:
+        results = [Failure(track(f"Unhandled exception while handling message: {err}"))] * len(deliveries)
+    finally:
+        removeScratchDirectory(scratchDir)
+
+    consume( map(partial(settleUnlessStopping, stop), deliveries, results) )
+
+
+class DeliveryStream:
+    """Pulls *Delivery*s from a Producer on a background (daemon) thread, so
+       that waiting for the next one can be abandoned after a timeout and
+       resumed later, or abandoned for good at exit
+    """
+    def __init__(self, producer:Producer) -> None:
+        self._producer = producer
+        self._deliveries = producer.deliveries()
+        self._puller = Puller()
+        self._pending:Optional[Future] = None
+
+    def next(self, timeout:Optional[float]=None) -> Optional[Delivery]:
+        """Returns the next *Delivery*, or None once the Producer is exhausted.
+           Raises concurrent.futures.TimeoutError if nothing arrives within
+           *timeout* seconds.
+        """
+        if self._pending is None:
+            self._pending = self._puller.submit(next, self._deliveries, None)
+        delivery = self._pending.result(timeout)
+        self._pending = None
+        return delivery
+
+    def nextUnless(self, stop:threading.Event) -> Optional[Delivery]:
+        """Like *next*, but gives up and returns None once *stop* is set
+        """
+        while not stop.is_set():
+            try:
+                return self.next(timeout=STOP_POLL_SECONDS)
+            except concurrent.futures.TimeoutError:
+                pass
+        return None
+
+    def close(self) -> Future:
+        """Stops pulling, and closes the Producer so that it can flush or
+           release whatever it still holds. A *Delivery* that is still on its
+           way is released as soon as it arrives. Returns a Future that is done
+           once the Producer's iterator has been closed.
+        """
+        def releaseArrival(pending:Future) -> None:
+            if pending.exception() is None and pending.result() is not None:
+                releaseDelivery(pending.result())
+        self._producer.close()
+        if self._pending is not None:
+            self._pending.add_done_callback(releaseArrival)
+        # Runs after any pending receive, since the iterator can't be closed
+        # while it is running
+        closing = self._puller.submit(closeIterator, self._deliveries)
+        self._puller.shutdown()
+        return closing
+
+
+def batchKey(config:Configuration, msg:Message) -> Tuple[Command, List[Asset]]:
+    """Messages with equal keys can be run together in a single batch
+    """
+    step = peekStep(msg)
+    return (chooseCommand(config, step.command), step.assets)
+
+
+def collectBatch(config:Configuration,
+                 stream:DeliveryStream,
+                 first:Delivery) -> Tuple[List[Delivery], Optional[Delivery]]:
+    """Collects further *Delivery*s that can share a single run of the *Command*
+       for *first*, until the batch is full or its time window closes. Returns the
+       batch, along with the first *Delivery* that could not join it, if any.
+    """
+    key = batchKey(config, first.message)
+    batching = key[0].batching
+    deadline = time.monotonic() + batching.maxWaitMs / 1000
+    batch = [first]
+    while len(batch) < batching.maxMessages:
+        try:
+            delivery = stream.next(timeout=max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            break
+        if delivery is None:
+            break
+        elif batchKey(config, delivery.message) != key:
+            return (batch, delivery)
+        batch.append(delivery)
+    return (batch, None)
+
+
+def acquireUnless(semaphore:threading.BoundedSemaphore, stop:threading.Event) -> bool:
+    """Acquires *semaphore*, unless *stop* is set first
+    """
+    while not stop.is_set():
+        if semaphore.acquire(timeout=STOP_POLL_SECONDS):
+            return True
+    return False
+
+
+def drainInFlight(config:Configuration, futures:Sequence[Future]) -> None:
+    """Gives running messages *config.shutdownGrace* seconds to finish, then
+       kills the Commands still running so their messages are released
+    """
+    _, notDone = concurrent.futures.wait(futures, timeout=config.shutdownGrace)
+    if notDone:
+        logging.warning(f"{len(notDone)} still in flight after the {config.shutdownGrace}s "
+                        f"shutdown grace period; killing their commands")
+        runningProcesses.killAll()
+
+
+def runMessageProducer(config:Configuration,
+                       producer:Producer,
+                       stop:Optional[threading.Event]=None) -> None:
+    """Runs a message Producer as a stream, with up to *config.concurrency*
+       messages (or batches of messages) running at once. When *config.prefetch*
+       is non-zero, up to that many additional messages are read ahead and have
+       their assets localized in the background while the running ones execute.
+
+       The next *Delivery* is not requested from the Producer until a slot is
+       free to hold it, and messages are run in the order they were received.
+
+       Runs until the Producer is exhausted or *stop* is set; SIGTERM and
+       SIGINT set it too. On stopping, read-ahead messages are released right
+       away, and running ones get *config.shutdownGrace* seconds to finish
+       before their Commands are killed and their messages released.
+    """
+    stop = threading.Event() if stop is None else stop
+    inFlight = threading.BoundedSemaphore(config.concurrency + config.prefetch)
+    stream = DeliveryStream(producer)
+    cache = assetCacheFor(config)
+    heldOver:Optional[Delivery] = None
+    futures:List[Future] = []
+    with stopOnSignals(stop), \
+         ThreadPoolExecutor(max_workers=config.concurrency) as workers, \
+         ThreadPoolExecutor(max_workers=max(1, config.prefetch)) as localizers:
+        while acquireUnless(inFlight, stop):
+            delivery = heldOver or stream.nextUnless(stop)
+            if delivery is None:
+                break
+            received = time.perf_counter()
+            batch, heldOver = collectBatch(config, stream, delivery)
+            scratchDir = newScratchDirectory(config)
+            prepare:Callable[[], Outcome[str, List[WorkItem]]] = \
+                partial(prepareBatch, [d.message for d in batch], scratchDir, cache)
+            if config.prefetch > 0:
+                prepare = localizers.submit(prepare).result
+            future = workers.submit(handleDeliveries, config, batch, prepare, scratchDir, stop,
+                                    received)
+            future.add_done_callback(lambda _: inFlight.release())
+            futures = [f for f in futures if not f.done()] + [future]
+        if stop.is_set():
+            if heldOver is not None:
+                releaseDelivery(heldOver)
+            closing = stream.close()
+            drainInFlight(config, futures)
+            if not concurrent.futures.wait([closing], timeout=config.shutdownGrace).done:
+                logging.warning(f"Producer did not stop within the {config.shutdownGrace}s "
+                                f"shutdown grace period; abandoning it")
     return None
@@ -1,13 +1,19 @@
 # -*- mode: python;-*-
 
+import heapq
+import os
+import socket
+import threading
 import time
+from functools import partial
 from pathlib import Path
-from typing import Generator, List, Dict, Any
-from dataclasses import dataclass
+from typing import Generator, Iterator, List, Set, Dict, Any, Tuple, Optional
+from dataclasses import dataclass, field
 
 from ..message.header import Message
-from ..outcome import Outcome, Success, Failure, pureOutcome, liftOutcome
-from .producer import Producer
+from ..outcome import Outcome, Success, Failure
+from .producer import Producer, Delivery, openDelivery, serialMessages
+from ..utils import inotify
 from ..utils.typeshed import pathlike
 
 
@@ -22,12 +28,19 @@ class ProducerFilesystem(Producer):
     removeFailures:bool=False
     refreshInterval:float=1.0
     quitWhenEmpty:bool=False
+    useInotify:bool=True
+    claim:bool=False
+    workerId:str=""
+    leaseSeconds:float=300.0
+    _closing:threading.Event = field(default_factory=threading.Event, init=False,
+                                     repr=False, compare=False)
 
     def messages(self) -> Generator[Message, Outcome[Any, Any], None]:
         """Treats a filesystem directory as a queue, yielding the contents of
            each normal file as a message. Tracks processed files to avoid
            re-processing. "Polls" the "queue" indefinitely. Files are processed
-           oldest-first, according to filesystem mtime.
+           oldest-first, according to filesystem mtime. Hidden files (whose
+           names start with ".") are ignored.
 
 	   When *removeSuccesses* is True, each message file is deleted after
            being processed successfully. Default: False.
@@ -35,41 +48,288 @@ class ProducerFilesystem(Producer):
            When *removeFailures* is True, each message file that **fails**
            during processing is removed. Default: False.
 
-           Once all existing messages have been exhausted, "polls" *dir* every
-           *refreshInterval* seconds for new messages.
+           Once all existing messages have been exhausted, waits for new files
+           to be written into (or moved into) *dir*. Where inotify is
+           available (and *useInotify* is True), new files are picked up as
+           soon as they are closed; otherwise *dir* is rescanned every
+           *refreshInterval* seconds.
 
            When *quitWhenEmpty* is True, only makes a single pass through the
            directory, does not "poll" for new messages after that, and exits
+
+           When *claim* is True, several processes (on one host or on NFS
+           clients) can safely share *dir*. Each file is claimed before it is
+           handed out by renaming it into inflight/*workerId*, and afterwards
+           moved into done/ or failed/ (unless it is removed). *workerId*
+           defaults to the host name and process id. Workers renew a lease
+           while they run; the files of a worker whose lease is more than
+           *leaseSeconds* old are moved back into *dir* for others to claim.
         """
-        fake_message = Message() # type: ignore
-
-        processed:List[Path] = []
-        while True:
-
-            files = ( pureOutcome(Path(self.dir).glob("*"))
-                      >> liftOutcome(lambda g: filter(lambda f: f.is_file(), g))
-                      >> liftOutcome(lambda fs: filter(lambda f: f not in processed, fs))
-                      >> liftOutcome(lambda fs: sorted(fs, key=(lambda f: f.stat().st_mtime))) )
-            assert(isinstance(files, Success))
-
-            for file in files.value:
-                with Message.fromStr(file.read_text()) as msg:
-                    result = yield msg
-                if isinstance(result, Success):
-                    if self.removeSuccesses:
-                        file.unlink()
-                    else:
-                        processed += [file]
-                elif isinstance(result, Failure):
-                    if self.removeFailures:
-                        file.unlink()
+        return serialMessages(self.deliveries())
+
+    def deliveries(self) -> Iterator[Delivery]:
+        """Same as *messages*, but yields *Delivery*s. Files that have been
+           handed out but not yet settled are skipped when re-scanning *dir*.
+           A *Delivery* settled with None is handed out again. Stops within
+           *refreshInterval* seconds of the producer being closed.
+        """
+        # Holds every file that is waiting, in flight or has been processed
+        seen:Set[Path] = set()
+        lock = threading.Lock()
+        # Files waiting to be handed out, oldest first
+        waiting:List[Tuple[float, Path]] = []
+
+        def onSettle(file:Path, result:Optional[Outcome[Any, Any]]) -> None:
+            remove = ( (isinstance(result, Success) and self.removeSuccesses) or
+                       (isinstance(result, Failure) and self.removeFailures) )
+            if remove:
+                file.unlink()
+                with lock:
+                    seen.discard(file)
+            elif not isinstance(result, (Success, Failure)):
+                # Released unprocessed. An unchanged file raises no new inotify
+                # event, so it goes straight back to waiting.
+                try:
+                    mtime = file.stat().st_mtime
+                except FileNotFoundError:
+                    with lock:
+                        seen.discard(file)
+                    return
+                with lock:
+                    heapq.heappush(waiting, (mtime, file))
+
+        def onSettleClaimed(held:Claims, file:Path, result:Optional[Outcome[Any, Any]]) -> None:
+            if isinstance(result, Success):
+                held.settle(file, None if self.removeSuccesses else "done")
+            elif isinstance(result, Failure):
+                held.settle(file, None if self.removeFailures else "failed")
+            else:
+                held.release(file)
+
+        def add(file:Path, mtime:float) -> None:
+            # Only called with lock held
+            if file not in seen:
+                seen.add(file)
+                heapq.heappush(waiting, (mtime, file))
+
+        def scan() -> None:
+            """Adds new files in *dir*, statting only those. Forgets files
+               that have gone from *dir*, so that the set of seen files only
+               grows with the directory itself.
+            """
+            present = set()
+            with os.scandir(self.dir) as entries:
+                for entry in entries:
+                    if isMessageFile(entry.name) and entry.is_file():
+                        file = Path(entry.path)
+                        if file not in seen:
+                            try:
+                                mtime = entry.stat().st_mtime
+                            except FileNotFoundError: # Gone since it was listed
+                                continue
+                            with lock:
+                                add(file, mtime)
+                        present.add(file)
+            with lock:
+                seen.intersection_update(present)
+
+        def update(events:List[inotify.Event]) -> None:
+            for event in events:
+                file = Path(self.dir, event.name)
+                if event.mask & inotify.IN_Q_OVERFLOW:
+                    scan()
+                elif not isMessageFile(event.name):
+                    pass
+                elif event.mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    with lock:
+                        seen.discard(file)
+                else:
+                    try:
+                        with lock:
+                            add(file, file.stat().st_mtime)
+                    except FileNotFoundError:
+                        pass
+
+        def claimNext(file:Path) -> Optional[Path]:
+            """Claims *file*, unless it has already gone (eg. to another
+               worker), in which case it is forgotten
+            """
+            claimed = claims.claim(file) if claims is not None else file
+            if claimed is None:
+                with lock:
+                    seen.discard(file)
+                return None
+            return claimed
+
+        claims = Claims(self.dir, self.workerId, self.leaseSeconds) if self.claim else None
+        watcher = None
+        if self.useInotify and not self.quitWhenEmpty:
+            # Watch before the first scan, so that no file slips between them
+            watcher = inotify.watch(str(self.dir), WATCH_EVENTS)
+        try:
+            if claims is not None:
+                claims.sweep()
+            scan()
+            while not self._closing.is_set():
+                while waiting:
+                    with lock:
+                        _, file = heapq.heappop(waiting)
+                    claimed = claimNext(file)
+                    if claimed is None:
+                        continue
+                    try:
+                        text = claimed.read_text()
+                    except FileNotFoundError: # Removed while waiting
+                        with lock:
+                            seen.discard(file)
+                        continue
+                    if claims is not None:
+                        yield openDelivery(text, partial(onSettleClaimed, claims, claimed))
                     else:
-                        processed += [file]
+                        yield openDelivery(text, partial(onSettle, file))
+
+                if self.quitWhenEmpty:
+                    break
+
+                if watcher is not None:
+                    events = watcher.read(self.refreshInterval)
+                    if self._closing.is_set():
+                        break
+                    update(events)
+                elif self._closing.wait(self.refreshInterval):
+                    break
+                else:
+                    scan()
+                if claims is not None and claims.sweepDue():
+                    claims.sweep()
+        finally:
+            if watcher is not None:
+                watcher.close()
+            if claims is not None:
+                claims.close()
+
+
+    def close(self) -> None:
+        """Stops *deliveries* from waiting for further files
+        """
+        self._closing.set()
+
+
+# A new message file is one that has been written and closed in the
+# directory, or moved into it
+WATCH_EVENTS = ( inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+                 | inotify.IN_DELETE | inotify.IN_MOVED_FROM )
+
+
+def isMessageFile(name:str) -> bool:
+    return not name.startswith(".")
+
+
+class Claims:
+    """The files that worker *workerId* has claimed from *dir*, held in
+       *dir*/inflight/*workerId* under a lease that is renewed every third of
+       *leaseSeconds*.
+
+       Lease ages are measured against the mtime of this worker's own freshly
+       renewed lease file rather than the local clock, so that workers on NFS
+       clients with skewed clocks agree on when a lease has expired.
+    """
+    def __init__(self, dir:pathlike, workerId:str, leaseSeconds:float) -> None:
+        self.root = Path(dir)
+        self.leaseSeconds = leaseSeconds
+        self.inflight = self.root / "inflight" / (workerId or defaultWorkerId())
+        self.inflight.mkdir(parents=True, exist_ok=True)
+        self.lease = self.inflight / ".lease"
+        self.renew()
+        # Files left over from an earlier run under the same *workerId*
+        for file in self.inflight.iterdir():
+            if isMessageFile(file.name):
+                self.release(file)
+        self._nextSweep = 0.0
+        self._stop = threading.Event()
+        threading.Thread(target=self._heartbeat, name="npipes-fs-lease", daemon=True).start()
+
+    def renew(self) -> float:
+        """Renews the lease, returning the (filesystem's) time it was renewed
+        """
+        self.lease.touch()
+        return self.lease.stat().st_mtime
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(self.leaseSeconds / 3):
+            try:
+                self.renew()
+            except OSError:
+                pass # Try again next time; the lease is good for a while yet
+
+    def claim(self, file:Path) -> Optional[Path]:
+        """Atomically takes *file* for this worker. None if it has already
+           been taken.
+        """
+        claimed = self.inflight / file.name
+        try:
+            os.rename(file, claimed)
+            return claimed
+        except FileNotFoundError:
+            return None
+
+    def settle(self, claimed:Path, to:Optional[str]) -> None:
+        """Moves *claimed* into subdirectory *to* of *dir*, or removes it if
+           *to* is None
+        """
+        try:
+            if to is None:
+                claimed.unlink()
+            else:
+                target = self.root / to
+                target.mkdir(exist_ok=True)
+                os.replace(claimed, target / claimed.name)
+        except FileNotFoundError:
+            pass # Recovered by another worker after our lease ran out
+
+    def release(self, claimed:Path) -> None:
+        """Puts *claimed* back into *dir* to be claimed again
+        """
+        try:
+            os.rename(claimed, self.root / claimed.name)
+        except FileNotFoundError:
+            pass
+
+    def sweepDue(self) -> bool:
+        return time.monotonic() >= self._nextSweep
+
+    def sweep(self) -> None:
+        """Moves the files of workers whose leases have expired back into
+           *dir*
+        """
+        self._nextSweep = time.monotonic() + self.leaseSeconds / 3
+        now = self.renew()
+        for worker in (self.root / "inflight").iterdir():
+            if worker == self.inflight or not worker.is_dir():
+                continue
+            try:
+                renewed = (worker / ".lease").stat().st_mtime
+            except FileNotFoundError:
+                try:
+                    renewed = worker.stat().st_mtime
+                except FileNotFoundError: # Swept by someone else
+                    continue
+            if now - renewed > self.leaseSeconds:
+                self.recover(worker)
+
+    def recover(self, worker:Path) -> None:
+        try:
+            for file in worker.iterdir():
+                if isMessageFile(file.name):
+                    self.release(file)
+            (worker / ".lease").unlink()
+            worker.rmdir()
+        except OSError:
+            pass # Someone else is recovering it too
 
-                # Required by intended usage semantics
-                yield fake_message
+    def close(self) -> None:
+        self._stop.set()
 
-            if self.quitWhenEmpty:
-                break
 
-            time.sleep(self.refreshInterval)
+def defaultWorkerId() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
@@ -1,12 +1,19 @@
 # -*- mode: python;-*-
 
 from base64 import b64decode
+import asyncio
 import json
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import ExitStack
 from os import environ
 
-from typing import Generator, List, Dict, Any
+from dataclasses import dataclass
+from typing import Generator, Iterator, AsyncIterator, Awaitable, Callable, List, Dict, Any, Optional
 from ..outcome import Outcome, Success, Failure
 from ..message.header import Message
+from ..metrics import metrics
 
 
 # FIXME: What is this doing in here?
@@ -15,6 +22,31 @@ def envLower(key:str) -> Dict:
     return json.loads(b64decode(bv.encode()).decode())
 
 
+@dataclass(frozen=True)
+class Delivery:
+    """A single *Message* handed out by a *Producer*, along with the means to
+       report back the *Outcome* of processing it.
+
+       **message** The *Message* to process
+       **settle**  Callable that MUST be called exactly once with the *Success*
+                   or *Failure* resulting from processing *message*. Settling
+                   performs the same cleanup as *send*ing the result to the
+                   generator returned by *Producer.messages*. Settling with
+                   None instead releases a *message* that was never processed,
+                   leaving it to be delivered again.
+
+       Unlike the *messages* stream, any number of *Delivery*s can be
+       outstanding at once, and they can be settled in any order and from any
+       thread.
+
+       *Delivery*s yielded by *Producer.asyncDeliveries* are settled from the
+       event loop, so there *settle* must not block; it returns an awaitable
+       instead.
+    """
+    message:Message
+    settle:Callable[[Optional[Outcome[Any, Any]]], Any]
+
+
 class Producer:
     def messages(self) -> Generator[Message, Outcome[Any, Any], None]:
         """Yields an infinte sequence of *Message*s. Caller is expected to *send*
@@ -45,6 +77,139 @@ class Producer:
         #                      # use these generators. Best to think of these as bi-directional
         #                      # streams rather than typical python generators.
 
+    def deliveries(self) -> Iterator[Delivery]:
+        """Yields an infinite sequence of *Delivery*s.
+
+           The default implementation adapts *messages*: since that stream can
+           only have one *Message* outstanding, the next *Delivery* is not
+           produced until the previous one has been settled. Producers that
+           can safely hand out several messages at a time should override this
+           method (and can then implement *messages* with *serialMessages*).
+        """
+        stream = self.messages()
+        for msg in stream:
+            outcomes:queue.Queue = queue.Queue(maxsize=1)
+            yield Delivery(msg, outcomes.put)
+            stream.send(outcomes.get())
+
+    def close(self) -> None:
+        """Asks the iterators returned by *deliveries* to finish, so that one
+           blocked waiting for the next message gives up. Runtimes call this
+           from another thread once they stop pulling, and then close the
+           iterator itself, which lets the Producer flush or release whatever
+           it still holds. The default does nothing.
+        """
+        pass
+
+    async def asyncDeliveries(self) -> AsyncIterator[Delivery]:
+        """Async version of *deliveries* for the asyncio runtime (see
+           *npipes.asyncprocessor*).
+
+           The default implementation adapts *deliveries*, pulling from it on a
+           dedicated thread and settling on the event loop's default executor,
+           so blocking producers don't stall the event loop. Producers with
+           native asyncio support should override this method.
+        """
+        loop = asyncio.get_event_loop()
+        puller = Puller()
+        deliveries = self.deliveries()
+        abandoned = False
+        try:
+            while True:
+                delivery = await asyncio.wrap_future(puller.submit(next, deliveries, None))
+                if delivery is None:
+                    return
+                yield Delivery(delivery.message, settleInExecutor(loop, delivery))
+        except asyncio.CancelledError:
+            abandoned = True
+            raise
+        finally:
+            # The iterator is closed once any pull in progress returns; that
+            # is only waited for when the pull wasn't abandoned
+            closing = puller.submit(closeIterator, deliveries)
+            puller.shutdown()
+            if not abandoned:
+                await asyncio.wrap_future(closing)
+
+
+class Puller:
+    """Runs calls that pull from a Producer one at a time, in order, on a
+       daemon thread. Unlike a ThreadPoolExecutor's worker, the thread does
+       not hold up interpreter exit while a call is stuck waiting on a
+       Producer that never returns.
+    """
+    def __init__(self) -> None:
+        self._calls:queue.Queue = queue.Queue()
+        threading.Thread(target=self._run, name="npipes-puller", daemon=True).start()
+
+    def submit(self, f:Callable[..., Any], *args:Any) -> Future:
+        future:Future = Future()
+        self._calls.put((future, f, args))
+        return future
+
+    def shutdown(self) -> None:
+        """Stops the thread once the calls already submitted have run
+        """
+        self._calls.put(None)
+
+    def _run(self) -> None:
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            future, f, args = call
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(f(*args))
+                except BaseException as err:
+                    future.set_exception(err)
+
+
+def settleInExecutor(loop:asyncio.AbstractEventLoop,
+                     delivery:Delivery) -> Callable[[Optional[Outcome[Any, Any]]], Awaitable[Any]]:
+    """A non-blocking *settle* for *delivery*, which runs its blocking one in
+       *loop*'s default executor
+    """
+    def settle(result:Optional[Outcome[Any, Any]]) -> Awaitable[Any]:
+        return loop.run_in_executor(None, delivery.settle, result)
+    return settle
+
+
+def closeIterator(iterator:Iterator[Any]) -> None:
+    """Closes *iterator* if it is a generator, which runs its cleanup
+    """
+    close = getattr(iterator, "close", None)
+    if close is not None:
+        close()
+
+
+def openDelivery(s:str, onSettle:Callable[[Optional[Outcome[Any, Any]]], None]) -> Delivery:
+    """Creates a *Delivery* for the message contained in the string *s*.
+
+       The message stays valid (see *Message.fromStr*) until the *Delivery* is
+       settled, at which point *onSettle* is called with the result.
+    """
+    stack = ExitStack()
+    with metrics.timed("parse") as sample:
+        sample.bytes = len(s)
+        msg = stack.enter_context(Message.fromStr(s))
+    def settle(result:Optional[Outcome[Any, Any]]) -> None:
+        stack.close()
+        onSettle(result)
+    return Delivery(msg, settle)
+
+
+def serialMessages(deliveries:Iterator[Delivery]) -> Generator[Message, Outcome[Any, Any], None]:
+    """Adapts a sequence of *Delivery*s to the bi-directional stream semantics
+       of *Producer.messages*
+    """
+    fake_message = Message()
+    for delivery in deliveries:
+        result = yield delivery.message
+        delivery.settle(result)
+        # Required by intended usage semantics
+        yield fake_message
+
 
 
 # Each Producer submodule MUST have a free function named createProducer,
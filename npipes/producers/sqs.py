@@ -1,13 +1,25 @@
 # -*- mode: python;-*-
 
-from typing import Generator, List, Dict, Any
-from dataclasses import dataclass
-
-import boto3
+import logging
+import queue
+import threading
+import time
+from functools import partial
+from typing import Generator, Iterator, List, Dict, Any, Optional, Set
+from dataclasses import dataclass, field
 
+from ..awsclients import client, queueUrl
 from ..message.header import Message
 from ..outcome import Outcome, Success, Failure
-from .producer import Producer
+from .producer import Producer, Delivery, openDelivery, serialMessages
+
+# Most entries in a single DeleteMessageBatch or ChangeMessageVisibilityBatch
+MAX_BATCH_ENTRIES = 10
+# How often a waiting *ProducerSqs.deliveries* checks whether it was closed
+CLOSE_POLL_SECONDS = 0.1
+# How long closing waits for a receive that is under way
+RECEIVE_JOIN_SECONDS = 1.0
+
 
 def createProducer(cliArgs:List[str], producerArgs:Dict) -> Producer:
     return ProducerSqs(**producerArgs)
@@ -15,8 +27,25 @@ def createProducer(cliArgs:List[str], producerArgs:Dict) -> Producer:
 
 @dataclass(frozen=True)
 class ProducerSqs(Producer):
+    """Polls SQS queue *queueName* for messages, receiving up to
+       *maxNumberOfMessages* at a time.
+
+       Receives run on a background thread that keeps up to *prefetchBatches*
+       received batches waiting locally, so the next message is already at
+       hand when a worker frees up. Acknowledgements are collected for up to
+       *ackIntervalMs* and sent with DeleteMessageBatch and
+       ChangeMessageVisibilityBatch. While *heartbeat* is on, the visibility
+       timeout of every received but unsettled message is extended before it
+       runs out, so that a long-running step is not handed out again.
+    """
     queueName:str
     maxNumberOfMessages:int=1
+    waitTimeSeconds:int=20
+    prefetchBatches:int=1
+    ackIntervalMs:int=500
+    heartbeat:bool=True
+    _closing:threading.Event = field(default_factory=threading.Event, init=False,
+                                     repr=False, compare=False)
 
     def messages(self) -> Generator[Message, Outcome[Any, Any], None]:
         """Yields an (infinite) series of *Message*s by polling the specified
@@ -28,21 +57,199 @@ class ProducerSqs(Producer):
            or *map* operation. DO NOT use the idiom of capturing the value returned
            by *generator.send(foo)*.
         """
-        sqs = boto3.resource('sqs')
-        queue = sqs.get_queue_by_name(QueueName=self.queueName)
-        fake_message = Message()
-
-        sqsMsgs: List[boto3.SQS.Message] = []
-        while True:
-            sqsMsgs = queue.receive_messages(AttributeNames=['VisibilityTimeout'],
-                                             MaxNumberOfMessages=self.maxNumberOfMessages,
-                                             WaitTimeSeconds=20)
-            for sqsMsg in sqsMsgs: # Allows changing MaxNumberOfMessages to > 1 for batching
-                with Message.fromStr(sqsMsg.body) as msg:
-                    result = yield msg
-                if isinstance(result, Success):
-                    sqsMsg.delete()
-                elif isinstance(result, Failure):
-                    sqsMsg.change_visibility(VisibilityTimeout=0)
-
-                yield fake_message
+        return serialMessages(self.deliveries())
+
+    def deliveries(self) -> Iterator[Delivery]:
+        """Yields an (infinite) series of *Delivery*s by polling the specified
+           queue, until the producer is closed. Settling with *Success*
+           deletes the message from the queue; settling with *Failure*
+           immediately makes the message visible in the queue again so further
+           processing attempts can be made.
+        """
+        url = queueUrl(self.queueName)
+        acks = AckBatcher(url, visibilityTimeout(url), self.ackIntervalMs / 1000, self.heartbeat)
+        received:queue.Queue = queue.Queue(maxsize=max(1, self.prefetchBatches))
+        stop = threading.Event()
+        # Held while stopping, or while handing a batch over, so that no batch
+        # can be put into *received* after it has been drained
+        handover = threading.Lock()
+        receiver = threading.Thread(target=self.receiveInto,
+                                    args=(url, acks, received, stop, handover),
+                                    name="npipes-sqs-receive", daemon=True)
+        receiver.start()
+        try:
+            while not self._closing.is_set():
+                try:
+                    sqsMsgs = received.get(timeout=CLOSE_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                for sqsMsg in sqsMsgs: # Allows changing MaxNumberOfMessages to > 1 for batching
+                    yield openDelivery(sqsMsg["Body"],
+                                       partial(acks.settle, sqsMsg["ReceiptHandle"]))
+        finally:
+            with handover:
+                stop.set()
+                # Messages that were received but never handed out go straight back
+                while not received.empty():
+                    release(acks, received.get_nowait())
+            # A receive already under way releases whatever it brings back.
+            # A short one is waited for, so that its messages go back with
+            # the rest; a long poll is left to finish on its own.
+            receiver.join(RECEIVE_JOIN_SECONDS)
+            acks.close()
+
+    def close(self) -> None:
+        """Stops *deliveries* from waiting for further messages. Closing its
+           iterator then sends the acknowledgements still waiting, and hands
+           back the messages that were received but never handed out.
+        """
+        self._closing.set()
+
+    def receiveInto(self,
+                    url:str,
+                    acks:"AckBatcher",
+                    received:queue.Queue,
+                    stop:threading.Event,
+                    handover:threading.Lock) -> None:
+        """Receives batches of messages into *received* until *stop* is set.
+           Waits while *received* is full. A batch that can't be handed over
+           before *stop* is set is released.
+        """
+        while not stop.is_set():
+            try:
+                response = client("sqs").receive_message(QueueUrl=url,
+                                                         MaxNumberOfMessages=self.maxNumberOfMessages,
+                                                         WaitTimeSeconds=self.waitTimeSeconds)
+            except Exception as err:
+                logging.warning(f"Unable to receive from SQS queue {self.queueName}: {err}")
+                stop.wait(1)
+                continue
+            sqsMsgs = response.get("Messages", [])
+            if sqsMsgs:
+                acks.track([m["ReceiptHandle"] for m in sqsMsgs])
+            while sqsMsgs:
+                with handover:
+                    if stop.is_set():
+                        release(acks, sqsMsgs)
+                        return
+                    try:
+                        received.put_nowait(sqsMsgs)
+                        break
+                    except queue.Full:
+                        pass
+                stop.wait(CLOSE_POLL_SECONDS)
+
+
+def release(acks:"AckBatcher", sqsMsgs:List[Dict]) -> None:
+    """Hands received messages that were never processed back to the queue
+    """
+    for sqsMsg in sqsMsgs:
+        acks.settle(sqsMsg["ReceiptHandle"], Failure("Not processed"))
+
+
+def visibilityTimeout(url:str) -> int:
+    """The queue's default visibility timeout in seconds
+    """
+    attributes = client("sqs").get_queue_attributes(QueueUrl=url,
+                                                    AttributeNames=["VisibilityTimeout"])
+    return int(attributes["Attributes"]["VisibilityTimeout"])
+
+
+def chunked(xs:List[str], n:int) -> Iterator[List[str]]:
+    for first in range(0, len(xs), n):
+        yield xs[first:first + n]
+
+
+class AckBatcher:
+    """Collects the acknowledgements of messages received from the SQS queue
+       at *url* and sends them in batches every *interval* seconds (or once a
+       batch is full). With *heartbeat*, the visibility of tracked messages is
+       also extended to *visibility* seconds every third of that time.
+    """
+    def __init__(self, url:str, visibility:int, interval:float, heartbeat:bool) -> None:
+        self.url = url
+        self.visibility = visibility
+        self.interval = interval
+        self.heartbeat = heartbeat and visibility > 0
+        self._lock = threading.Lock()
+        # Held for a whole flush, so that one returns only once any flush
+        # already under way has been sent too
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._inflight:Set[str] = set()
+        self._deletes:List[str] = []
+        self._releases:List[str] = []
+        threading.Thread(target=self._run, name="npipes-sqs-acks", daemon=True).start()
+
+    def track(self, handles:List[str]) -> None:
+        """Starts keeping the messages with receipt *handles* invisible
+        """
+        with self._lock:
+            self._inflight.update(handles)
+
+    def settle(self, handle:str, result:Optional[Outcome[Any, Any]]) -> None:
+        with self._lock:
+            self._inflight.discard(handle)
+            if isinstance(result, Success):
+                self._deletes.append(handle)
+            elif isinstance(result, Failure):
+                self._releases.append(handle)
+            full = max(len(self._deletes), len(self._releases)) >= MAX_BATCH_ENTRIES
+        if full or self._closed:
+            self._wake.set()
+            if self._closed:
+                self.flush()
+
+    def close(self) -> None:
+        """Sends any acknowledgements still waiting and stops the heartbeat.
+           Messages settled from now on are acknowledged straight away.
+        """
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+    def _run(self) -> None:
+        nextBeat = time.monotonic() + self.visibility / 3
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if self.heartbeat and time.monotonic() >= nextBeat:
+                    nextBeat = time.monotonic() + self.visibility / 3
+                    self.extend()
+            except Exception as err:
+                logging.warning(f"Unable to acknowledge SQS messages: {err}")
+
+    def flush(self) -> None:
+        with self._flushing:
+            with self._lock:
+                deletes, self._deletes = self._deletes, []
+                releases, self._releases = self._releases, []
+            sqs = client("sqs")
+            for chunk in chunked(deletes, MAX_BATCH_ENTRIES):
+                self.report("delete", chunk, sqs.delete_message_batch(
+                    QueueUrl=self.url,
+                    Entries=[{"Id": str(n), "ReceiptHandle": h} for n, h in enumerate(chunk)]))
+            self.changeVisibility("release", releases, 0)
+
+    def extend(self) -> None:
+        """Extends the visibility of every message that is still in flight
+        """
+        with self._lock:
+            inflight = list(self._inflight)
+        self.changeVisibility("extend", inflight, self.visibility)
+
+    def changeVisibility(self, action:str, handles:List[str], timeout:int) -> None:
+        sqs = client("sqs")
+        for chunk in chunked(handles, MAX_BATCH_ENTRIES):
+            self.report(action, chunk, sqs.change_message_visibility_batch(
+                QueueUrl=self.url,
+                Entries=[{"Id": str(n), "ReceiptHandle": h, "VisibilityTimeout": timeout}
+                         for n, h in enumerate(chunk)]))
+
+    def report(self, action:str, chunk:List[str], response:Dict) -> None:
+        for failed in response.get("Failed", []):
+            logging.warning(f"Unable to {action} SQS message {chunk[int(failed['Id'])]}: "
+                            f"{failed.get('Code')}: {failed.get('Message')}")
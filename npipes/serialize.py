@@ -1,5 +1,7 @@
 # -*- mode: python;-*-
 
+import dataclasses
+import inspect
 import json
 from operator import methodcaller
 
@@ -9,11 +11,83 @@ try:
 except ImportError:
     HAS_YAML = False
 
-from typing import NamedTuple, Union, Type, Tuple, Any, Sequence, TypeVar
+from typing import NamedTuple, Union, Type, Tuple, Any, Callable, Dict, Optional, Sequence, TypeVar
 
 
 T = TypeVar("T", bound="Serializable")
 
+
+class JsonCodec(NamedTuple):
+    """A JSON library: *dumps* turns plain values into compact JSON text, and
+       *loads* turns JSON text (str or UTF-8 bytes) back into plain values
+    """
+    name:str
+    dumps:Callable[[Any], str]
+    loads:Callable[[Union[str, bytes, bytearray]], Any]
+
+
+def stdlibDumps(x:Any) -> str:
+    return json.dumps(x, separators=(',',':'))
+
+
+CODECS:Dict[str, JsonCodec] = {"json": JsonCodec("json", stdlibDumps, json.loads)}
+
+# Faster JSON libraries are used when they are installed
+try:
+    import orjson
+
+    def orjsonDumps(x:Any) -> str:
+        try:
+            return orjson.dumps(x).decode()
+        except TypeError: # eg. ints wider than 64 bits
+            return stdlibDumps(x)
+
+    CODECS["orjson"] = JsonCodec("orjson", orjsonDumps, orjson.loads)
+except ImportError:
+    pass
+
+try:
+    import ujson
+
+    def ujsonDumps(x:Any) -> str:
+        try:
+            return ujson.dumps(x, ensure_ascii=False, escape_forward_slashes=False)
+        except OverflowError:
+            return stdlibDumps(x)
+
+    CODECS["ujson"] = JsonCodec("ujson", ujsonDumps, ujson.loads)
+except ImportError:
+    pass
+
+# Fastest first
+PREFERENCE = ["orjson", "ujson", "json"]
+
+codec = next(CODECS[name] for name in PREFERENCE if name in CODECS)
+
+
+def useCodec(name:str) -> JsonCodec:
+    """Uses the JsonCodec *name* (one of *CODECS*) for all JSON from now on;
+       an empty *name* picks the fastest one available
+    """
+    global codec
+    if not name:
+        name = next(n for n in PREFERENCE if n in CODECS)
+    if name not in CODECS:
+        raise ValueError(f"JSON codec {name} is not available; "
+                         f"choose from {', '.join(sorted(CODECS))}")
+    codec = CODECS[name]
+    return codec
+
+
+def dumpJson(x:Any) -> str:
+    """Compact JSON for plain value *x*, made with the current codec"""
+    return codec.dumps(x)
+
+
+def loadJson(s:Union[str, bytes, bytearray]) -> Any:
+    """Parses JSON text *s* with the current codec"""
+    return codec.loads(s)
+
 class Serializable:
     """Derive from this class and implement _toDict and _fromDict
        to get customized support for JSON and YAML serialization.
@@ -54,9 +128,16 @@ class Serializable:
            2. There is information in the "default" dict that *would* get stripped
               out that you prefer to keep in there explicitly.
         """
+        defaults = _defaults.get(type(self), _MISSING)
+        if defaults is _MISSING:
+            defaults = defaultsOf(type(self))
+        if defaults is None:
+            return self._toDict()
+        instance, default = defaults
+        if self == instance: # Nothing to keep, so skip making the dict
+            return {}
         try:
-            default = type(self)()._toDict()
-            this = self._toDict(methodcaller("_toMinDict"))
+            this = self._toDict(_toMinDict)
             return subtractDicts(this, default)
         except TypeError as e:
 #            print("WARNING: _toMinDict: using fallthrough for type {}".format(type(self)))
@@ -71,6 +152,22 @@ class Serializable:
                  `.key1.key2` The key path can be thought of as representing
                  a normal python-style chained accessor. Something like a
                  stripped-down jmespath.
+
+           Where every key in a path names a field of a dataclass, only the
+           objects along the path are copied (see *replaceField*) and
+           everything else is shared with self, so the cost doesn't depend
+           on the size of the rest of the object (eg. a large message body).
+           Otherwise self is copied via its dict.
+        """
+        result = self
+        for path, val in paths:
+            result = replacePath(result, path.split('.')[1:], val)
+            if result is None:
+                return self._withDict(paths)
+        return result
+
+    def _withDict(self:T, paths:Sequence[Tuple[str, Any]]) -> T:
+        """*_with* by way of a full round-trip through *_toDict* and *_fromDict*
         """
         d = self._toDict()
         for path, val in paths:
@@ -84,27 +181,80 @@ class Serializable:
         return cls._fromDict(d)
 
 
+def replacePath(obj:Any, keys:Sequence[str], val:Any) -> Any:
+    """Copy of dataclass *obj* with the field at path *keys* set to *val*,
+       or None if some key in the path is not a dataclass field
+    """
+    key, *rest = keys
+    if key not in getattr(obj, "__dataclass_fields__", ()):
+        return None
+    if rest:
+        val = replacePath(getattr(obj, key), rest, val)
+        if val is None:
+            return None
+    return replaceField(obj, key, val)
+
+
+def replaceField(obj:Any, key:str, val:Any) -> Any:
+    """*dataclasses.replace* of the single field *key* of *obj*. The other
+       fields are passed on as they are stored, so that one behind a lazy
+       descriptor (one with a *stored* method, like *Message.body*) is not
+       decoded just to be copied.
+    """
+    kwargs = {}
+    for f in dataclasses.fields(obj):
+        if f.init and f.name != key:
+            descriptor = inspect.getattr_static(type(obj), f.name, None)
+            stored = getattr(descriptor, "stored", None)
+            kwargs[f.name] = getattr(obj, f.name) if stored is None else stored(obj)
+    kwargs[key] = val
+    return obj.__class__(**kwargs)
+
+
+_toMinDict = methodcaller("_toMinDict")
+_MISSING = object()
+
+# A default-constructed instance of each class along with its _toDict, or
+# None for classes that can't be default-constructed. Never modified once made.
+_defaults:Dict[type, Any] = {}
+
+
+def defaultsOf(cls:type) -> Optional[Tuple[Serializable, Dict]]:
+    """The default-constructed *cls* and its dict, made only once per class
+    """
+    try:
+        return _defaults[cls]
+    except KeyError:
+        try:
+            instance = cls()
+            defaults:Optional[Tuple[Serializable, Dict]] = (instance, instance._toDict())
+        except TypeError:
+            defaults = None
+        _defaults[cls] = defaults
+        return defaults
+
+
 def subtractDicts(a, b):
     """Calculates a - b and also removes empty entries
     """
-    return {k:v for k, v in a.items() if v != {} and (k not in b or v != b[k])}
+    return {k:v for k, v in a.items() if v != {} and v != b.get(k, _MISSING)}
 
 
 def toJson(x:Serializable) -> str:
     """Serialiazes a `Serializable` instance to JSON"""
-    return json.dumps(x._toDict(), separators=(',',':'))
+    return dumpJson(x._toDict())
 
 
 def toMinJson(x:Serializable) -> str:
     """Serializes to JSON, while omitting all keys where x does not differ
        from the default-constructed instance of x
     """
-    return json.dumps(x._toMinDict(), separators=(',',':'))
+    return dumpJson(x._toMinDict())
 
 
 def fromJson(jsonstr:Union[str,bytes, bytearray], typ:Type[Serializable]) -> Serializable:
     """Deserializes `jsonstr` into an instance of `typ`"""
-    return typ._fromDict(json.loads(jsonstr))
+    return typ._fromDict(loadJson(jsonstr))
 
 
 if HAS_YAML:
@@ -0,0 +1,117 @@
+# -*- mode: python;-*-
+
+# Keeps processing within its time limits: per-Step deadlines, killing the
+# whole process tree of a Command that overruns, and stopping cleanly when the
+# processor is asked to exit.
+
+import math
+import os
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional, Set
+
+from .outcome import Outcome, Success, Failure
+from .utils.track import track
+
+
+@dataclass(frozen=True)
+class Deadline:
+    """The time (per time.monotonic) by which a *Step* must be done; None means
+       there is no limit
+    """
+    at:Optional[float]=None
+
+    @staticmethod
+    def after(seconds:int) -> "Deadline":
+        """A Deadline *seconds* from now, or none at all if *seconds* is 0
+        """
+        return Deadline(time.monotonic() + seconds if seconds else None)
+
+    def remaining(self) -> Optional[float]:
+        return None if self.at is None else self.at - time.monotonic()
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def limit(self, timeout:int) -> int:
+        """Shortens a Command timeout in whole seconds (0 meaning no timeout)
+           so that it ends by this Deadline
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        budget = max(1, math.ceil(remaining))
+        return budget if timeout == 0 else min(timeout, budget)
+
+    def check(self) -> Outcome[str, None]:
+        return Failure(track("Step timed out")) if self.expired() else Success(None)
+
+
+class ProcessRegistry:
+    """Tracks the process groups of running Commands so they can all be killed
+       when the processor shuts down
+    """
+    def __init__(self) -> None:
+        self._pids:Set[int] = set()
+        self._lock = threading.Lock()
+
+    def add(self, pid:int) -> None:
+        with self._lock:
+            self._pids.add(pid)
+
+    def discard(self, pid:int) -> None:
+        with self._lock:
+            self._pids.discard(pid)
+
+    @contextmanager
+    def running(self, pid:int) -> Iterator[int]:
+        self.add(pid)
+        try:
+            yield pid
+        finally:
+            self.discard(pid)
+
+    def killAll(self) -> None:
+        with self._lock:
+            pids = list(self._pids)
+        for pid in pids:
+            killProcessGroup(pid)
+
+
+runningProcesses = ProcessRegistry()
+
+
+def killProcessGroup(pid:int) -> None:
+    """Kills the process group led by *pid*, so that anything a Command started
+       dies with it. Commands are started in their own session (and so their own
+       process group) for this reason.
+    """
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+@contextmanager
+def stopOnSignals(stop:threading.Event) -> Iterator[threading.Event]:
+    """Sets *stop* on SIGTERM or SIGINT for the duration of the context. Signal
+       handlers can only be installed from the main thread; elsewhere, this does
+       nothing and *stop* must be set by the caller.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield stop
+        return
+    signums = [signal.SIGTERM, signal.SIGINT]
+    previous = [signal.signal(signum, lambda *_: stop.set()) for signum in signums]
+    try:
+        yield stop
+    finally:
+        for signum, handler in zip(signums, previous):
+            signal.signal(signum, handler)
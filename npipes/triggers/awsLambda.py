@@ -3,8 +3,7 @@
 from ..message.header import Message
 from ..outcome import Outcome, Success, Failure
 from ..message.ezqconverter import toEzqOrJsonLines
-
-import boto3
+from ..awsclients import client
 
 
 def sendMessage(name, message:Message) -> Outcome[str, None]:
@@ -16,10 +15,9 @@ def sendMessage(name, message:Message) -> Outcome[str, None]:
     structure, it could (for example) simply discard the header and process the
     message body.
     """
-    client = boto3.client("lambda")
-    resp = client.invoke(FunctionName=name,
-                         InvocationType="Event",
-                         Payload=toEzqOrJsonLines(message).encode("utf-8"))
+    resp = client("lambda").invoke(FunctionName=name,
+                                   InvocationType="Event",
+                                   Payload=toEzqOrJsonLines(message).encode("utf-8"))
     # Boto3 docs specify the following success codes based on InvocationType:
     # RequestResponse => 200, Event => 202, DryRun => 204
     # We're forcing Event invocation here, so...
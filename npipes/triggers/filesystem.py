@@ -16,7 +16,12 @@ def sendMessage(dir, message:Message) -> Outcome[str, None]:
     """
     try:
         messageStr = toEzqOrJsonLines(message)
-        Path(dir).joinpath(randomName()).write_text(messageStr)
+        # Written under a hidden name and then renamed, so that a reader never
+        # sees a partly written message
+        name = randomName()
+        tmp = Path(dir).joinpath("." + name)
+        tmp.write_text(messageStr)
+        tmp.rename(Path(dir).joinpath(name))
         return Success(None)
     except Exception as e:
         return Failure("TriggerFilesystem.sendMessage: {}".format(e))
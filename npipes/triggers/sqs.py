@@ -2,18 +2,129 @@
 
 from ..message.header import Message
 from ..outcome import Outcome, Success, Failure
-from ..message.header import Encoding, EncodingPlainText, EncodingGzB64, S3Asset, AssetSettings, Decompression, BodyInString, BodyInAsset
+from ..message.header import Encoding, EncodingPlainText, EncodingGzB64, S3Asset, AssetSettings, Decompression, BodyInString, BodyInBytes, BodyInAsset
 from ..assethandlers.assets import randomName
 from ..assethandlers.s3utils import uploadData
 from ..assethandlers.s3path import S3Path
 from ..message.ezqconverter import toEzqOrJsonLines
+from ..awsclients import client, queueUrl
 
-from typing import Generator, List
-import boto3
+from concurrent.futures import Future
+from typing import Dict, Generator, List
 import hashlib
 import gzip
+import threading
+import time
 from base64 import b64encode
 
+# Limits of a single SendMessageBatch call
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 262144
+
+
+class PendingSend:
+    """A message body waiting in a *SendBatch*, and the *Outcome* of sending it
+    """
+    def __init__(self, body:str) -> None:
+        self.body = body
+        self.size = len(body.encode("utf-8"))
+        self.md5 = hashlib.md5(body.encode("utf-8")).hexdigest()
+        self.result:Future = Future()
+
+
+class SendBatch:
+    def __init__(self) -> None:
+        self.entries:List[PendingSend] = []
+        self.size = 0
+        self.closed = False
+
+    def fits(self, entry:PendingSend) -> bool:
+        return ( len(self.entries) < MAX_BATCH_ENTRIES
+                 and self.size + entry.size <= MAX_BATCH_BYTES )
+
+    def add(self, entry:PendingSend) -> None:
+        self.entries.append(entry)
+        self.size += entry.size
+        if len(self.entries) == MAX_BATCH_ENTRIES:
+            self.closed = True
+
+
+class SendBuffer:
+    """Coalesces messages sent to the same queue from different threads into
+       SendMessageBatch calls. The first message of a batch waits up to
+       *linger* seconds for others to join it; the batch is sent as soon as it
+       is full. Each sender blocks until its own message is confirmed, so the
+       input message is never acked before its output is enqueued.
+    """
+    def __init__(self, linger:float=0.0) -> None:
+        self.linger = linger
+        self._open:Dict[str, SendBatch] = {}
+        self._cond = threading.Condition()
+
+    def send(self, url:str, body:str) -> Outcome[str, None]:
+        entry = PendingSend(body)
+        with self._cond:
+            batch = self._open.get(url)
+            if batch is not None and batch.fits(entry):
+                leader = False
+            else:
+                leader = True
+                if batch is not None:
+                    batch.closed = True # Full up; its leader sends it now
+                    self._cond.notify_all()
+                batch = self._open[url] = SendBatch()
+            batch.add(entry)
+            if batch.closed:
+                self._cond.notify_all()
+            if leader:
+                deadline = time.monotonic() + self.linger
+                while not batch.closed and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+                batch.closed = True
+                if self._open.get(url) is batch:
+                    del self._open[url]
+        if leader:
+            sendBatch(url, batch)
+        return entry.result.result()
+
+
+def sendBatch(url:str, batch:SendBatch) -> None:
+    """Sends *batch* with one SendMessageBatch call, and settles each entry
+       with the result for its message
+    """
+    entries = batch.entries
+    try:
+        response = client("sqs").send_message_batch(
+            QueueUrl=url,
+            Entries=[{"Id": str(n), "MessageBody": e.body} for n, e in enumerate(entries)])
+    except Exception as err:
+        for entry in entries:
+            entry.result.set_result(Failure("Unable to send SQS message: {}".format(err)))
+        return
+    for sent in response.get("Successful", []):
+        entry = entries[int(sent["Id"])]
+        if sent.get("MD5OfMessageBody") == entry.md5:
+            entry.result.set_result(Success(None))
+        else:
+            entry.result.set_result(Failure("Enqueued message MD5 does not match what was sent"))
+    for failed in response.get("Failed", []):
+        entries[int(failed["Id"])].result.set_result(
+            Failure("Unable to send SQS message: {}: {}".format(failed.get("Code"),
+                                                                failed.get("Message"))))
+    for entry in entries:
+        if not entry.result.done():
+            entry.result.set_result(Failure("SQS reported no result for message"))
+
+
+sendBuffer = SendBuffer()
+
+
+def configureBatching(linger:float) -> None:
+    """Sets how many seconds a message waits for others to batch up with
+    """
+    global sendBuffer
+    sendBuffer = SendBuffer(linger)
+
 
 def sendMessage(queuename:str, overflowPath:str, message:Message) -> Outcome[str, None]:
     """Sends *message* to SQS queue *queuename*
@@ -25,28 +136,23 @@ def sendMessage(queuename:str, overflowPath:str, message:Message) -> Outcome[str
        **overflowPath** should be of the form "s3://bucket/my/prefix". The
        actual message body will then be written to
        "s3://bucket/my/prefix/some_random_name.gz"
+
+       Messages sent to the same queue at about the same time are sent together
+       in batches (see *SendBuffer*).
     """
     try:
-        sqs = boto3.resource("sqs")
-        queue = sqs.get_queue_by_name(QueueName=queuename)
-        messageAutoflowed = overflow(message, overflowPath)
         messageBody = toEzqOrJsonLines(overflow(message, overflowPath))
         # Probably want to maintain an md5 of the overflowed body in
         # the message as well so the receiving side can check that it
         # has everything.
-        md5 = hashlib.md5(messageBody.encode("utf-8")).hexdigest()
-        response = queue.send_message(MessageBody=messageBody)
-        if response.get("MD5OfMessageBody") == md5:
-            return Success(None)
-        else:
-            return Failure("Enqueued message MD5 does not match what was sent")
+        return sendBuffer.send(queueUrl(queuename), messageBody)
     except Exception as err:
         return Failure("Unable to send SQS message: {}".format(err))
 
 def overflow(message:Message, overflowPath:str) -> Message:
     # If body is already in an asset, there's nothing we can do here.
-    body = Message.body
-    if isinstance(body, BodyInString):
+    body = message.body
+    if isinstance(body, (BodyInString, BodyInBytes)):
         # SQS accepts messages up to 256kB (262,144 B), *including* the SQS
         # header data. The size of the SQS header is unspecified, but is
         # unlikely to be > 2,144B ... probably maybe. Hence the choice of 260000 here:
@@ -59,14 +165,16 @@ def overflow(message:Message, overflowPath:str) -> Message:
             # 2. If the above fails, we take the gzip bytestring (no b64 stuff), send
             #    it to overflowPath in S3, then re-jigger the Message to reference
             #    a BodyInAsset.
-            bodyBytes = body.string.encode()
+            # A binary body is compressed as is; a Command that reads it as
+            # binary gets back exactly the same bytes.
+            bodyBytes = body.string.encode() if isinstance(body, BodyInString) else body.data
             gzBodyBytes = gzip.compress(bodyBytes, compresslevel=9)
             b64BodyBytes = b64encode(gzBodyBytes)
             # So...did the compression get us under the threshold?
-            if len(b64BodyBytes) < (overAmount - 23): # 23 is the add'l bytes occupied
-                                                      # by the now-nec. encoding info
-                newBody = BodyInString(b64BodyBytes.decode(), encoding=EncodingGzB64())
-                return message._with([(".body", newBody)])
+            newBody = BodyInString(b64BodyBytes.decode(), encoding=EncodingGzB64())
+            compressed = message._with([(".body", newBody)])
+            if len(compressed.toJsonLines().encode()) <= 260000:
+                return compressed
             else:
                 # Have to overflow to S3
                 fname = randomName()
@@ -81,7 +189,7 @@ def overflow(message:Message, overflowPath:str) -> Message:
                 newsteps = [newstep] + oldsteps[1:]
 
                 return message._with([(".header.steps", newsteps),
-                                      (".header.body", BodyInAsset(assetId="AutoOverflow"))])
+                                      (".body", BodyInAsset(assetId="AutoOverflow"))])
                 # We don't check the message at this point to see if we're truly under
                 # size now. That's because we're not going to put header information into
                 # S3. If someone has dreamed up a workflow that results in a *Header* that
@@ -1,11 +1,12 @@
 from contextlib import contextmanager, ExitStack
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, TypeVar
 
-from npipes.utils.typeshed import pathlike
+# Paths come back as the same type they were added as
+P = TypeVar("P", str, Path)
 
 @contextmanager
-def autoDeleteFile(path:pathlike) -> Iterator[pathlike]:
+def autoDeleteFile(path:P) -> Iterator[P]:
     """Context manager that deletes a single file when the context ends
     """
     try:
@@ -31,7 +32,7 @@ class AutoDeleter(ExitStack):
 
     # file_1, file_2, and file_3 are deleted here automatically
     """
-    def add(self, path:pathlike) -> pathlike:
+    def add(self, path:P) -> P:
         """Returns path after adding it to the auto-deletion context.
         """
         return self.enter_context(autoDeleteFile(path))
@@ -2,6 +2,7 @@
 
 from gzip import compress, decompress
 from base64 import b64encode, b64decode
+from typing import Union
 
 
 def toGzB64(s:str) -> bytes:
@@ -10,8 +11,14 @@ def toGzB64(s:str) -> bytes:
     """
     return b64encode(compress(s.encode("utf-8")))
 
-def fromGzB64(b:bytes) -> str:
-    """Convert a base-64-encoded, gzipped bytes list to a plain string;
-       inverse function of *toGzB64*
+def fromGzB64(b:Union[bytes, str]) -> str:
+    """Convert a base-64-encoded, gzipped bytes list (or its base-64 text) to a
+       plain string; inverse function of *toGzB64*
     """
-    return decompress(b64decode(b)).decode()
+    return gunzipB64(b).decode()
+
+def gunzipB64(b:Union[bytes, str]) -> bytes:
+    """Like *fromGzB64*, but leaves the decompressed data as bytes. *b* may
+       also be the base-64 text as a string, saving a copy.
+    """
+    return decompress(b64decode(b))
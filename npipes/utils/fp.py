@@ -8,4 +8,4 @@ def identity(x):
 
 def concurrentMap(f, xs):
     with concurrent.futures.ThreadPoolExecutor() as executor:
-        return executor.map(f, xs)
+        return list(executor.map(f, xs))
@@ -0,0 +1,87 @@
+# -*- mode: python;-*-
+
+# Minimal inotify bindings over ctypes, for watching a single directory
+# without polling it. Only available on Linux; *watch* returns None wherever
+# inotify can't be used, so callers can fall back to rescanning.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from typing import List, NamedTuple, Optional
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_CLOEXEC     = 0o2000000
+IN_NONBLOCK    = 0o4000
+
+_EVENT = struct.Struct("iIII") # wd, mask, cookie, len; followed by len bytes of name
+
+
+class Event(NamedTuple):
+    mask:int
+    name:str
+
+
+class Inotify:
+    """Watches directory *path* for the events in *mask*
+    """
+    def __init__(self, path:str, mask:int) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask | IN_ONLYDIR) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), path)
+
+    def read(self, timeout:Optional[float]=None) -> List[Event]:
+        """Events that have happened, waiting up to *timeout* seconds for
+           the first one
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append(Event(mask, name))
+        return events
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self) -> "Inotify":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def watch(path:str, mask:int) -> Optional[Inotify]:
+    """An *Inotify* watching *path*, or None if inotify is unavailable
+    """
+    try:
+        return Inotify(path, mask)
+    except (OSError, AttributeError):
+        return None
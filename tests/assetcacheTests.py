@@ -0,0 +1,139 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import os
+import tempfile
+import time
+from pathlib import Path
+from threading import Thread
+
+from npipes.assethandlers.assetcache import *
+from npipes.outcome import Success, Failure
+
+
+class AssetCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        self.fetches = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fetcher(self, content, name="asset.txt"):
+        def fetch(workDir):
+            self.fetches.append(workDir)
+            path = Path(workDir, name)
+            path.write_bytes(content)
+            return Success(str(path))
+        return fetch
+
+    def test_localize(self):
+        cache = AssetCache(self.root / "cache")
+        first = self.root / "msg1" / "asset.txt"
+        second = self.root / "msg2" / "asset.txt"
+        self.assertEqual(cache.localize("a@1", first, self.fetcher(b"one")).value, first)
+        self.assertEqual(cache.localize("a@1", second, self.fetcher(b"one")).value, second)
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual(second.read_bytes(), b"one")
+        # Hardlinked, and protected from being written through the link
+        self.assertEqual(first.stat().st_ino, second.stat().st_ino)
+        self.assertFalse(os.stat(second).st_mode & 0o222)
+        # Removing a message's copy leaves the cache intact
+        first.unlink()
+        self.assertEqual(cache.localize("a@1", first, self.fetcher(b"one")).value, first)
+        self.assertEqual(len(self.fetches), 1)
+        # A new version is fetched again
+        cache.localize("a@2", first, self.fetcher(b"two"))
+        self.assertEqual(len(self.fetches), 2)
+        self.assertEqual(first.read_bytes(), b"two")
+        # Identical content under another key is stored once
+        cache.localize("b@1", self.root / "msg3" / "b.txt", self.fetcher(b"two"))
+        self.assertEqual(len(list(cache.root.joinpath("objects").iterdir())), 2)
+
+    def test_localizeDirectory(self):
+        def fetch(workDir):
+            Path(workDir, "unzipped", "sub").mkdir(parents=True)
+            Path(workDir, "unzipped", "sub", "x").write_text("x")
+            return Success(os.path.join(workDir, "unzipped"))
+        cache = AssetCache(self.root / "cache")
+        target = self.root / "msg" / "dir"
+        self.assertEqual(cache.localize("d@1", target, fetch).value, target)
+        self.assertEqual(target.joinpath("sub", "x").read_text(), "x")
+
+    def test_fetchFailure(self):
+        cache = AssetCache(self.root / "cache")
+        result = cache.localize("a@1", self.root / "a", lambda workDir: Failure("nope"))
+        self.assertEqual(result.reason, "nope")
+        self.assertEqual(list(cache.root.joinpath("objects").iterdir()), [])
+        self.assertEqual(list(cache.root.joinpath("tmp").iterdir()), [])
+
+    def test_evict(self):
+        cache = AssetCache(self.root / "cache", maxBytes=250)
+        target = self.root / "msg" / "asset"
+        for key in ["a", "b"]:
+            cache.localize(key, target, self.fetcher(key.encode() * 100))
+        # Using "a" makes "b" the least recently used
+        past = time.time() - 60
+        os.utime(next(cache.root.joinpath("objects").iterdir()), (past, past))
+        cache.localize("a", target, self.fetcher(b"a" * 100))
+        cache.localize("c", target, self.fetcher(b"c" * 100))
+        self.assertLessEqual(cache.size(), 250)
+        self.assertEqual(len(self.fetches), 3)
+        cache.localize("a", target, self.fetcher(b"a" * 100))
+        self.assertEqual(len(self.fetches), 3)
+        cache.localize("b", target, self.fetcher(b"b" * 100))
+        self.assertEqual(len(self.fetches), 4)
+
+    def test_oversized(self):
+        cache = AssetCache(self.root / "cache", maxBytes=10)
+        target = self.root / "msg" / "asset"
+        result = cache.localize("big", target, self.fetcher(b"x" * 100))
+        self.assertEqual(result.value, target)
+        self.assertEqual(target.read_bytes(), b"x" * 100)
+        # The entry being served stays, even though it alone is over the cap
+        cache.localize("big", self.root / "msg2" / "asset", self.fetcher(b"x" * 100))
+        self.assertEqual(len(self.fetches), 1)
+        # ...until something else is served
+        other = self.root / "msg3" / "asset"
+        cache.localize("other", other, self.fetcher(b"y" * 100))
+        self.assertEqual(other.read_bytes(), b"y" * 100)
+        self.assertEqual(cache.size(), 100)
+
+    def test_evictedAfterLookup(self):
+        cache = AssetCache(self.root / "cache")
+        cache.localize("a", self.root / "first", self.fetcher(b"a"))
+        # Another process evicts the object between our lookup and our link
+        lookup = cache._lookup
+        def lookupThenEvict(keyName):
+            obj = lookup(keyName)
+            if obj is not None and len(self.fetches) == 1:
+                removeTree(obj)
+            return obj
+        cache._lookup = lookupThenEvict
+        target = self.root / "second"
+        self.assertEqual(cache.localize("a", target, self.fetcher(b"a")).value, target)
+        self.assertEqual(target.read_bytes(), b"a")
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_concurrentFetch(self):
+        cache = AssetCache(self.root / "cache")
+        def fetch(workDir):
+            self.fetches.append(workDir)
+            time.sleep(0.2)
+            Path(workDir, "f").write_text("f")
+            return Success(os.path.join(workDir, "f"))
+        threads = [Thread(target=cache.localize, args=("k", self.root / str(n) / "f", fetch))
+                   for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.fetches), 1)
+        self.assertTrue(all((self.root / str(n) / "f").exists() for n in range(4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
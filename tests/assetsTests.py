@@ -0,0 +1,137 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import gzip
+import io
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+from npipes.message.header import S3Asset, AssetSettings, Decompression
+from npipes.assethandlers.assets import *
+from npipes.assethandlers.s3path import S3Path
+from npipes.outcome import Success, Failure
+
+try:
+    try:
+        from moto import mock_aws
+    except ImportError: # moto < 5
+        from moto import mock_s3 as mock_aws
+    haveMoto = True
+except ImportError:
+    haveMoto = False
+
+
+class AssetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_decompressStream(self):
+        # Concatenated gzip members decompress to the concatenated content
+        stream = io.BytesIO(gzip.compress(b"first ") + gzip.compress(b"second"))
+        target = self.dir / "out" / "data.txt"
+        result = decompressStream(stream, STREAM_DECOMPRESSORS[".gz"], target)
+        self.assertEqual(result.value, target)
+        self.assertEqual(target.read_bytes(), b"first second")
+        self.assertTrue(stream.closed)
+
+    def test_decompressStreamCorrupt(self):
+        target = self.dir / "data.txt"
+        result = decompressStream(io.BytesIO(b"not gzip"), STREAM_DECOMPRESSORS[".gz"], target)
+        self.assertIsInstance(result, Failure)
+        self.assertEqual(list(self.dir.iterdir()), [])
+
+    def test_decompressZip(self):
+        archive = self.dir / "a.zip"
+        with zipfile.ZipFile(archive, "w") as z:
+            z.writestr("sub/x.txt", "x")
+        target = self.dir / "unzipped"
+        self.assertEqual(decompress(archive, str(target)).value, str(target))
+        self.assertEqual(target.joinpath("sub", "x.txt").read_text(), "x")
+        self.assertFalse(archive.exists())
+
+    def test_decompressGzipFile(self):
+        archive = self.dir / "a.json.gz"
+        archive.write_bytes(gzip.compress(b"{}"))
+        target = self.dir / "a.json"
+        self.assertEqual(decompress(archive, str(target)).value, str(target))
+        self.assertEqual(target.read_bytes(), b"{}")
+        self.assertFalse(archive.exists())
+
+    def test_renameToLocalTarget(self):
+        src = self.dir / "src"
+        src.joinpath("sub").mkdir(parents=True)
+        src.joinpath("sub", "x").write_text("x")
+        src.joinpath("y").write_text("y")
+        dst = self.dir / "dst"
+        dst.joinpath("sub").mkdir(parents=True)
+        dst.joinpath("sub", "z").write_text("z")
+        renameToLocalTarget(src, str(dst))
+        self.assertEqual(sorted(p.name for p in dst.rglob("*")), ["sub", "x", "y", "z"])
+        self.assertFalse(src.exists())
+        f = self.dir / "f"
+        f.write_text("f")
+        self.assertEqual(renameToLocalTarget(f, str(self.dir / "a" / "g")).value,
+                         str(self.dir / "a" / "g"))
+        self.assertEqual((self.dir / "a" / "g").read_text(), "f")
+
+
+@unittest.skipUnless(haveMoto, "moto is not installed")
+class S3AssetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from npipes.assethandlers import s3utils
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.mock = mock_aws()
+        self.mock.start()
+        # Drop any shared client made outside the mock
+        s3utils.configureTransfers(s3utils.transferSettings.chunkSize,
+                                   s3utils.transferSettings.concurrency)
+        s3utils.s3Client().create_bucket(Bucket="bucket")
+        s3utils.uploadData(gzip.compress(b"hello"), "s3://bucket/in/hello.txt.gz")
+        zipped = io.BytesIO()
+        with zipfile.ZipFile(zipped, "w") as z:
+            z.writestr("x.txt", "x")
+        s3utils.uploadData(zipped.getvalue(), "s3://bucket/in/files.zip")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.mock.stop()
+        self.tmp.cleanup()
+
+    def asset(self, path, localTarget=""):
+        return S3Asset(S3Path(path), AssetSettings("a", Decompression(True), localTarget))
+
+    def test_localizeGzip(self):
+        result = localizeAsset(self.asset("s3://bucket/in/hello.txt.gz", "hello.txt"), str(self.dir))
+        self.assertEqual(result.value, str(self.dir / "hello.txt"))
+        self.assertEqual((self.dir / "hello.txt").read_text(), "hello")
+        self.assertEqual(os.listdir(self.dir), ["hello.txt"])
+
+    def test_localizeZip(self):
+        result = localizeAsset(self.asset("s3://bucket/in/files.zip", "files"), str(self.dir))
+        self.assertEqual(result.value, str(self.dir / "files"))
+        self.assertEqual((self.dir / "files" / "x.txt").read_text(), "x")
+        self.assertEqual(os.listdir(self.dir), ["files"])
+
+    def test_localizeCached(self):
+        from npipes.assethandlers.assetcache import AssetCache
+        cache = AssetCache(self.dir / "cache")
+        asset = self.asset("s3://bucket/in/hello.txt.gz", "hello.txt")
+        for msg in ["m1", "m2"]:
+            result = localizeAsset(asset, str(self.dir / msg), cache)
+            self.assertEqual(Path(result.value).read_text(), "hello")
+        self.assertEqual((self.dir / "m1" / "hello.txt").stat().st_ino,
+                         (self.dir / "m2" / "hello.txt").stat().st_ino)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import os
+import threading
+from unittest.mock import patch
+
+from npipes.message.header import Message, Header, Step, BodyInString
+from npipes import awsclients
+from npipes.awsclients import *
+from npipes.outcome import Success, Failure
+
+try:
+    try:
+        from moto import mock_aws
+    except ImportError: # moto < 5
+        from moto import mock_sqs as mock_aws
+    haveMoto = True
+except ImportError:
+    haveMoto = False
+
+
+@unittest.skipUnless(haveMoto, "moto is not installed")
+class AwsClientsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.mock = mock_aws()
+        self.mock.start()
+        forget("sqs")
+        self.url = client("sqs").create_queue(QueueName="q")["QueueUrl"]
+
+    def tearDown(self):
+        forget("sqs")
+        self.mock.stop()
+
+    def test_sharedAcrossThreads(self):
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(client("sqs")))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(map(id, clients))), 1)
+        self.assertIs(clients[0], client("sqs"))
+
+    def test_forget(self):
+        old = client("sqs")
+        forget("sqs")
+        self.assertIsNot(client("sqs"), old)
+
+    def test_newClientsAfterFork(self):
+        old = client("sqs")
+        with patch.object(awsclients, "_pid", -1):
+            self.assertIsNot(client("sqs"), old)
+
+    def test_queueUrlLookedUpOnce(self):
+        sqs = client("sqs")
+        with patch.object(sqs, "get_queue_url", wraps=sqs.get_queue_url) as lookup:
+            self.assertEqual(queueUrl("q"), self.url)
+            self.assertEqual(queueUrl("q"), self.url)
+        self.assertEqual(lookup.call_count, 1)
+
+    def test_sendAndReceive(self):
+        from npipes.triggers.sqs import sendMessage
+        from npipes.producers.sqs import ProducerSqs
+        message = Message(Header(steps=[Step("next")]), BodyInString("hello"))
+        self.assertIsInstance(sendMessage("q", "s3://bucket/overflow", message), Success)
+        deliveries = ProducerSqs("q").deliveries()
+        delivery = next(deliveries)
+        self.assertEqual(delivery.message.body.string, "hello")
+        delivery.settle(Success(None))
+        deliveries.close() # Sends the acknowledgement
+        attributes = client("sqs").get_queue_attributes(
+            QueueUrl=self.url, AttributeNames=["ApproximateNumberOfMessages",
+                                               "ApproximateNumberOfMessagesNotVisible"])
+        self.assertEqual(set(attributes["Attributes"].values()), {"0"})
+
+
+if __name__ == '__main__':
+    unittest.main()
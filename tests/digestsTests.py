@@ -0,0 +1,78 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+from npipes.assethandlers.digests import *
+
+
+class DigestsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = Path(self.tmp.name, "data")
+        self.data = os.urandom(2500)
+        self.file.write_bytes(self.data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_multipartEtag(self):
+        parts = [self.data[:1000], self.data[1000:2000], self.data[2000:]]
+        expected = hashlib.md5(b"".join(hashlib.md5(p).digest() for p in parts)).hexdigest()
+        self.assertEqual(multipartEtag(self.file, 1000), f"{expected}-3")
+        self.assertTrue(isMultipartEtag(f"{expected}-3"))
+        self.assertEqual(etagParts(f"{expected}-3"), 3)
+        self.assertFalse(isMultipartEtag(fileMd5(self.file)))
+
+    def test_digestIndex(self):
+        index = DigestIndex()
+        calls = []
+        def compute(pth):
+            calls.append(pth)
+            return fileMd5(pth)
+        self.assertEqual(index.digest(self.file, "md5", compute), hashlib.md5(self.data).hexdigest())
+        index.digest(self.file, "md5", compute)
+        self.assertEqual(len(calls), 1)
+        # Another kind of digest is computed separately
+        index.etag(self.file, 1000)
+        self.assertEqual(index.lookup(self.file, "etag:1000"), multipartEtag(self.file, 1000))
+        # A changed file is hashed again
+        self.file.write_bytes(b"changed")
+        self.assertEqual(index.digest(self.file, "md5", compute), hashlib.md5(b"changed").hexdigest())
+        self.assertEqual(len(calls), 2)
+
+    def test_digestIndexBounded(self):
+        index = DigestIndex(maxFiles=2)
+        files = [Path(self.tmp.name, str(n)) for n in range(3)]
+        for f in files:
+            f.write_text(f.name)
+            index.md5(f)
+        self.assertIsNone(index.lookup(files[0], "md5"))
+        self.assertIsNotNone(index.lookup(files[2], "md5"))
+
+    def test_isCurrent(self):
+        from npipes.assethandlers import s3utils
+        def remote(etag, size=2500, md5=""):
+            return s3utils.RemoteObject("bucket", "key", etag, size, md5)
+        md5 = hashlib.md5(self.data).hexdigest()
+        self.assertTrue(s3utils.isCurrent(remote(md5), self.file))
+        self.assertFalse(s3utils.isCurrent(remote(md5, size=2501), self.file))
+        self.assertFalse(s3utils.isCurrent(remote("0" * 32), self.file))
+        self.assertTrue(s3utils.isCurrent(remote("0" * 32, md5=md5), self.file))
+        self.assertFalse(s3utils.isCurrent(remote(md5), Path(self.tmp.name, "missing")))
+        self.assertFalse(s3utils.isCurrent(None, self.file))
+        etag = multipartEtag(self.file, 1000)
+        with patch.object(s3utils, "remotePartSize", return_value=1000):
+            self.assertTrue(s3utils.isCurrent(remote(etag), self.file))
+        with patch.object(s3utils, "remotePartSize", return_value=1024):
+            self.assertFalse(s3utils.isCurrent(remote(etag), self.file))
+
+
+if __name__ == '__main__':
+    unittest.main()
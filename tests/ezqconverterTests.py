@@ -3,7 +3,7 @@
 import unittest
 import time
 # from npipes.message.ezqconverter import *
-from npipes.message.header import Message
+from npipes.message.header import Message, Header, Step, Command, BodyInBytes
 from npipes.message.ezqconverter import convertFromEZQ, convertToEZQ
 
 class EZQConverterTestCase(unittest.TestCase):
@@ -34,6 +34,15 @@ class EZQConverterTestCase(unittest.TestCase):
             with convertFromEZQ(Message, msgstr) as msg:
                 print(convertToEZQ(msg))
 
+    def test_binaryBodyRoundTrip(self):
+        for data in [b"\x89PNG\r\n\x1a\n\xff\x00", "plain \u00e9".encode()]:
+            msg = Message(Header(steps=[Step("0", command=Command(["cat"]))]), BodyInBytes(data))
+            with convertFromEZQ(Message, convertToEZQ(msg)) as converted:
+                if data.startswith(b"plain"):
+                    self.assertEqual(converted.body.string, data.decode())
+                else:
+                    self.assertEqual(converted.body, BodyInBytes(data))
+
 
 
 if __name__ == '__main__':
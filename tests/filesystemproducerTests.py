@@ -0,0 +1,147 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from npipes.message.header import Message, Header, Step, BodyInString
+from npipes.producers.filesystem import ProducerFilesystem
+from npipes.triggers.filesystem import sendMessage
+from npipes.utils import inotify
+from npipes.outcome import Success, Failure
+
+
+def writeMessage(dir, name, text, mtime=None):
+    path = Path(dir, name)
+    path.write_text(Message(Header(steps=[Step("s")]), BodyInString(text)).toJsonLines())
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+class ProducerFilesystemTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.puller = ThreadPoolExecutor(max_workers=1)
+
+    def tearDown(self):
+        self.puller.shutdown(wait=False)
+        self.tmp.cleanup()
+
+    def nextWithin(self, deliveries, seconds):
+        return self.puller.submit(next, deliveries).result(seconds)
+
+    def bodies(self, producer):
+        bodies = []
+        for delivery in producer.deliveries():
+            bodies.append(delivery.message.body.string)
+            delivery.settle(Success(None))
+        return bodies
+
+    def test_mtimeOrder(self):
+        now = time.time()
+        for name, age in [("a", 10), ("b", 30), ("c", 20)]:
+            writeMessage(self.dir, name, name, now - age)
+        writeMessage(self.dir, ".hidden", "hidden")
+        producer = ProducerFilesystem(self.dir, quitWhenEmpty=True)
+        self.assertEqual(self.bodies(producer), ["b", "c", "a"])
+
+    def test_removeSuccesses(self):
+        writeMessage(self.dir, "a", "a")
+        self.bodies(ProducerFilesystem(self.dir, quitWhenEmpty=True, removeSuccesses=True))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    @unittest.skipIf(inotify.watch(".", inotify.IN_MOVED_TO) is None, "inotify is unavailable")
+    def test_inotify(self):
+        writeMessage(self.dir, "first", "first")
+        deliveries = ProducerFilesystem(self.dir, refreshInterval=60).deliveries()
+        self.assertEqual(self.nextWithin(deliveries, 5).message.body.string, "first")
+        start = time.monotonic()
+        threading.Timer(0.2, sendMessage, (self.dir, Message(Header(steps=[Step("s")]),
+                                                             BodyInString("second")))).start()
+        self.assertEqual(self.nextWithin(deliveries, 5).message.body.string, "second")
+        # Picked up as soon as it was written, long before a rescan would
+        self.assertLess(time.monotonic() - start, 5)
+        deliveries.close()
+
+    @unittest.skipIf(inotify.watch(".", inotify.IN_MOVED_TO) is None, "inotify is unavailable")
+    def test_releaseRequeues(self):
+        writeMessage(self.dir, "a", "a")
+        deliveries = ProducerFilesystem(self.dir, refreshInterval=0.1).deliveries()
+        self.nextWithin(deliveries, 5).settle(None)
+        # No new event arrives for the unchanged file, yet it is handed out again
+        again = self.nextWithin(deliveries, 5)
+        self.assertEqual(again.message.body.string, "a")
+        again.settle(Success(None))
+        deliveries.close()
+
+    def test_close(self):
+        for useInotify in [True, False]:
+            with self.subTest(useInotify=useInotify):
+                producer = ProducerFilesystem(self.dir, refreshInterval=0.1,
+                                              useInotify=useInotify)
+                pending = self.puller.submit(next, producer.deliveries(), None)
+                time.sleep(0.3)
+                producer.close()
+                # The idle producer stops waiting for files
+                self.assertIsNone(pending.result(5))
+
+    def test_rescan(self):
+        writeMessage(self.dir, "first", "first")
+        deliveries = ProducerFilesystem(self.dir, refreshInterval=0.1,
+                                        useInotify=False).deliveries()
+        first = self.nextWithin(deliveries, 5)
+        writeMessage(self.dir, "second", "second")
+        self.assertEqual(self.nextWithin(deliveries, 5).message.body.string, "second")
+        # A file that is removed and later written again is a new message
+        third = self.puller.submit(next, deliveries)
+        Path(self.dir, "first").unlink()
+        first.settle(Success(None))
+        time.sleep(0.3)
+        writeMessage(self.dir, "first", "again")
+        self.assertEqual(third.result(5).message.body.string, "again")
+
+    def test_claim(self):
+        writeMessage(self.dir, "a", "a")
+        writeMessage(self.dir, "b", "b")
+        producer = ProducerFilesystem(self.dir, quitWhenEmpty=True, claim=True, workerId="w1")
+        for delivery in producer.deliveries():
+            self.assertEqual(sorted(os.listdir(Path(self.dir, "inflight", "w1"))),
+                             [".lease", delivery.message.body.string])
+            delivery.settle(Success(None) if delivery.message.body.string == "a"
+                            else Failure("b fails"))
+        self.assertEqual(os.listdir(Path(self.dir, "done")), ["a"])
+        self.assertEqual(os.listdir(Path(self.dir, "failed")), ["b"])
+
+    def test_claimIsExclusive(self):
+        for n in range(50):
+            writeMessage(self.dir, str(n), str(n))
+        producers = [ProducerFilesystem(self.dir, quitWhenEmpty=True, claim=True,
+                                        removeSuccesses=True, workerId=f"w{n}")
+                     for n in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            bodies = list(pool.map(self.bodies, producers))
+        everything = [b for bs in bodies for b in bs]
+        self.assertEqual(sorted(everything, key=int), [str(n) for n in range(50)])
+
+    def test_leaseRecovery(self):
+        dead = Path(self.dir, "inflight", "dead")
+        dead.mkdir(parents=True)
+        writeMessage(dead, "x", "x")
+        dead.joinpath(".lease").touch()
+        old = time.time() - 100
+        os.utime(dead / ".lease", (old, old))
+        producer = ProducerFilesystem(self.dir, quitWhenEmpty=True, claim=True,
+                                      removeSuccesses=True, leaseSeconds=10)
+        self.assertEqual(self.bodies(producer), ["x"])
+        self.assertFalse(dead.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
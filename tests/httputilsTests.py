@@ -0,0 +1,197 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from unittest.mock import patch
+
+from npipes.message.header import UriAsset, AssetSettings, Decompression
+from npipes.assethandlers import httputils
+from npipes.assethandlers.httputils import *
+from npipes.assethandlers.assets import localizeAsset
+from npipes.assethandlers.assetcache import AssetCache
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    """Serves *files* (path -> bytes) with ETags, Range and If-Range support.
+       Records each request as (method, path, headers, status).
+    """
+    daemon_threads = True
+
+    def __init__(self, files):
+        self.files = files
+        self.log = []
+        self.dropAfter = None # Cut the next full response off after this many bytes
+        self.delay = 0
+        self.active = 0
+        self.maxActive = 0
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), FileHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, headers, body=b""):
+        self.server.log.append((self.command, self.path, dict(self.headers), status))
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command == "GET":
+            drop = self.server.dropAfter
+            if drop is not None and status == 200:
+                self.server.dropAfter = None
+                self.wfile.write(body[:drop])
+                self.wfile.flush()
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.maxActive = max(self.server.maxActive, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            self.serve()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def serve(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.respond(404, {"Content-Length": "0"})
+            return
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        if self.headers.get("If-None-Match") == etag:
+            self.respond(304, {**headers, "Content-Length": "0"})
+            return
+        rng = self.headers.get("Range")
+        if rng and self.headers.get("If-Range", etag) == etag:
+            first, last = rng[len("bytes="):].split("-")
+            first, last = int(first), int(last) if last else len(data) - 1
+            part = data[first:last + 1]
+            self.respond(206, {**headers, "Content-Length": str(len(part)),
+                               "Content-Range": f"bytes {first}-{last}/{len(data)}"}, part)
+        else:
+            self.respond(200, {**headers, "Content-Length": str(len(data))}, data)
+
+
+class HttpUtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(10000)
+        self.server = FileServer({"/data.bin": self.data,
+                                  "/hello.txt.gz": gzip.compress(b"hello")})
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        configureHttp(4, 8)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def gets(self):
+        return [(path, status, headers.get("Range"))
+                for method, path, headers, status in self.server.log if method == "GET"]
+
+    def test_downloadFile(self):
+        target = self.dir / "data.bin"
+        self.assertEqual(downloadFile(self.server.url("/data.bin"), target).value, target)
+        self.assertEqual(target.read_bytes(), self.data)
+        self.assertEqual(self.gets(), [("/data.bin", 200, None)])
+        # The second time, the server confirms the copy is current
+        self.assertEqual(downloadFile(self.server.url("/data.bin"), target).value, target)
+        self.assertEqual(self.gets()[-1], ("/data.bin", 304, None))
+        self.assertEqual(len(self.gets()), 2)
+
+    def test_downloadChanged(self):
+        target = self.dir / "data.bin"
+        downloadFile(self.server.url("/data.bin"), target)
+        self.server.files["/data.bin"] = b"changed"
+        self.server.log.clear()
+        self.assertEqual(downloadFile(self.server.url("/data.bin"), target).value, target)
+        self.assertEqual(target.read_bytes(), b"changed")
+        # The conditional GET brings the new version; nothing else is requested
+        self.assertEqual([(method, status) for method, _, _, status in self.server.log],
+                         [("GET", 200)])
+        self.assertEqual(downloadFile(self.server.url("/data.bin"), target).value, target)
+        self.assertEqual(self.gets()[-1], ("/data.bin", 304, None))
+
+    def test_downloadMissing(self):
+        result = downloadFile(self.server.url("/missing"), self.dir / "missing")
+        self.assertIsInstance(result, Failure)
+        self.assertEqual(list(self.dir.iterdir()), [])
+
+    def test_downloadInRanges(self):
+        target = self.dir / "data.bin"
+        with patch.object(httputils, "httpSettings", HttpSettings(chunkSize=1024)):
+            downloadFile(self.server.url("/data.bin"), target)
+        self.assertEqual(target.read_bytes(), self.data)
+        self.assertEqual(len(self.gets()), 10)
+        self.assertTrue(all(status == 206 for _, status, _ in self.gets()))
+
+    def test_resume(self):
+        data = os.urandom(1000000)
+        self.server.files["/big.bin"] = data
+        self.server.dropAfter = 300000
+        target = self.dir / "big.bin"
+        self.assertEqual(downloadFile(self.server.url("/big.bin"), target).value, target)
+        self.assertEqual(target.read_bytes(), data)
+        (_, first, _), (_, second, rng) = self.gets()
+        self.assertEqual((first, second), (200, 206))
+        self.assertGreater(int(rng[len("bytes="):-1]), 0)
+
+    def test_perHost(self):
+        configureHttp(4, 2)
+        self.server.delay = 0.1
+        threads = [threading.Thread(target=downloadFile,
+                                    args=(self.server.url("/data.bin"), self.dir / str(n)))
+                   for n in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.server.maxActive, 2)
+        self.assertTrue(all((self.dir / str(n)).read_bytes() == self.data for n in range(6)))
+
+    def test_localizeStreamed(self):
+        asset = UriAsset(self.server.url("/hello.txt.gz"),
+                         AssetSettings("h", Decompression(True), "hello.txt"))
+        result = localizeAsset(asset, str(self.dir))
+        self.assertEqual(Path(result.value).read_text(), "hello")
+        self.assertEqual(os.listdir(self.dir), ["hello.txt"])
+
+    def test_localizeCached(self):
+        cache = AssetCache(self.dir / "cache")
+        asset = UriAsset(self.server.url("/data.bin"), AssetSettings("d"))
+        for msg in ["m1", "m2"]:
+            result = localizeAsset(asset, str(self.dir / msg), cache)
+            self.assertEqual(Path(result.value).read_bytes(), self.data)
+        self.assertEqual(len(self.gets()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import threading
+import time
+
+from npipes.iopool import *
+from npipes.outcome import Success, Failure
+
+
+def waitForCancel(seconds):
+    """Loops like a download does until cancelled, or gives up after *seconds*
+    """
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        checkCancelled()
+        time.sleep(0.01)
+    return Success("finished")
+
+
+class IOPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = IOPool(maxWorkers=4)
+
+    def test_mapOutcomes(self):
+        results = self.pool.mapOutcomes(lambda x: Success(x * 2), [1, 2, 3])
+        self.assertEqual([r.value for r in results], [2, 4, 6])
+        self.assertEqual(self.pool.mapOutcomes(Success, []), [])
+
+    def test_failureCancelsSiblings(self):
+        def op(x):
+            if x == "bad":
+                return Failure("bad asset")
+            return waitForCancel(10)
+        start = time.monotonic()
+        results = self.pool.mapOutcomes(op, ["a", "bad", "b"])
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(results[1].reason, "bad asset")
+        self.assertIsInstance(results[0], Failure)
+        self.assertIsInstance(results[2], Failure)
+
+    def test_timeout(self):
+        self.pool.configure(4, 0.2)
+        cancelled = threading.Event()
+        def op(x):
+            try:
+                return waitForCancel(10)
+            except Cancelled:
+                cancelled.set()
+                raise
+        results = self.pool.mapOutcomes(op, [1])
+        self.assertIn("Timed out", results[0].reason)
+        self.assertTrue(cancelled.wait(5))
+
+    def test_exceptionIsFailure(self):
+        result = self.pool.call(lambda: 1 / 0)
+        self.assertIn("division by zero", result.reason)
+
+    def test_tokenCarriedToThreads(self):
+        token = CancelToken()
+        token.cancel()
+        def inner():
+            return runWithToken(currentToken(), checkCancelled)
+        self.assertRaises(Cancelled, runWithToken, token, inner)
+        self.assertIsNone(currentToken())
+
+
+if __name__ == '__main__':
+    unittest.main()
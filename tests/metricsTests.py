@@ -0,0 +1,62 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import json
+import os
+import urllib.request
+from pathlib import Path
+
+from npipes.metrics import *
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        ordered = [float(x) for x in range(1, 101)]
+        self.assertEqual(percentile(ordered, 50), 50.0)
+        self.assertEqual(percentile(ordered, 95), 95.0)
+        self.assertEqual(percentile(ordered, 99), 99.0)
+        self.assertEqual(percentile([3.0], 99), 3.0)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_timed(self):
+        m = Metrics()
+        for nbytes in [10, 20]:
+            with m.timed("stage") as sample:
+                sample.bytes = nbytes
+        self.assertEqual(m.call("other", max, 1, 2), 2)
+        m.countMessage(True)
+        m.countMessage(False)
+        summary = m.summary()
+        self.assertEqual(summary["stages"]["stage"]["count"], 2)
+        self.assertEqual(summary["stages"]["stage"]["bytes"], 30)
+        self.assertEqual(summary["stages"]["other"]["count"], 1)
+        self.assertEqual(summary["messages"]["succeeded"], 1)
+        self.assertEqual(summary["messages"]["failed"], 1)
+
+    def test_writeMetricsFile(self):
+        m = Metrics()
+        m.record("stage", 0.5, 100)
+        try:
+            writeMetricsFile("tests/metrics.json", m)
+            written = json.loads(Path("tests/metrics.json").read_text())
+            self.assertEqual(written["stages"]["stage"]["p50"], 0.5)
+        finally:
+            os.remove("tests/metrics.json")
+
+    def test_serveMetrics(self):
+        m = Metrics()
+        m.record("stage", 0.25)
+        server = serveMetrics(0, m)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            served = json.loads(urllib.request.urlopen(url).read())
+            self.assertEqual(served["stages"]["stage"]["p99"], 0.25)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
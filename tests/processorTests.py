@@ -3,10 +3,15 @@
 import unittest
 
 import os
+import shutil
+import sys
 from itertools import chain
 from pathlib import Path
 import textwrap
+import threading
+import time
 import warnings
+from unittest.mock import patch
 
 import boto3
 import yaml
@@ -14,8 +19,74 @@ import yaml
 from npipes.processor import *
 from npipes.outcome import *
 from npipes.message.header import *
+from npipes.producers.producer import Producer
 from npipes.producers.filesystem import ProducerFilesystem
-
+from npipes import persistentworker
+from npipes.persistentworker import runPersistentCommand
+from npipes.supervision import runningProcesses
+from npipes.outputspool import OutputSpool, SpilledOutput
+from npipes.utils.autodeleter import AutoDeleter
+from npipes.utils.compressionutils import toGzB64
+from npipes.metrics import metrics
+from npipes.asyncprocessor import runMessageProducerAsync
+
+# A tiny persistent worker: replies with its pid and the body it was sent,
+# and exits if the body is "crash"
+PERSISTENT_ECHO = textwrap.dedent("""
+    import os, struct, sys
+    def read():
+        head = sys.stdin.buffer.read(4)
+        if len(head) < 4:
+            sys.exit(0)
+        return sys.stdin.buffer.read(struct.unpack(">I", head)[0])
+    def write(b):
+        sys.stdout.buffer.write(struct.pack(">I", len(b)) + b)
+    while True:
+        header, body = read(), read()
+        if body == b"crash":
+            sys.exit(1)
+        write(b"0")
+        write(str(os.getpid()).encode() + b":" + body)
+        sys.stdout.flush()
+    """)
+
+# A persistent worker that starts a long-lived child, writes the child's pid
+# to the file named in the body, and then hangs without replying; or, if the
+# body is "close", closes its stdout but doesn't exit
+PERSISTENT_HANG = textwrap.dedent("""
+    import os, struct, subprocess, sys, time
+    def read():
+        return sys.stdin.buffer.read(struct.unpack(">I", sys.stdin.buffer.read(4))[0])
+    header, body = read(), read()
+    if body == b"close":
+        os.close(1)
+    else:
+        child = subprocess.Popen(["sleep", "60"])
+        with open(body, "w") as f:
+            f.write(str(child.pid))
+    time.sleep(60)
+    """)
+
+
+class StuckProducer(Producer):
+    """Never yields a message, and ignores *close*"""
+    def deliveries(self):
+        threading.Event().wait()
+        yield from ()
+
+
+def processGone(pid, within=5):
+    """True if process *pid* is gone (or a zombie) within *within* seconds"""
+    deadline = time.monotonic() + within
+    while time.monotonic() < deadline:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                if f.read().rsplit(")", 1)[1].split()[0] == "Z":
+                    return True
+        except FileNotFoundError:
+            return True
+        time.sleep(0.05)
+    return False
 
 
 class ProcessorTestCase(unittest.TestCase):
@@ -41,6 +112,68 @@ class ProcessorTestCase(unittest.TestCase):
         res = runCommand(command, "")
         self.assertEqual(res.value, "1\n2\n3\n")
 
+    def test_runProcess_spooled(self):
+        command = Command(["ls","tests/static"], outputChannel=OutputChannelStdout())
+        small = runProcess(command, None, None, OutputSpool(16, "tests/spooled"))
+        self.assertEqual(small.value, "1\n2\n3\n")
+        large = runProcess(command, None, None, OutputSpool(4, "tests/spooled"))
+        try:
+            self.assertEqual(large.value, SpilledOutput("tests/spooled"))
+            self.assertEqual(large.value.read(), "1\n2\n3\n")
+        finally:
+            os.remove("tests/spooled")
+
+    def test_runPersistentCommand(self):
+        command = Command([sys.executable, "-c", PERSISTENT_ECHO],
+                          persistence=Persistence(True, maxMessages=2))
+        key = toJson(command)
+        pid1, out1 = runPersistentCommand(key, command, "{}", "one").value.split(":")
+        pid2, out2 = runPersistentCommand(key, command, "{}", "two").value.split(":")
+        pid3, out3 = runPersistentCommand(key, command, "{}", "three").value.split(":")
+        self.assertEqual([out1, out2, out3], ["one", "two", "three"])
+        self.assertEqual(pid1, pid2)
+        self.assertNotEqual(pid2, pid3) # restarted after maxMessages
+
+    def test_runPersistentCommand_crash(self):
+        command = Command([sys.executable, "-c", PERSISTENT_ECHO],
+                          persistence=Persistence(True))
+        key = toJson(command)
+        self.assertTrue(failed(runPersistentCommand(key, command, "{}", "crash")))
+        self.assertEqual(runPersistentCommand(key, command, "{}", "after").value.split(":")[1],
+                         "after")
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "needs /proc")
+    def test_runPersistentCommand_timeoutKillsGroup(self):
+        command = Command([sys.executable, "-c", PERSISTENT_HANG], timeout=1,
+                          persistence=Persistence(True))
+        pidFile = os.path.abspath("tests/persistentChild")
+        try:
+            result = runPersistentCommand(toJson(command), command, "{}", pidFile)
+            self.assertIn("timed out", result.reason)
+            with open(pidFile) as f:
+                self.assertTrue(processGone(int(f.read())))
+        finally:
+            os.remove(pidFile)
+
+    def test_runPersistentCommand_closedStdout(self):
+        command = Command([sys.executable, "-c", PERSISTENT_HANG],
+                          persistence=Persistence(True))
+        start = time.monotonic()
+        with patch.object(persistentworker, "EXIT_SECONDS", 0.5):
+            result = runPersistentCommand(toJson(command), command, "{}", "close")
+        self.assertIn("exited with code", result.reason)
+        self.assertLess(time.monotonic() - start, 30)
+
+    @unittest.skipUnless(os.path.isdir("/proc"), "needs /proc")
+    def test_persistentWorkerKilledOnShutdown(self):
+        command = Command([sys.executable, "-c", PERSISTENT_ECHO],
+                          persistence=Persistence(True))
+        pid, _ = runPersistentCommand(toJson(command), command, "{}", "x").value.split(":")
+        # Leads a process group of its own, so the group can be killed as a whole
+        self.assertEqual(os.getpgid(int(pid)), int(pid))
+        runningProcesses.killAll()
+        self.assertTrue(processGone(int(pid)))
+
     def test_scrapeOutput_OCStdout(self):
         command = Command([], outputChannel=OutputChannelStdout())
         self.assertEqual( scrapeOutput(command, "this").value, "this" )
@@ -77,6 +210,18 @@ class ProcessorTestCase(unittest.TestCase):
         co = expandCommand(fancyCommand, assets, bodystr, "", "", "", os.getpid())
         self.assertEqual(co, fancyCommandExpectation)
 
+    def test_expandCommand_bodyfiles(self):
+        command = Command(["cat", "${bodyfiles}", "${bodyfile}"])
+        co = expandCommand(command, [], "", "b1", "", "", 0, bodyfiles=["b1", "b2"])
+        self.assertEqual(co.arglist, ["cat", "b1", "b2", "b1"])
+        co = expandCommand(command, [], "", "b1", "", "", 0)
+        self.assertEqual(co.arglist, ["cat", "b1", "b1"])
+
+    def test_splitOutput(self):
+        self.assertEqual(splitOutput("a\nb\n", "\n", 2).value, ["a", "b"])
+        self.assertEqual(splitOutput("a\n\n", "\n", 2).value, ["a", ""])
+        self.assertTrue(failed(splitOutput("a\nb\nc", "\n", 2)))
+
     @unittest.skip("Implement later")
     def test_triggerNextStep(self):
         pass
@@ -99,6 +244,23 @@ class ProcessorTestCase(unittest.TestCase):
     def test_extractBody(self):
         pass
 
+    def test_extractBody_binary(self):
+        self.assertEqual(extractBody(BodyInBytes(b"\xff\x00"), [], binary=True), b"\xff\x00")
+        self.assertEqual(extractBody(BodyInString("text"), [], binary=True), b"text")
+        self.assertEqual(extractBody(BodyInBytes(b"text"), []), "text")
+        zipped = BodyInString(toGzB64("zipped \u00e9").decode(), EncodingGzB64())
+        self.assertEqual(extractBody(zipped, [], binary=True), "zipped \u00e9".encode())
+        self.assertEqual(extractBody(zipped, []), "zipped \u00e9")
+
+    def test_runCommand_binary(self):
+        command = Command(["cat"], inputChannelStdin=True, binaryInput=True, binaryOutput=True)
+        self.assertEqual(runCommand(command, b"\x00\xff\xfe").value, b"\x00\xff\xfe")
+
+    def test_makeMessage_binary(self):
+        msg = makeMessage(b"\x89PNG\r\n", Header()).value
+        self.assertEqual(msg.body, BodyInBytes(b"\x89PNG\r\n"))
+        self.assertEqual(Message.fromJsonLines(msg.toJsonLines()), msg)
+
     def test_runMessageProducer(self):
         """Tests against a filesystem producer"""
 
@@ -141,6 +303,208 @@ class ProcessorTestCase(unittest.TestCase):
         for msg in expectedMessages:
             self.assertTrue(msg in results)
 
+    def runFilesystemPipeline(self, config, count, transform=lambda body: body,
+                              run=runMessageProducer):
+        """Runs *count* messages through a filesystem producer using *config*,
+           and checks that every message made it through, having had its body
+           changed by *transform*, and was acked"""
+        testIn = "tests/fsp"
+        testOut = "tests/fsp/results"
+        for f in chain(Path(testIn).glob("*"), Path(testOut).glob("*")):
+            if f.is_file():
+                f.unlink()
+
+        producer = ProducerFilesystem("tests/fsp", quitWhenEmpty=True,
+                                      removeSuccesses=True, removeFailures=True)
+        step1 = Step("step one", command=Command(["cat", "${bodyfile}"]))
+        step2 = Step("terminus", trigger=TriggerFilesystem("tests/fsp/results"))
+        header = Header(steps = [step1, step2])
+        for x in range(1, count + 1):
+            msg = Message(header, BodyInString("Message {}".format(x)))
+            Path("tests/fsp").joinpath("{}".format(x)).write_text(msg.toJsonLines())
+
+        run(config, producer)
+
+        results = [Message.fromJsonLines(p.read_text()) for p in Path(testOut).glob("*")]
+        expectedMessages = list(map(lambda m: Message(Header(steps=[step2]),
+                                                      BodyInString(transform("Message {}".format(m)))),
+                                    range(1, count + 1)))
+        self.assertEqual(len(results), len(expectedMessages))
+        for msg in expectedMessages:
+            self.assertTrue(msg in results)
+        # Every message was acked, and every scratch directory cleaned up
+        self.assertEqual([f for f in Path(testIn).glob("*") if f.is_file()], [])
+        self.assertEqual(list(Path(".npipes_scratch").glob("*")), [])
+
+    def test_runMessageProducerConcurrently(self):
+        """Tests against a filesystem producer with several messages in flight"""
+        self.runFilesystemPipeline(Configuration(lockCommand=False, concurrency=3), 8)
+
+    def test_runMessageProducerSpooled(self):
+        """Output spooled to disk without an overflowPath is read back in"""
+        self.runFilesystemPipeline(Configuration(lockCommand=False, spoolThreshold=4), 3)
+        self.runFilesystemPipeline(Configuration(lockCommand=False, spoolThreshold=4,
+                                                 concurrency=2),
+                                   3, run=runMessageProducerAsync)
+
+    def test_runMessageProducerMemfd(self):
+        """Body files backed by memfds, where the platform has them"""
+        self.runFilesystemPipeline(Configuration(lockCommand=False, tempFiles="memfd"), 3)
+
+    def test_writeTempFile(self):
+        config = Configuration(tempFiles="memfd")
+        with AutoDeleter() as deleter:
+            unused = writeTempFile(config, Command(["cat"]), ["bodyfile"], "x", "", deleter)
+            self.assertEqual(unused, "")
+            extended = writeTempFile(config, Command(["cp", "${bodyfile}", "${bodyfile}.out"]),
+                                     ["bodyfile"], "x", "", deleter)
+            self.assertTrue(Path(extended).is_file())
+            self.assertFalse(extended.startswith("/proc/"))
+        self.assertFalse(Path(extended).exists())
+
+    def test_stepTimeout(self):
+        """An overrunning Step is failed, along with everything its Command started"""
+        step = Step("slow", command=Command(["sh", "-c", "sleep 30 & wait"]), stepTimeout=1)
+        msg = Message(Header(steps=[step, Step("terminus")]), BodyInString(""))
+        start = time.monotonic()
+        result = handleMessage(Configuration(lockCommand=False), msg)
+        self.assertTrue(result.reason.endswith("Command timed out"))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_runMessageProducerStop(self):
+        """Stopping releases running and read-ahead messages within the grace period"""
+        self.runStoppedPipeline(runMessageProducer)
+        self.runStoppedPipeline(runMessageProducerAsync)
+
+    def test_runMessageProducerStopKeepsMessages(self):
+        """Messages released on stopping are neither removed nor failed"""
+        for run in [runMessageProducer, runMessageProducerAsync]:
+            self.runStoppedPipeline(run, removeFailures=True)
+            self.runStoppedPipeline(run, removeFailures=True, claim=True)
+            self.assertFalse(Path("tests/fsp/failed").exists())
+
+    def test_runMessageProducerStopIdle(self):
+        """An idle producer that waits for new messages is stopped too"""
+        testIn = "tests/fsp"
+        self.clearMessageDir(testIn)
+        blocking = lambda: {t for t in threading.enumerate() if t.is_alive() and not t.daemon}
+        before = blocking()
+        for run in [runMessageProducer, runMessageProducerAsync]:
+            for useInotify in [True, False]:
+                with self.subTest(run=run.__name__, useInotify=useInotify):
+                    producer = ProducerFilesystem(testIn, refreshInterval=0.1,
+                                                  useInotify=useInotify)
+                    stop = threading.Event()
+                    threading.Timer(0.5, stop.set).start()
+                    start = time.monotonic()
+                    with self.assertNoLogs(level="WARNING"):
+                        run(Configuration(lockCommand=False, shutdownGrace=2), producer, stop)
+                    self.assertLess(time.monotonic() - start, 2)
+                    # Nothing is left behind that would hold up interpreter exit
+                    self.assertEqual(blocking() - before, set())
+            with self.subTest(run=run.__name__, producer="StuckProducer"):
+                stop = threading.Event()
+                threading.Timer(0.5, stop.set).start()
+                start = time.monotonic()
+                with self.assertLogs(level="WARNING") as logs:
+                    run(Configuration(lockCommand=False, shutdownGrace=1), StuckProducer(), stop)
+                self.assertLess(time.monotonic() - start, 3)
+                # Given up on, without being mistaken for a running message
+                self.assertEqual(len(logs.output), 1)
+                self.assertIn("Producer did not stop", logs.output[0])
+                self.assertEqual(blocking() - before, set())
+
+    def runStoppedPipeline(self, run, removeFailures=False, claim=False):
+        testIn = "tests/fsp"
+        self.clearMessageDir(testIn)
+        step = Step("slow", command=Command(["sleep", "30"]))
+        for x in range(3):
+            msg = Message(Header(steps=[step, Step("terminus")]), BodyInString(""))
+            Path(testIn).joinpath(str(x)).write_text(msg.toJsonLines())
+        producer = ProducerFilesystem(testIn, quitWhenEmpty=True, claim=claim,
+                                      removeSuccesses=True, removeFailures=removeFailures)
+        stop = threading.Event()
+        threading.Timer(0.5, stop.set).start()
+        start = time.monotonic()
+        run(Configuration(lockCommand=False, prefetch=1, shutdownGrace=1), producer, stop)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(sorted(f.name for f in Path(testIn).glob("*") if f.is_file()),
+                         ["0", "1", "2"])
+        self.clearMessageDir(testIn)
+
+    def clearMessageDir(self, dir):
+        """Removes the messages in *dir*, and its claim directories"""
+        for f in Path(dir).glob("*"):
+            if f.is_file():
+                f.unlink()
+        for sub in ["inflight", "done", "failed"]:
+            shutil.rmtree(Path(dir, sub), ignore_errors=True)
+
+    def test_runMessageProducerMetrics(self):
+        """Every stage of handling a message is timed"""
+        metrics.reset()
+        self.runFilesystemPipeline(Configuration(lockCommand=False), 2)
+        summary = metrics.summary()
+        for stage in ["parse", "queueWait", "popStep", "localize", "extract", "tempFiles",
+                      "expand", "command", "scrape", "trigger", "settle"]:
+            self.assertEqual(summary["stages"][stage]["count"], 2, stage)
+        self.assertEqual(summary["messages"]["succeeded"], 2)
+
+    def test_runMessageProducerBatchedMetrics(self):
+        """A batch times the same stages, once per message or once per run"""
+        command = Command(["tr", "a-z", "A-Z"], inputChannelStdin=True,
+                          batching=Batching(maxMessages=2, maxWaitMs=2000))
+        metrics.reset()
+        self.runFilesystemPipeline(Configuration(command=command), 2, transform=str.upper)
+        summary = metrics.summary()
+        for stage in ["parse", "queueWait", "popStep", "localize", "extract", "tempFiles",
+                      "expand", "command", "scrape", "trigger", "settle"]:
+            self.assertIn(stage, summary["stages"])
+        for stage in ["parse", "popStep", "extract", "trigger", "settle"]:
+            self.assertEqual(summary["stages"][stage]["count"], 2, stage)
+        for stage in ["localize", "tempFiles", "expand", "command", "scrape"]:
+            self.assertEqual(summary["stages"][stage]["count"], 1, stage)
+        self.assertEqual(summary["messages"]["succeeded"], 2)
+
+    def test_runMessageProducerPrefetch(self):
+        """Tests against a filesystem producer while reading ahead"""
+        self.runFilesystemPipeline(Configuration(lockCommand=False, prefetch=2), 5)
+
+    def test_runMessageProducerBatched(self):
+        """Tests that a batched command is run once over several messages"""
+        invocations = Path("tests/batch_invocations.txt")
+        if invocations.exists():
+            invocations.unlink()
+        command = Command(["sh", "-c", f"echo run >> {invocations}; tr a-z A-Z"],
+                          inputChannelStdin=True,
+                          batching=Batching(maxMessages=4, maxWaitMs=2000))
+        try:
+            self.runFilesystemPipeline(Configuration(command=command, concurrency=2), 4,
+                                       transform=str.upper)
+            self.assertEqual(invocations.read_text(), "run\n")
+        finally:
+            invocations.unlink()
+
+    def test_runMessageProducerAsync(self):
+        """Tests the asyncio runtime against a filesystem producer"""
+        self.runFilesystemPipeline(Configuration(lockCommand=False, concurrency=3), 6,
+                                   run=runMessageProducerAsync)
+
+    def test_runMessageProducerAsyncBatched(self):
+        command = Command(["tr", "a-z", "A-Z"], inputChannelStdin=True,
+                          batching=Batching(maxMessages=3, maxWaitMs=500))
+        self.runFilesystemPipeline(Configuration(command=command, prefetch=1), 5,
+                                   transform=str.upper, run=runMessageProducerAsync)
+
+    def test_prepareMessage(self):
+        step = Step("step one", command=Command(["cat", "${bodyfile}"]))
+        msg = Message(Header(steps=[step, Step("terminus")]), BodyInString("body"))
+        work = prepareMessage(msg, "scratch").value
+        self.assertEqual(work.step, step)
+        self.assertEqual(work.newHeader, Header(steps=[Step("terminus")]))
+        self.assertEqual(work.localized, [])
+        self.assertEqual(work.scratchDir, "scratch")
+
     # TODO: Should this test be moved elsewhere since it relies on
     # A. network access
     # B. active AWS account with SQS perms
@@ -0,0 +1,123 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import io
+import os
+import tempfile
+import threading
+from pathlib import Path
+from unittest.mock import patch
+
+from npipes.assethandlers import s3utils
+from npipes.assethandlers.s3utils import *
+from npipes.outcome import Success, Failure
+
+try:
+    try:
+        from moto import mock_aws
+    except ImportError: # moto < 5
+        from moto import mock_s3 as mock_aws
+    haveMoto = True
+except ImportError:
+    haveMoto = False
+
+
+class FakeClient:
+    """Serves ranged GETs of a single object, recording the ranges asked for
+    """
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, Range, **kwargs):
+        first, last = map(int, Range[len("bytes="):].split("-"))
+        with self.lock:
+            self.ranges.append((first, last))
+        return {"Body": io.BytesIO(self.data[first:last + 1])}
+
+
+class S3UtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = s3utils.transferSettings
+
+    def tearDown(self):
+        configureTransfers(self.settings.chunkSize, self.settings.concurrency)
+        self.tmp.cleanup()
+
+    def test_byteRanges(self):
+        self.assertEqual(byteRanges(10, 4), [(0, 3), (4, 7), (8, 9)])
+        self.assertEqual(byteRanges(8, 4), [(0, 3), (4, 7)])
+        self.assertEqual(byteRanges(0, 4), [])
+
+    def test_downloadRanges(self):
+        data = os.urandom(10000)
+        client = FakeClient(data)
+        configureTransfers(1024, 4)
+        target = Path(self.tmp.name, "obj")
+        remote = RemoteObject("bucket", "key", "etag", len(data))
+        with patch.object(s3utils, "s3Client", return_value=client):
+            downloadRanges(remote, target)
+        self.assertEqual(target.read_bytes(), data)
+        self.assertEqual(sorted(client.ranges), byteRanges(len(data), 1024))
+        self.assertEqual(os.listdir(self.tmp.name), ["obj"])
+
+    def test_downloadRangesShortRead(self):
+        client = FakeClient(b"x" * 100)
+        target = Path(self.tmp.name, "obj")
+        remote = RemoteObject("bucket", "key", "etag", 200)
+        with patch.object(s3utils, "s3Client", return_value=client):
+            self.assertRaises(IOError, downloadRanges, remote, target)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+
+@unittest.skipUnless(haveMoto, "moto is not installed")
+class S3UtilsMotoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.mock = mock_aws()
+        self.mock.start()
+        self.settings = s3utils.transferSettings
+        configureTransfers(5 * MiB, 4)
+        s3Client().create_bucket(Bucket="bucket")
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        configureTransfers(self.settings.chunkSize, self.settings.concurrency)
+        self.mock.stop()
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        data = os.urandom(12 * MiB)
+        source = Path(self.tmp.name, "source")
+        source.write_bytes(data)
+        self.assertIsInstance(uploadFile(source, "s3://bucket/big"), Success)
+        remote = headObject(S3Path("s3://bucket/big"))
+        self.assertTrue(isMultipartEtag(remote.etag))
+        target = Path(self.tmp.name, "target")
+        self.assertIsInstance(downloadFile("s3://bucket/big", target), Success)
+        self.assertEqual(target.read_bytes(), data)
+        self.assertTrue(isCurrent(remote, source))
+
+    def test_uploadData(self):
+        self.assertIsInstance(uploadData("small", "s3://bucket/small"), Success)
+        data = os.urandom(11 * MiB)
+        self.assertIsInstance(uploadData(io.BytesIO(data), "s3://bucket/stream"), Success)
+        target = Path(self.tmp.name, "stream")
+        downloadFile("s3://bucket/stream", target)
+        self.assertEqual(target.read_bytes(), data)
+        target = Path(self.tmp.name, "small")
+        downloadFile("s3://bucket/small", target)
+        self.assertEqual(target.read_text(), "small")
+
+    def test_missing(self):
+        self.assertIsInstance(downloadFile("s3://bucket/missing", Path(self.tmp.name, "m")), Failure)
+        self.assertIsInstance(remoteVersion("s3://bucket/missing"), Failure)
+
+
+if __name__ == '__main__':
+    unittest.main()
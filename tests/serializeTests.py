@@ -5,6 +5,8 @@ import unittest
 from npipes.message.header import *
 # from npipes.message.message import *
 from npipes.assethandlers.s3utils import S3Path
+from npipes import serialize
+from npipes.serialize import CODECS, useCodec
 
 class SerializeTestCase(unittest.TestCase):
 
@@ -41,6 +43,15 @@ class SerializeTestCase(unittest.TestCase):
         self.assertEqual(ur._toMinDict(), expected)
         self.assertEqual(ur, Asset._fromDict(ur._toMinDict()))
 
+    def test_toMinDictCached(self):
+        step = Step("step one", command=Command(["cat"]))
+        first = step._toMinDict()
+        first["id"] = "changed"
+        first["command"]["timeout"] = 5
+        self.assertEqual(step._toMinDict(), {"id": "step one", "command": {"arglist": ["cat"]}})
+        self.assertEqual(Step()._toMinDict(), {})
+        self.assertEqual(Step(id="x")._toMinDict(), {"id": "x"})
+
     def test_with(self):
         s = Step( id="list",
                   trigger=TriggerSqs( QueueName("lister_queue"), overflowPath="s3://junk"),
@@ -60,6 +71,68 @@ class SerializeTestCase(unittest.TestCase):
         self.assertEqual(t.description, newdesc)
         self.assertEqual(t.command.arglist, newargs)
 
+    def test_codecs(self):
+        msg = Message(Header(steps=[Step("one", command=Command(["cat"]))]),
+                      BodyInString('multi\nline "quoted" \u00e9 \U0001F600 body'))
+        try:
+            for name in CODECS:
+                useCodec(name)
+                text = msg.toMinJsonLines()
+                self.assertEqual(len(text.splitlines()), 2)
+                self.assertEqual(Message.fromJsonLines(text), msg)
+                self.assertEqual(serialize.loadJson(serialize.dumpJson({"n": 2**70})), {"n": 2**70})
+        finally:
+            useCodec("")
+
+    def test_useCodec(self):
+        self.assertEqual(useCodec("json").name, "json")
+        self.assertRaises(ValueError, useCodec, "nonesuch")
+        fastest = next(name for name in serialize.PREFERENCE if name in CODECS)
+        self.assertEqual(useCodec("").name, fastest)
+
+    def test_withSharesSubtrees(self):
+        body = BodyInString("x" * 1000)
+        steps = [Step("one", command=Command(["a"])), Step("two")]
+        msg = Message(Header(steps=steps), body)
+        t = msg._with([(".header.steps", steps[1:])])
+        self.assertIs(t.body, body)
+        self.assertIs(t.header.steps[0], steps[1])
+        u = steps[0]._with([(".command.timeout", 5)])
+        self.assertEqual(u.command.timeout, 5)
+        self.assertIs(u.command.arglist, steps[0].command.arglist)
+        self.assertIs(u.trigger, steps[0].trigger)
+
+    def test_withFallsBack(self):
+        # Not a field of Header, so it goes by way of the dicts, which ignore it
+        msg = Message(Header(steps=[Step("one")]), BodyInString("b"))
+        self.assertEqual(msg._with([(".header.nonesuch", 1)]), msg)
+
+    def test_fromJsonLinesLazy(self):
+        msg = Message(Header(steps=[Step("one")]), BodyInString("a\nb"))
+        lazy = Message.fromJsonLines(msg.toJsonLines())
+        self.assertIsInstance(lazy.__dict__["_body"], RawBody)
+        self.assertEqual(lazy.header, msg.header)
+        self.assertEqual(lazy.body, msg.body)
+        self.assertIs(lazy.body, lazy.body)
+        self.assertEqual(lazy, msg)
+        self.assertEqual(Message.fromJsonLines(msg.toJsonLines().replace("\n", "\r\n", 1)), msg)
+        self.assertEqual(Message.fromJsonLines(toJson(msg.header)).body, BodyInString(""))
+
+    def test_withKeepsBodyLazy(self):
+        msg = Message(Header(steps=[Step("one"), Step("two")]), BodyInString("b"))
+        lazy = Message.fromJsonLines(msg.toJsonLines())
+        t = lazy._with([(".header.steps", [Step("two")])])
+        self.assertIsInstance(lazy.__dict__["_body"], RawBody)
+        self.assertIsInstance(t.__dict__["_body"], RawBody)
+        self.assertEqual(t.header.steps, [Step("two")])
+        self.assertEqual(t.body, msg.body)
+
+    def test_fromJsonLinesBadBody(self):
+        # A malformed body only fails once it is used
+        lazy = Message.fromJsonLines(toJson(Header()) + "\n{nope")
+        self.assertEqual(lazy.header, Header())
+        self.assertRaises(ValueError, lambda: lazy.body)
+
 
 if __name__ == '__main__':
     unittest.main()
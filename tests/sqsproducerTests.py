@@ -0,0 +1,150 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import os
+import threading
+import time
+from unittest.mock import patch
+
+from npipes.message.header import Message, Header, Step, Command, BodyInString
+from npipes.awsclients import client, forget
+from npipes.producers.sqs import *
+from npipes.outcome import Success, Failure
+from npipes.configuration import Configuration
+from npipes.processor import runMessageProducer
+from npipes.asyncprocessor import runMessageProducerAsync
+
+try:
+    try:
+        from moto import mock_aws
+    except ImportError: # moto < 5
+        from moto import mock_sqs as mock_aws
+    haveMoto = True
+except ImportError:
+    haveMoto = False
+
+
+@unittest.skipUnless(haveMoto, "moto is not installed")
+class ProducerSqsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        self.mock = mock_aws()
+        self.mock.start()
+        forget("sqs")
+        self.url = client("sqs").create_queue(QueueName="q",
+                                              Attributes={"VisibilityTimeout": "2"})["QueueUrl"]
+
+    def tearDown(self):
+        forget("sqs")
+        self.mock.stop()
+
+    def send(self, count):
+        for n in range(count):
+            message = Message(Header(steps=[Step("s")]), BodyInString(str(n)))
+            client("sqs").send_message(QueueUrl=self.url, MessageBody=message.toJsonLines())
+
+    def counts(self):
+        attributes = client("sqs").get_queue_attributes(
+            QueueUrl=self.url, AttributeNames=["ApproximateNumberOfMessages",
+                                               "ApproximateNumberOfMessagesNotVisible"])["Attributes"]
+        return (int(attributes["ApproximateNumberOfMessages"]),
+                int(attributes["ApproximateNumberOfMessagesNotVisible"]))
+
+    def take(self, deliveries, count):
+        return [next(deliveries) for _ in range(count)]
+
+    def test_batchedAcks(self):
+        self.send(12)
+        sqs = client("sqs")
+        deliveries = ProducerSqs("q", maxNumberOfMessages=10, waitTimeSeconds=0,
+                                 ackIntervalMs=60000).deliveries()
+        with patch.object(sqs, "delete_message_batch", wraps=sqs.delete_message_batch) as deletes, \
+             patch.object(sqs, "change_message_visibility_batch",
+                          wraps=sqs.change_message_visibility_batch) as changes:
+            taken = self.take(deliveries, 12)
+            for delivery in taken[:11]:
+                delivery.settle(Success(None))
+            # A full batch is sent straight away. Once it has gone, the
+            # release below can only be sent by closing.
+            deadline = time.monotonic() + 5
+            while not deletes.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+            taken[11].settle(Failure("again"))
+            deliveries.close()
+        self.assertEqual([len(c.kwargs["Entries"]) for c in deletes.call_args_list], [10, 1])
+        self.assertEqual([len(c.kwargs["Entries"]) for c in changes.call_args_list], [1])
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_ackInterval(self):
+        self.send(1)
+        deliveries = ProducerSqs("q", ackIntervalMs=100).deliveries()
+        next(deliveries).settle(Success(None))
+        time.sleep(0.5)
+        self.assertEqual(self.counts(), (0, 0))
+        deliveries.close()
+
+    def test_heartbeat(self):
+        self.send(1)
+        deliveries = ProducerSqs("q", ackIntervalMs=100).deliveries()
+        delivery = next(deliveries)
+        time.sleep(3) # Longer than the queue's visibility timeout
+        self.assertEqual(self.counts(), (0, 1))
+        delivery.settle(Success(None))
+        deliveries.close()
+        self.assertEqual(self.counts(), (0, 0))
+
+    def test_prefetch(self):
+        self.send(2)
+        deliveries = ProducerSqs("q", waitTimeSeconds=0).deliveries()
+        next(deliveries)
+        time.sleep(0.5)
+        # The second message was received ahead of being asked for
+        self.assertEqual(self.counts(), (0, 2))
+        deliveries.close()
+        # ...and is handed back when the producer closes
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_prefetchWaitingHandedBack(self):
+        self.send(3)
+        deliveries = ProducerSqs("q", waitTimeSeconds=0).deliveries()
+        next(deliveries)
+        time.sleep(0.5)
+        # One batch waits to be handed out, and the next waits for room
+        self.assertEqual(self.counts(), (0, 3))
+        deliveries.close()
+        # ...and both are handed back when the producer closes
+        self.assertEqual(self.counts(), (2, 1))
+
+    def test_runMessageProducerFlushesAcks(self):
+        """Acknowledgements still waiting when the runtime stops are sent"""
+        for run in [runMessageProducer, runMessageProducerAsync]:
+            with self.subTest(run=run.__name__):
+                for n in range(2):
+                    message = Message(Header(steps=[Step("s", command=Command(["true"])),
+                                                    Step("terminus")]),
+                                      BodyInString(str(n)))
+                    client("sqs").send_message(QueueUrl=self.url,
+                                               MessageBody=message.toJsonLines())
+                producer = ProducerSqs("q", waitTimeSeconds=0, ackIntervalMs=60000)
+                stop = threading.Event()
+                succeeded = []
+                settle = AckBatcher.settle
+                def settleThenStop(acks, handle, result):
+                    settle(acks, handle, result)
+                    if isinstance(result, Success):
+                        succeeded.append(handle)
+                        if len(succeeded) == 2:
+                            stop.set()
+                timer = threading.Timer(10, stop.set)
+                timer.start()
+                with patch.object(AckBatcher, "settle", settleThenStop):
+                    run(Configuration(lockCommand=False, shutdownGrace=1), producer, stop)
+                timer.cancel()
+                self.assertEqual(len(succeeded), 2)
+                self.assertEqual(self.counts(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- mode: python;-*-
+
+import unittest
+
+import hashlib
+import os
+import random
+import string
+import threading
+import time
+from unittest.mock import patch
+
+from npipes.message.header import *
+from npipes.processor import extractBodyInString, extractBody
+from npipes.triggers import sqs
+from npipes.triggers.sqs import *
+from npipes.outcome import Success, Failure
+
+try:
+    try:
+        from moto import mock_aws
+    except ImportError: # moto < 5
+        from moto import mock_s3 as mock_aws
+    haveMoto = True
+except ImportError:
+    haveMoto = False
+
+
+class FakeSqs:
+    """Records SendMessageBatch calls, failing any entry whose body is "bad"
+    """
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        with self.lock:
+            self.batches.append((QueueUrl, [e["MessageBody"] for e in Entries]))
+        return {"Successful": [{"Id": e["Id"],
+                                "MD5OfMessageBody": hashlib.md5(e["MessageBody"].encode()).hexdigest()}
+                               for e in Entries if e["MessageBody"] != "bad"],
+                "Failed": [{"Id": e["Id"], "Code": "InvalidMessageContents", "Message": "bad"}
+                           for e in Entries if e["MessageBody"] == "bad"]}
+
+
+class SendBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sqs = FakeSqs()
+        patcher = patch.object(sqs, "client", return_value=self.sqs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sendAll(self, buffer, sends):
+        """Sends each (url, body) of *sends* from its own thread
+        """
+        results = [None] * len(sends)
+        def send(n):
+            results[n] = buffer.send(*sends[n])
+        threads = [threading.Thread(target=send, args=(n,)) for n in range(len(sends))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesces(self):
+        results = self.sendAll(SendBuffer(linger=0.5), [("q", str(n)) for n in range(25)])
+        self.assertTrue(all(isinstance(r, Success) for r in results))
+        sizes = sorted(len(bodies) for _, bodies in self.sqs.batches)
+        self.assertEqual(sizes, [5, 10, 10])
+        self.assertEqual(sorted(b for _, bodies in self.sqs.batches for b in bodies),
+                         sorted(str(n) for n in range(25)))
+
+    def test_perQueue(self):
+        self.sendAll(SendBuffer(linger=0.2), [("q1", "a"), ("q2", "b"), ("q1", "c")])
+        self.assertEqual(sorted((url, sorted(bodies)) for url, bodies in self.sqs.batches),
+                         [("q1", ["a", "c"]), ("q2", ["b"])])
+
+    def test_byteLimit(self):
+        big = "x" * (MAX_BATCH_BYTES // 2)
+        self.sendAll(SendBuffer(linger=0.2), [("q", big)] * 3)
+        self.assertEqual(sorted(len(bodies) for _, bodies in self.sqs.batches), [1, 2])
+
+    def test_byteLimitWakesLeader(self):
+        big = "x" * (MAX_BATCH_BYTES * 3 // 4)
+        buffer = SendBuffer(linger=2)
+        finished = []
+        def send():
+            buffer.send("q", big)
+            finished.append(time.monotonic())
+        first = threading.Thread(target=send)
+        start = time.monotonic()
+        first.start()
+        time.sleep(0.1)
+        second = threading.Thread(target=send)
+        second.start()
+        first.join()
+        second.join()
+        # The first batch goes out as soon as the second message closes it
+        self.assertLess(min(finished) - start, 1)
+        self.assertEqual(len(self.sqs.batches), 2)
+
+    def test_lingerBoundsWait(self):
+        start = time.monotonic()
+        self.assertIsInstance(SendBuffer(linger=0.1).send("q", "alone"), Success)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.sqs.batches, [("q", ["alone"])])
+
+    def test_perEntryFailure(self):
+        ok, bad = self.sendAll(SendBuffer(linger=0.2), [("q", "ok"), ("q", "bad")])
+        self.assertEqual(len(self.sqs.batches), 1)
+        self.assertIsInstance(ok, Success)
+        self.assertIn("InvalidMessageContents", bad.reason)
+
+    def test_callFailure(self):
+        self.sqs.send_message_batch = lambda **kwargs: 1 / 0
+        result = SendBuffer(linger=0).send("q", "body")
+        self.assertIn("division by zero", result.reason)
+
+
+class OverflowTestCase(unittest.TestCase):
+
+    def message(self, text):
+        return Message(Header(steps=[Step("next")]), BodyInString(text))
+
+    def test_smallUnchanged(self):
+        msg = self.message("small")
+        self.assertIs(overflow(msg, "s3://bucket/overflow"), msg)
+
+    def test_compresses(self):
+        text = "compressible " * 30000
+        result = overflow(self.message(text), "s3://bucket/overflow")
+        self.assertIsInstance(result.body.encoding, EncodingGzB64)
+        self.assertEqual(extractBodyInString(result.body), text)
+        self.assertLessEqual(len(result.toJsonLines().encode()), 260000)
+
+    def test_compressesBytes(self):
+        data = bytes(range(256)) * 2000
+        msg = Message(Header(steps=[Step("next")]), BodyInBytes(data))
+        result = overflow(msg, "s3://bucket/overflow")
+        self.assertIsInstance(result.body.encoding, EncodingGzB64)
+        self.assertEqual(extractBody(result.body, [], binary=True), data)
+        self.assertLessEqual(len(result.toJsonLines().encode()), 260000)
+
+    @unittest.skipUnless(haveMoto, "moto is not installed")
+    def test_toS3(self):
+        from npipes.assethandlers import s3utils
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        with mock_aws():
+            s3utils.configureTransfers(s3utils.transferSettings.chunkSize,
+                                       s3utils.transferSettings.concurrency)
+            s3utils.s3Client().create_bucket(Bucket="bucket")
+            rng = random.Random(0)
+            text = "".join(rng.choices(string.ascii_letters, k=400000))
+            result = overflow(self.message(text), "s3://bucket/overflow")
+            self.assertEqual(result.body, BodyInAsset(assetId="AutoOverflow"))
+            asset, = result.header.steps[0].assets
+            self.assertEqual(asset.settings.id, "AutoOverflow")
+            self.assertIsNotNone(s3utils.headObject(asset.path))
+
+
+if __name__ == '__main__':
+    unittest.main()